@@ -0,0 +1,177 @@
+"""
+Loading statistics into NumPy arrays for analysis.
+
+:py:func:`load_matrix`, also available as
+:py:meth:`Statistic.objects.as_matrix <gatherstats.models.StatisticManager.as_matrix>`, reads
+the statistics for a set of keys from one endpoint into a dense keys by fetch times
+:py:class:`TimeSeriesMatrix` without creating a model instance per statistic. The matrix has
+vectorised helpers for the differences and growth rates of each series and for ratios such as
+the fraction of each institution's assets which are completed.
+
+NumPy is an optional dependency of :py:mod:`gatherstats` and is only needed by this module.
+
+"""
+import datetime
+
+from django.db import DEFAULT_DB_ALIAS
+import numpy
+
+from gatherstats.models import Snapshot, Statistic, StatisticKey
+
+#: Number of statistics read from the database at a time.
+CHUNK_SIZE = 10000
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class TimeSeriesMatrix:
+    """
+    A dense matrix of statistic values with one row per key and one column per fetch time.
+    Missing values are NaN.
+
+    """
+    def __init__(self, keys, times, values, parents=None, leaves=None):
+        #: List of the key path of each row.
+        self.keys = list(keys)
+
+        #: NumPy ``datetime64[us]`` array of the fetch time, in UTC, of each column.
+        self.times = numpy.asarray(times, dtype='datetime64[us]')
+
+        #: NumPy float array of values with shape (number of keys, number of times).
+        self.values = numpy.asarray(values, dtype=float)
+
+        #: Lists of the parent path and leaf name of each key. See
+        #: :py:class:`~gatherstats.models.StatisticKey`.
+        self.parents = list(parents) if parents is not None else [None] * len(self.keys)
+        self.leaves = list(leaves) if leaves is not None else [None] * len(self.keys)
+
+        self._row_indexes = {key: index for index, key in enumerate(self.keys)}
+
+    @property
+    def mask(self):
+        """Boolean array which is True where a value is present."""
+        return ~numpy.isnan(self.values)
+
+    def row(self, key):
+        """Return the array of values of the key with path *key*."""
+        return self.values[self._row_indexes[key]]
+
+    def fill_forward(self):
+        """Return a matrix in which each missing value is replaced by the last value present
+        before it in the same row. This reconstructs full series for endpoints gathered with
+        delta storage, for which only changed values are recorded.
+
+        """
+        present = self.mask
+        # For each cell, the column index of the last present value at or before it.
+        last_present = numpy.where(present, numpy.arange(self.values.shape[1]), 0)
+        numpy.maximum.accumulate(last_present, axis=1, out=last_present)
+        filled = numpy.take_along_axis(self.values, last_present, axis=1)
+        # Cells before the first present value in a row remain missing.
+        filled[~numpy.logical_or.accumulate(present, axis=1)] = numpy.nan
+        return self._derived(self.times, filled)
+
+    def differences(self):
+        """Return a matrix of the change in each value since the previous fetch time. It has
+        one column fewer than this matrix.
+
+        """
+        return self._derived(self.times[1:], numpy.diff(self.values, axis=1))
+
+    def growth_rates(self):
+        """Return a matrix of the fractional change in each value since the previous fetch
+        time. Changes from zero are NaN. It has one column fewer than this matrix.
+
+        """
+        previous = self.values[:, :-1]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            rates = numpy.diff(self.values, axis=1) / previous
+        rates[previous == 0] = numpy.nan
+        return self._derived(self.times[1:], rates)
+
+    def ratios(self, numerator='completed', denominator='total'):
+        """Return a matrix of the ratio of the key with leaf name *numerator* to the key with
+        leaf name *denominator* under each parent path which has both. The rows are the parent
+        paths. Ratios with a zero denominator are NaN. For example, if the matrix holds the
+        completed and total counts for each institution, the result is the fraction of each
+        institution's assets which are completed.
+
+        """
+        rows_by_parent = {}
+        for index, (parent, leaf) in enumerate(zip(self.parents, self.leaves)):
+            if leaf in (numerator, denominator):
+                rows_by_parent.setdefault(parent, {})[leaf] = index
+
+        parents = sorted(
+            parent for parent, rows in rows_by_parent.items()
+            if numerator in rows and denominator in rows)
+        numerators = self.values[[rows_by_parent[parent][numerator] for parent in parents]]
+        denominators = self.values[[rows_by_parent[parent][denominator] for parent in parents]]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ratios = numerators / denominators
+        ratios[denominators == 0] = numpy.nan
+        return TimeSeriesMatrix(parents, self.times, ratios)
+
+    def _derived(self, times, values):
+        return TimeSeriesMatrix(self.keys, times, values, self.parents, self.leaves)
+
+
+def load_matrix(endpoint, patterns=(), prefixes=(), start=None, end=None,
+                using=DEFAULT_DB_ALIAS):
+    """Return a :py:class:`TimeSeriesMatrix` of the values of the keys matching the glob
+    patterns *patterns* or starting with *prefixes* fetched from the endpoint with URL
+    *endpoint* at or after the datetime *start* and before the datetime *end* if not None. See
+    :py:meth:`StatisticKeyManager.matching <gatherstats.models.StatisticKeyManager.matching>`.
+
+    The rows are ordered by key path and there is a column for each fetch of the endpoint with
+    statistics in the time range. The values are read in chunks into a preallocated array.
+
+    """
+    key_qs = StatisticKey.objects.db_manager(using).matching(patterns, prefixes)
+    keys = list(key_qs.order_by('path').values_list('pk', 'path', 'parent', 'leaf'))
+    row_indexes = {pk: index for index, (pk, _, _, _) in enumerate(keys)}
+
+    snapshots = Snapshot.objects.using(using).filter(endpoint__url=endpoint, unchanged=False)
+    statistics = Statistic.objects.using(using).filter(endpoint__url=endpoint, key__in=key_qs)
+    if start is not None:
+        snapshots = snapshots.filter(fetched_at__gte=start)
+        statistics = statistics.filter(fetched_at__gte=start)
+    if end is not None:
+        snapshots = snapshots.filter(fetched_at__lt=end)
+        statistics = statistics.filter(fetched_at__lt=end)
+
+    times = numpy.array(sorted(
+        _microseconds(fetched_at)
+        for fetched_at in snapshots.values_list('fetched_at', flat=True).distinct()
+    ), dtype=numpy.int64)
+    values = numpy.full((len(keys), len(times)), numpy.nan)
+
+    if len(keys) > 0 and len(times) > 0:
+        chunk = []
+        rows = statistics.values_list('key_id', 'fetched_at', 'numeric_value')
+        for row in rows.iterator(chunk_size=CHUNK_SIZE):
+            chunk.append(row)
+            if len(chunk) >= CHUNK_SIZE:
+                _fill(values, times, row_indexes, chunk)
+                chunk = []
+        _fill(values, times, row_indexes, chunk)
+
+    return TimeSeriesMatrix(
+        [path for _, path, _, _ in keys], times.astype('datetime64[us]'), values,
+        parents=[parent for _, _, parent, _ in keys], leaves=[leaf for _, _, _, leaf in keys])
+
+
+def _fill(values, times, row_indexes, chunk):
+    """Set the cells of *values* for the key id, fetched_at, value tuples in *chunk*."""
+    if len(chunk) == 0:
+        return
+    key_ids, fetched_ats, chunk_values = zip(*chunk)
+    rows = numpy.fromiter((row_indexes[key_id] for key_id in key_ids), dtype=numpy.intp)
+    columns = numpy.searchsorted(
+        times, numpy.fromiter(map(_microseconds, fetched_ats), dtype=numpy.int64))
+    values[rows, columns] = chunk_values
+
+
+def _microseconds(when):
+    return (when - _EPOCH) // _MICROSECOND
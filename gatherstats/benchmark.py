@@ -0,0 +1,357 @@
+"""
+Benchmarks of the ingest path using synthetic stats endpoint responses.
+
+:py:func:`synthetic_body` generates response bodies shaped like those of the IAR backend's stats
+endpoint with a configurable number of institutions, depth of breakdown and number of counts at
+each level. :py:func:`run` times flattening a body, creating statistics from a body with
+:py:meth:`~gatherstats.models.StatisticManager.create_from_stats_response` and running the
+gatherstats management command end to end on a file, against the default database.
+
+:py:func:`queries` generates a dataset of many snapshots from several endpoints and times the
+standard read queries against it, recording the query plan of each. Together with
+:py:func:`storage`, which reports the size of the statistic table and each of its indexes, this
+shows the effect of adding or dropping an index on both reads and the ingest benchmarks.
+
+The benchmarkstats management command runs the benchmarks in a temporary test database and saves
+the results as JSON so that they can be compared between commits. Run it with the development
+settings to benchmark SQLite and with ``DJANGO_DB_ENGINE`` etc. pointing at a local PostgreSQL
+server to benchmark PostgreSQL.
+
+"""
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import django
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
+
+from gatherstats.models import (
+    Endpoint, LatestStatistic, Statistic, StatisticKey, _flatten_dict)
+
+#: Names of the counts at each level of a synthetic body.
+COUNT_NAMES = (
+    'total', 'completed', 'with_personal_data', 'with_sensitive_personal_data',
+    'with_risk_type', 'with_storage', 'private', 'deleted',
+)
+
+#: Names of the breakdowns of each institution's counts in a synthetic body, outermost first.
+DIMENSIONS = ('department', 'purpose', 'owner', 'storage')
+
+#: Names of the benchmarks run by :py:func:`run`.
+BENCHMARKS = ('flatten', 'create_from_stats_response', 'gatherstats_command')
+
+#: Names of the queries timed by :py:func:`queries`.
+QUERIES = ('series', 'key_across_endpoints', 'time_range', 'values_at', 'latest')
+
+# Directory containing manage.py.
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run by startup() in a fresh interpreter. Prints the elapsed time and the modules loaded.
+_STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+import gatherstats.management.commands.gatherstats
+print(json.dumps({'seconds': time.perf_counter() - started, 'modules': sorted(sys.modules)}))
+'''
+
+
+def synthetic_body(institutions=100, depth=1, breadth=4, counts=4, seed=0):
+    """Return a synthetic stats endpoint response body. Overall counts are given for all assets
+    and for each of *institutions* institutions. Each institution's counts are broken down
+    *depth* levels deep with *breadth* values at each level. There are *counts* counts at each
+    level. Counts are random but reproducible for a given *seed*.
+
+    The number of keys in the body is ``counts * (1 + institutions * (1 + breadth + ... +
+    breadth ** depth))``.
+
+    """
+    if not 0 < counts <= len(COUNT_NAMES):
+        raise ValueError('counts must be between 1 and {}'.format(len(COUNT_NAMES)))
+    if not 0 <= depth <= len(DIMENSIONS):
+        raise ValueError('depth must be between 0 and {}'.format(len(DIMENSIONS)))
+
+    rng = random.Random(seed)
+
+    def make_counts():
+        return {name: rng.randrange(10000) for name in COUNT_NAMES[:counts]}
+
+    def make_breakdown(level):
+        node = make_counts()
+        if level < depth:
+            node['by_' + DIMENSIONS[level]] = {
+                '{}{:02d}'.format(DIMENSIONS[level].upper(), idx): make_breakdown(level + 1)
+                for idx in range(breadth)
+            }
+        return node
+
+    return {
+        'asset_counts': {
+            'all': make_counts(),
+            'by_institution': {
+                'INST{:04d}'.format(idx): make_breakdown(0) for idx in range(institutions)
+            },
+        },
+    }
+
+
+def run(sizes=(100,), depth=1, breadth=4, counts=4, repeat=5):
+    """Run each benchmark *repeat* times for synthetic bodies with each number of institutions
+    in *sizes* and the other arguments as for :py:func:`synthetic_body`. Return a list of
+    results, one per benchmark and size, as dictionaries suitable for serialising as JSON.
+
+    Statistics are written to the default database. Each size uses its own endpoint and one
+    unmeasured ingest is made first so that keys exist and caches are warm, as in a regular
+    gather. Every repeat uses a body with different values so that no response is skipped as
+    unchanged.
+
+    """
+    results = []
+    for size in sizes:
+        bodies = [
+            synthetic_body(size, depth, breadth, counts, seed=seed) for seed in range(repeat + 1)
+        ]
+        key_count = sum(1 for _ in _flatten_dict(bodies[0]))
+        parameters = {
+            'institutions': size, 'depth': depth, 'breadth': breadth, 'counts': counts,
+            'keys': key_count,
+        }
+
+        timings = [_time(lambda: list(_flatten_dict(body))) for body in bodies[1:]]
+        results.append(_result('flatten', parameters, timings))
+
+        endpoint = 'https://benchmark.invalid/{}/ingest'.format(size)
+        fetched_at = timezone.now()
+        timings = []
+        for idx, body in enumerate(bodies):
+            elapsed = _time(lambda: Statistic.objects.create_from_stats_response(
+                endpoint=endpoint, body=body,
+                fetched_at=fetched_at + datetime.timedelta(seconds=idx), return_objects=False))
+            if idx > 0:
+                timings.append(elapsed)
+        results.append(_result('create_from_stats_response', parameters, timings))
+
+        endpoint = 'https://benchmark.invalid/{}/command'.format(size)
+        timings = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for idx, body in enumerate(bodies):
+                path = os.path.join(tmp_dir, '{}.json'.format(idx))
+                with open(path, 'w') as fobj:
+                    json.dump(body, fobj)
+                elapsed = _time(lambda: call_command(
+                    'gatherstats', path, endpoint=endpoint, stdout=io.StringIO()))
+                if idx > 0:
+                    timings.append(elapsed)
+        results.append(_result('gatherstats_command', parameters, timings))
+
+    return results
+
+
+def queries(institutions=100, snapshots=100, endpoints=2, depth=1, breadth=4, counts=4,
+            repeat=5):
+    """Ingest *snapshots* hourly synthetic bodies with *institutions* institutions, and the
+    other arguments as for :py:func:`synthetic_body`, from each of *endpoints* endpoints and then
+    run each of the standard queries named in :py:data:`QUERIES` *repeat* times. Return a list of
+    results as for :py:func:`run` which also give the plan of each query as returned by
+    :py:meth:`QuerySet.explain() <django.db.models.query.QuerySet.explain>`.
+
+    The queries are:
+
+    ``series``
+        One key from one endpoint over the middle half of the time range.
+    ``key_across_endpoints``
+        One key from every endpoint over the middle half of the time range.
+    ``time_range``
+        Every statistic fetched within one hour.
+    ``values_at``
+        Every key's value from one endpoint at the middle of the time range.
+    ``latest``
+        Every key's latest value from one endpoint.
+
+    """
+    hour = datetime.timedelta(hours=1)
+    start = timezone.make_aware(datetime.datetime(2018, 1, 1))
+    urls = [
+        'https://benchmark.invalid/{}/queries/{}'.format(institutions, idx)
+        for idx in range(endpoints)
+    ]
+    for idx in range(snapshots):
+        body = synthetic_body(institutions, depth, breadth, counts, seed=idx)
+        for url in urls:
+            Statistic.objects.create_from_stats_response(
+                endpoint=url, body=body, fetched_at=start + idx * hour, return_objects=False)
+
+    # Let the query planner see the generated data.
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+    endpoint_id = Endpoint.objects.get(url=urls[0]).pk
+    key_id = StatisticKey.objects.get(path='asset_counts.all.' + COUNT_NAMES[0]).pk
+    range_start, range_end = start + (snapshots // 4) * hour, start + (3 * snapshots // 4) * hour
+    middle = start + (snapshots // 2) * hour
+    querysets = {
+        'series': (
+            Statistic.objects
+            .filter(endpoint_id=endpoint_id, key_id=key_id, fetched_at__gte=range_start,
+                    fetched_at__lt=range_end)
+            .order_by('fetched_at').values_list('fetched_at', 'numeric_value')
+        ),
+        'key_across_endpoints': (
+            Statistic.objects
+            .filter(key_id=key_id, fetched_at__gte=range_start, fetched_at__lt=range_end)
+            .values_list('endpoint_id', 'fetched_at', 'numeric_value')
+        ),
+        'time_range': (
+            Statistic.objects
+            .filter(fetched_at__gte=middle, fetched_at__lt=middle + hour)
+            .values_list('key_id', 'numeric_value')
+        ),
+        'values_at': (
+            Statistic.objects.values_at(urls[0], middle).values_list('key_id', 'numeric_value')
+        ),
+        'latest': (
+            LatestStatistic.objects.for_endpoint(urls[0]).values_list('key_id', 'numeric_value')
+        ),
+    }
+
+    parameters = {
+        'institutions': institutions, 'snapshots': snapshots, 'endpoints': endpoints,
+        'depth': depth, 'breadth': breadth, 'counts': counts,
+        'rows': Statistic.objects.filter(endpoint__url__in=urls).count(),
+    }
+    results = []
+    for name in QUERIES:
+        queryset = querysets[name]
+        # Each repeat evaluates a copy of the queryset since a queryset caches its results.
+        timings = [_time(lambda: list(queryset.all())) for _ in range(repeat)]
+        results.append({
+            'name': name,
+            'parameters': parameters,
+            'timings': timings,
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'plan': queryset.explain(),
+        })
+    return results
+
+
+def storage():
+    """Return a dictionary describing the statistic table and its indexes. The ``indexes``
+    member is a list of dictionaries giving the name, columns and uniqueness of each index. On
+    PostgreSQL, the sizes in bytes of the table and of each index are also given.
+
+    """
+    table = Statistic._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+        indexes = [
+            {'name': name, 'columns': details['columns'], 'unique': details['unique']}
+            for name, details in sorted(constraints.items()) if details['index']
+        ]
+        result = {'table': table, 'indexes': indexes}
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_relation_size(%s::regclass)', [table])
+            result['size'], = cursor.fetchone()
+            for index in indexes:
+                cursor.execute('SELECT pg_relation_size(%s::regclass)', [index['name']])
+                index['size'], = cursor.fetchone()
+    return result
+
+
+def startup(settings_module, repeat=5):
+    """Time setting up Django with the settings module *settings_module* and importing the
+    gatherstats management command in a fresh Python interpreter *repeat* times. Return a result
+    as for :py:func:`run` which also lists the modules loaded.
+
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+    env['PYTHONPATH'] = os.pathsep.join(
+        path for path in [_PROJECT_DIR, env.get('PYTHONPATH')] if path)
+
+    timings = []
+    for _ in range(repeat):
+        output = json.loads(subprocess.check_output(
+            [sys.executable, '-c', _STARTUP_SCRIPT], env=env, universal_newlines=True
+        ).splitlines()[-1])
+        timings.append(output['seconds'])
+
+    return {
+        'name': 'startup',
+        'parameters': {'settings': settings_module},
+        'timings': timings,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'modules': output['modules'],
+    }
+
+
+def environment():
+    """Return a dictionary describing the environment in which benchmarks are run."""
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'machine': platform.machine(),
+        'run_at': timezone.now().isoformat(),
+    }
+
+
+def compare(baseline, results):
+    """Return a list of benchmark name, parameters, baseline median, median and ratio tuples
+    comparing *results* with the results *baseline* for the same benchmark and parameters. Both
+    are lists as returned by :py:func:`run`. A ratio above 1 means *results* are slower.
+
+    """
+    baseline_medians = {
+        (result['name'], json.dumps(result['parameters'], sort_keys=True)): result['median']
+        for result in baseline
+    }
+    comparisons = []
+    for result in results:
+        key = (result['name'], json.dumps(result['parameters'], sort_keys=True))
+        if key in baseline_medians:
+            comparisons.append((
+                result['name'], result['parameters'], baseline_medians[key], result['median'],
+                result['median'] / baseline_medians[key]))
+    return comparisons
+
+
+def _time(func):
+    """Call *func* and return the elapsed time in seconds."""
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+
+def _result(name, parameters, timings):
+    median = statistics.median(timings)
+    return {
+        'name': name,
+        'parameters': parameters,
+        'timings': timings,
+        'min': min(timings),
+        'median': median,
+        'keys_per_second': parameters['keys'] / median if median > 0 else None,
+    }
+
+
+def _git_commit():
+    """Return the git commit of the working tree or None if it cannot be determined."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
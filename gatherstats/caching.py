@@ -0,0 +1,183 @@
+"""
+A read-through cache of statistic queries which is invalidated exactly when statistics change.
+
+Statistics only change when a response is ingested, or when old statistics are pruned or rollups
+rebuilt, and so the results of queries such as the latest values or the comparison of two
+instants can be cached indefinitely between gathers. Each cache key includes a generation number
+for the endpoint queried, and a global generation number, which are stored in the cache
+themselves. Ingesting a response for an endpoint increments the endpoint's generation once the
+transaction commits and so every cached result for that endpoint becomes unreachable. Pruning
+statistics and rebuilding rollups increment the global generation. Since a result is stored
+under the generation read before it was computed, a result computed while an ingest commits is
+never served afterwards.
+
+The cache is one of the caches configured in Django's ``CACHES`` setting, named by the
+``GATHERSTATS_CACHE`` setting. Caching is disabled if that setting is None, the default. The
+cache must be shared by the processes which serve queries and those which ingest responses so
+that they see the same generations. A file-based cache on a shared directory, or memcached, is
+suitable. A local memory cache is only suitable if both happen in one process.
+
+Numbers of cache hits and misses in this process are counted and returned by :py:func:`counts`.
+
+"""
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+# Sentinel for a value missing from the cache.
+_MISSING = object()
+
+# Counts of hits and misses in this process.
+_counts = collections.Counter()
+_counts_lock = threading.Lock()
+
+# Cache key of the generation number shared by all endpoints.
+_GLOBAL = 'gatherstats:generation'
+
+
+def counts():
+    """Return a dictionary of the numbers of cache "hits" and "misses" in this process."""
+    with _counts_lock:
+        return {'hits': _counts['hits'], 'misses': _counts['misses']}
+
+
+def reset_counts():
+    """Reset the numbers of cache hits and misses to zero."""
+    with _counts_lock:
+        _counts.clear()
+
+
+def get_or_compute(endpoint, name, parameters, compute):
+    """Return the result of the query named *name* of the endpoint with URL *endpoint* with the
+    JSON-serialisable *parameters*. If it is not in the cache, it is computed by calling
+    *compute*, which takes no arguments, and stored. If caching is disabled, *compute* is always
+    called.
+
+    """
+    cache = _cache()
+    if cache is None:
+        return compute()
+
+    key = _key(cache, endpoint, name, parameters)
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        _count('hits')
+        return value
+
+    _count('misses')
+    value = compute()
+    cache.set(key, value, settings.GATHERSTATS_CACHE_TIMEOUT)
+    return value
+
+
+def iterate_or_compute(endpoint, name, parameters, rows):
+    """A generator which yields the rows of the query named *name* of the endpoint with URL
+    *endpoint* with the JSON-serialisable *parameters*. If they are not in the cache, they are
+    read from the iterable returned by calling *rows*, which takes no arguments, and yielded as
+    they are read. They are stored once all have been read unless there are more than
+    ``GATHERSTATS_CACHE_MAX_ROWS`` of them.
+
+    """
+    cache = _cache()
+    if cache is None:
+        yield from rows()
+        return
+
+    key = _key(cache, endpoint, name, parameters)
+    cached_rows = cache.get(key, _MISSING)
+    if cached_rows is not _MISSING:
+        _count('hits')
+        yield from cached_rows
+        return
+
+    _count('misses')
+    collected = []
+    for row in rows():
+        if collected is not None:
+            collected.append(row)
+            if len(collected) > settings.GATHERSTATS_CACHE_MAX_ROWS:
+                collected = None
+        yield row
+    if collected is not None:
+        cache.set(key, collected, settings.GATHERSTATS_CACHE_TIMEOUT)
+
+
+def invalidate(endpoint=None):
+    """Invalidate the cached results for the endpoint with URL *endpoint* or, if it is None, for
+    all endpoints.
+
+    """
+    cache = _cache()
+    if cache is None:
+        return
+    key = _generation_key(endpoint) if endpoint is not None else _GLOBAL
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The generation has been evicted and so any results cached with it are unreachable.
+        cache.set(key, _initial_generation(), None)
+
+
+def invalidate_on_commit(endpoint=None, using=DEFAULT_DB_ALIAS):
+    """As :py:func:`invalidate` but once the current transaction on the database *using*
+    commits.
+
+    """
+    if _cache() is not None:
+        transaction.on_commit(lambda: invalidate(endpoint), using=using)
+
+
+def _cache():
+    alias = settings.GATHERSTATS_CACHE
+    return caches[alias] if alias is not None else None
+
+
+def _count(name):
+    with _counts_lock:
+        _counts[name] += 1
+
+
+def _key(cache, endpoint, name, parameters):
+    """Return the cache key of the query named *name* of *endpoint* with *parameters* at the
+    current generations.
+
+    """
+    generations = cache.get_many([_GLOBAL, _generation_key(endpoint)])
+    global_generation = generations.get(_GLOBAL)
+    if global_generation is None:
+        global_generation = _start_generation(cache, _GLOBAL)
+    endpoint_generation = generations.get(_generation_key(endpoint))
+    if endpoint_generation is None:
+        endpoint_generation = _start_generation(cache, _generation_key(endpoint))
+
+    digest = hashlib.sha256(json.dumps(
+        [endpoint, parameters], sort_keys=True, default=str).encode('utf8')).hexdigest()
+    return 'gatherstats:{}:{}:{}:{}'.format(
+        name, global_generation, endpoint_generation, digest[:32])
+
+
+def _generation_key(endpoint):
+    # Endpoint URLs may contain characters which are not valid in memcached keys.
+    return 'gatherstats:generation:{}'.format(
+        hashlib.sha256(endpoint.encode('utf8')).hexdigest()[:32])
+
+
+def _start_generation(cache, key):
+    """Store an initial generation under *key* unless another process has done so first and
+    return the stored generation.
+
+    """
+    cache.add(key, _initial_generation(), None)
+    return cache.get(key)
+
+
+def _initial_generation():
+    # Generations start from the current time so that a generation which was evicted does not
+    # repeat an earlier value.
+    return int(time.time() * 1000000)
@@ -0,0 +1,172 @@
+"""
+Comparing the statistics from one endpoint at two instants.
+
+:py:func:`compare`, also available as
+:py:meth:`Statistic.objects.compare <gatherstats.models.StatisticManager.compare>`, returns the
+absolute and relative change in the value of each selected key between two instants, such as how
+each institution's completed count changed over a week::
+
+    Statistic.objects.compare(
+        'https://iar-backend.invalid/stats', last_week, now,
+        patterns=['asset_counts.by_institution.*.completed'])
+
+The value of a key at an instant is its value in the latest snapshot fetched at or before that
+instant, carrying values forward over snapshots which only recorded changed values.
+
+All of the values are read by a single query. A window function ranks the statistics of each key
+fetched up to each instant and only the latest from each side of the earlier instant is returned.
+The statistics read are bounded below by the latest snapshot at or before the earlier instant
+which recorded every value. On SQLite versions without window functions, the values at each
+instant are read by a separate query instead.
+
+"""
+import collections
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import OuterRef, Subquery
+
+from gatherstats.models import Snapshot, Statistic, StatisticKey
+
+#: The change in the value of the key with path *key*. The *before* and *after* values are None
+#: if the key had no value at that instant. The *change* is *after* minus *before* and the
+#: *relative_change* is the change as a fraction of *before*. Either is None if it cannot be
+#: computed.
+KeyChange = collections.namedtuple('KeyChange', 'key before after change relative_change')
+
+
+def compare(endpoint, before, after, patterns=(), prefixes=(), using=DEFAULT_DB_ALIAS):
+    """Return a list of :py:data:`KeyChange` tuples, in order of key path, comparing the
+    values of each key from the endpoint with URL *endpoint* at the datetime *before* with those
+    at the datetime *after*. If *patterns* or *prefixes* are given, only keys matching one of the
+    glob patterns or starting with one of the prefixes are compared. See
+    :py:meth:`StatisticKeyManager.matching <gatherstats.models.StatisticKeyManager.matching>`.
+
+    """
+    if before > after:
+        raise ValueError('before must not be later than after')
+
+    statistics = Statistic.objects.using(using).filter(
+        endpoint__url=endpoint, fetched_at__lte=after)
+    if len(patterns) + len(prefixes) > 0:
+        statistics = statistics.filter(
+            key__in=StatisticKey.objects.db_manager(using).matching(patterns, prefixes))
+
+    # Values older than the latest full snapshot at or before the earlier instant are superseded.
+    lower_bound = (
+        Snapshot.objects.using(using)
+        .filter(endpoint__url=endpoint, fetched_at__lte=before, unchanged=False, delta=False)
+        .order_by('-fetched_at').values_list('fetched_at', flat=True).first()
+    )
+    if lower_bound is not None:
+        statistics = statistics.filter(fetched_at__gte=lower_bound)
+
+    if _supports_window_functions(connections[using]):
+        values = _latest_values(statistics, before, using)
+    else:
+        values = _latest_values_without_window(statistics, before, using)
+
+    changes = []
+    for key, (before_value, after_value) in sorted(values.items()):
+        change, relative_change = None, None
+        if before_value is not None and after_value is not None:
+            change = after_value - before_value
+            if before_value != 0:
+                relative_change = change / before_value
+        changes.append(KeyChange(key, before_value, after_value, change, relative_change))
+    return changes
+
+
+def compare_with_previous(snapshot, patterns=(), prefixes=(), using=DEFAULT_DB_ALIAS):
+    """As :py:func:`compare` but compare the values as of the :py:class:`Snapshot` *snapshot*
+    with those as of the snapshot of the same endpoint fetched before it. If there is no earlier
+    snapshot, every key's *before* value is None.
+
+    """
+    previous_fetched_at = (
+        Snapshot.objects.using(using)
+        .filter(endpoint_id=snapshot.endpoint_id, fetched_at__lt=snapshot.fetched_at)
+        .order_by('-fetched_at').values_list('fetched_at', flat=True).first()
+    )
+    if previous_fetched_at is None:
+        # No statistic can have been fetched before the first snapshot.
+        previous_fetched_at = snapshot.fetched_at - snapshot.fetched_at.resolution
+    return compare(
+        snapshot.endpoint.url, previous_fetched_at, snapshot.fetched_at, patterns, prefixes,
+        using)
+
+
+def _latest_values(statistics, before, using):
+    """Return a dictionary mapping key path to the values at *before* and at the latest time
+    included in the queryset *statistics*, read using a window function.
+
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    inner_sql, params = (
+        statistics.order_by().values('key_id', 'fetched_at', 'numeric_value')
+        .query.sql_with_params())
+    before_param = (
+        Statistic._meta.get_field('fetched_at').get_db_prep_value(before, connection))
+
+    # The statistics of each key fetched at or before *before* are ranked separately from those
+    # fetched after it.
+    is_before = 'CASE WHEN s.{fetched_at} <= %s THEN 1 ELSE 0 END'
+    sql = (
+        'SELECT k.{path}, r.{is_before}, r.{value} FROM ('
+        'SELECT s.{key_id}, s.{value}, ' + is_before + ' AS {is_before}, '
+        'ROW_NUMBER() OVER (PARTITION BY s.{key_id}, ' + is_before + ' '
+        'ORDER BY s.{fetched_at} DESC) AS {recency} '
+        'FROM ({inner}) s'
+        ') r JOIN {key_table} k ON k.{pk} = r.{key_id} WHERE r.{recency} = 1'
+    ).format(
+        path=qn('path'), is_before=qn('is_before'), value=qn('numeric_value'),
+        key_id=qn('key_id'), fetched_at=qn('fetched_at'), recency=qn('recency'),
+        inner=inner_sql, key_table=qn(StatisticKey._meta.db_table),
+        pk=qn(StatisticKey._meta.pk.column))
+
+    values = {}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [before_param, before_param] + list(params))
+        for path, is_before, value in cursor.fetchall():
+            before_value, after_value = values.get(path, (None, None))
+            if is_before:
+                before_value = value
+            else:
+                after_value = value
+            values[path] = (before_value, after_value)
+
+    # A key not fetched after *before* still has the value it had then.
+    return {
+        path: (before_value, after_value if after_value is not None else before_value)
+        for path, (before_value, after_value) in values.items()
+    }
+
+
+def _supports_window_functions(connection):
+    """Return True if *connection* supports the window function used by :py:func:`compare`.
+    Django only enables window expressions for PostgreSQL but SQLite has supported them since
+    version 3.25.
+
+    """
+    if connection.features.supports_over_clause:
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 25, 0)
+    return False
+
+
+def _latest_values_without_window(statistics, before, using):
+    """As :py:func:`_latest_values` but read the values at each instant with a separate query.
+
+    """
+    def latest(qs):
+        latest_ids = (
+            qs.filter(key_id=OuterRef('key_id')).order_by('-fetched_at').values('pk')[:1])
+        return dict(
+            qs.filter(pk=Subquery(latest_ids)).values_list('key__path', 'numeric_value'))
+
+    before_values = latest(statistics.filter(fetched_at__lte=before))
+    after_values = latest(statistics)
+    return {
+        path: (before_values.get(path), after_values[path]) for path in after_values
+    }
@@ -6,3 +6,94 @@ Default settings values for the :py:mod:`gatherstats` application.
 # used as default settings for the assets application. See .apps.Config how this is achieved. This
 # is a bit mucky but, at the moment, Django does not have a standard way to specify default values
 # for settings.  See: https://stackoverflow.com/questions/8428556/
+
+#: Number of rows written per multi-row INSERT statement (or per ``COPY`` chunk on PostgreSQL)
+#: when ingesting a stats response.
+GATHERSTATS_INGEST_BATCH_SIZE = 500
+
+#: If True, and the database backend is PostgreSQL accessed via psycopg2, statistics are ingested
+#: using ``COPY ... FROM STDIN`` rather than multi-row INSERT statements.
+GATHERSTATS_INGEST_USE_COPY = True
+
+#: What happens when a response is ingested for an endpoint which already has a snapshot at the
+#: same fetch time: "error", "skip" or "overwrite". See
+#: :py:meth:`~gatherstats.models.StatisticManager.create_from_stats_response`.
+GATHERSTATS_INGEST_ON_CONFLICT = 'error'
+
+#: Default maximum number of endpoints fetched concurrently by the gatherstats management command.
+GATHERSTATS_FETCH_WORKERS = 4
+
+#: Default number of threads flattening fetched responses in the gatherstats management command
+#: while others are fetched and written. See :py:mod:`gatherstats.pipeline`.
+GATHERSTATS_FLATTEN_WORKERS = 1
+
+#: Maximum number of responses waiting to be flattened, and waiting to be written, in the
+#: gatherstats management command. Fetching pauses while these are full.
+GATHERSTATS_PIPELINE_QUEUE_SIZE = 4
+
+#: Identifier of the PostgreSQL advisory lock which a gatherstats scheduler must hold in order to
+#: gather. Schedulers sharing a database but gathering different endpoints should use different
+#: identifiers.
+GATHERSTATS_ADVISORY_LOCK_ID = 0x67617468
+
+#: If True, a statistic is only recorded when its value differs from the value last recorded for
+#: the same endpoint and key. See
+#: :py:meth:`~gatherstats.models.StatisticManager.create_from_stats_response`.
+GATHERSTATS_DELTA_STORAGE = False
+
+#: Lengths of the periods for which :py:class:`~gatherstats.models.StatisticRollup` rows are
+#: maintained as statistics are created and computed by the compactstats management command.
+#: Set to an empty sequence to disable rollups.
+GATHERSTATS_ROLLUP_PERIODS = ('hour', 'day')
+
+#: Length of each partition of a partitioned statistic table: "month" or "day". See
+#: :py:mod:`gatherstats.partitions`.
+GATHERSTATS_PARTITION_INTERVAL = 'month'
+
+#: Number of partitions after the current one which the partitionstats management command
+#: ensures exist.
+GATHERSTATS_PARTITIONS_AHEAD = 3
+
+#: If True, the gatherstats management command fetches endpoints conditionally and, if a response
+#: is the same as the previous one, records an unchanged snapshot rather than any statistics.
+GATHERSTATS_SKIP_UNCHANGED = True
+
+#: Default maximum number of files written to the database concurrently by the backfillstats
+#: management command. A single writer is always used with SQLite or with delta storage.
+GATHERSTATS_BACKFILL_WRITERS = 2
+
+#: If not None, the path of a file to which the gatherstats management command writes the metrics
+#: of each gather in the Prometheus text format, e.g. for node-exporter's textfile collector. See
+#: :py:mod:`gatherstats.metrics`.
+GATHERSTATS_METRICS_TEXTFILE = None
+
+#: If True, the read API is available to anyone. Otherwise only logged in users may use it. See
+#: :py:mod:`gatherstats.views`.
+GATHERSTATS_API_PUBLIC = False
+
+#: If not None, the name of a permission, such as ``"gatherstats.view_statistic"``, which logged in
+#: users must have to use the read API.
+GATHERSTATS_API_PERMISSION = None
+
+#: If True, the metrics view is enabled. Otherwise it returns 404 Not Found.
+GATHERSTATS_METRICS_VIEW = False
+
+#: If True, the metrics view is available to anyone, such as a Prometheus server. Otherwise it is
+#: only available to logged in users as for the rest of the read API.
+GATHERSTATS_METRICS_PUBLIC = False
+
+#: If not None, the directory of a spool to which the gatherstats management command appends
+#: fetched responses before writing them to the database. See :py:mod:`gatherstats.spool`.
+GATHERSTATS_SPOOL_DIR = None
+
+#: If not None, the name of the cache in Django's ``CACHES`` setting used to cache the results of
+#: statistic queries. The cache must be shared with the processes which ingest responses. See
+#: :py:mod:`gatherstats.caching`.
+GATHERSTATS_CACHE = None
+
+#: Number of seconds for which cached query results are kept. Results are invalidated when
+#: statistics change and so this only bounds the memory used by results which are not re-read.
+GATHERSTATS_CACHE_TIMEOUT = 24 * 60 * 60
+
+#: Maximum number of rows in a cached time series. Longer series are not cached.
+GATHERSTATS_CACHE_MAX_ROWS = 100000
@@ -0,0 +1,231 @@
+"""
+Streaming export of statistics in constant memory.
+
+Statistics are selected by endpoint, key and fetch time with :py:func:`select` and written by
+one of the writers in :py:data:`FORMATS`. Statistics are read in chunks using a server-side
+cursor where the database supports one and are written as they are read so that memory usage
+does not grow with the number of statistics exported. Endpoint URLs and key paths are read once
+up front rather than joined to every statistic.
+
+Statistics are exported in order of endpoint, key and fetch time, which is the order of the
+endpoint/key/fetched_at index and so needs no sort. For endpoints gathered with delta storage,
+only the recorded changes are exported.
+
+The following formats are supported:
+
+``csv``
+    Comma-separated values with a header row and the columns "endpoint", "key", "fetched_at"
+    and "value". Fetch times are ISO 8601.
+
+``ndjson``
+    One JSON object per line with the same members as the CSV columns.
+
+``columnar``
+    A compact binary format. The file starts with the eight bytes ``b'GSTATS1\\n'`` followed by
+    a little-endian unsigned 32-bit length and that many bytes of UTF-8 JSON header. The header
+    is an object with an "endpoints" member listing endpoint URLs and a "keys" member listing key
+    paths. The header is followed by blocks of statistics. Each block starts with a
+    little-endian unsigned 32-bit row count, *n*, followed by four arrays of *n* little-endian
+    values: unsigned 32-bit endpoint indexes into the "endpoints" list, unsigned 32-bit key
+    indexes into the "keys" list, signed 64-bit fetch times in microseconds since the Unix epoch
+    and 64-bit IEEE floating point values. The file ends with a block with a row count of zero.
+    :py:func:`read_columnar` reads the format.
+
+"""
+import array
+import collections
+import csv
+import datetime
+import io
+import json
+import struct
+import sys
+
+from gatherstats.models import Endpoint, Statistic, StatisticKey
+
+#: Number of statistics read from the database and written at a time.
+CHUNK_SIZE = 10000
+
+#: Magic bytes at the start of a columnar file.
+COLUMNAR_MAGIC = b'GSTATS1\n'
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+_UINT32 = struct.Struct('<I')
+
+#: Statistics selected for export. The endpoints and keys members are ordered dictionaries
+#: mapping primary key to endpoint URL and to key path. The statistics member is a queryset of
+#: endpoint id, key id, fetched_at, value tuples.
+Selection = collections.namedtuple('Selection', 'endpoints keys statistics')
+
+
+def select(endpoints=None, patterns=(), prefixes=(), since=None, before=None):
+    """Return a :py:data:`Selection` of the statistics from the endpoints with URLs in
+    *endpoints*, or all endpoints if None, whose keys match the glob patterns *patterns* or
+    start with *prefixes*, or all keys if neither is given, which were fetched at or after the
+    datetime *since* and before the datetime *before* if not None.
+
+    """
+    endpoint_qs = Endpoint.objects.all()
+    if endpoints is not None:
+        endpoint_qs = endpoint_qs.filter(url__in=endpoints)
+    key_qs = StatisticKey.objects.all()
+    if len(patterns) + len(prefixes) > 0:
+        key_qs = StatisticKey.objects.matching(patterns, prefixes)
+
+    statistics = Statistic.objects.all()
+    if endpoints is not None:
+        statistics = statistics.filter(endpoint__in=endpoint_qs)
+    if len(patterns) + len(prefixes) > 0:
+        statistics = statistics.filter(key__in=key_qs)
+    if since is not None:
+        statistics = statistics.filter(fetched_at__gte=since)
+    if before is not None:
+        statistics = statistics.filter(fetched_at__lt=before)
+
+    return Selection(
+        endpoints=collections.OrderedDict(endpoint_qs.order_by('pk').values_list('pk', 'url')),
+        keys=collections.OrderedDict(key_qs.order_by('pk').values_list('pk', 'path')),
+        statistics=(
+            statistics.order_by('endpoint_id', 'key_id', 'fetched_at')
+            .values_list('endpoint_id', 'key_id', 'fetched_at', 'numeric_value')
+        ),
+    )
+
+
+def write_csv(fobj, selection):
+    """Write the statistics in the :py:data:`Selection` *selection* as CSV to the text file-like
+    object *fobj*. Return the number of statistics written.
+
+    """
+    def format_chunk(rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(
+            (selection.endpoints[endpoint_id], selection.keys[key_id], fetched_at.isoformat(),
+             value)
+            for endpoint_id, key_id, fetched_at, value in rows
+        )
+        return buffer.getvalue()
+
+    header = io.StringIO()
+    csv.writer(header).writerow(['endpoint', 'key', 'fetched_at', 'value'])
+    fobj.write(header.getvalue())
+    return _write_chunks(fobj, selection, format_chunk)
+
+
+def write_ndjson(fobj, selection):
+    """Write the statistics in the :py:data:`Selection` *selection* as newline-delimited JSON to
+    the text file-like object *fobj*. Return the number of statistics written.
+
+    """
+    encoder = json.JSONEncoder()
+
+    def format_chunk(rows):
+        return ''.join(
+            encoder.encode({
+                'endpoint': selection.endpoints[endpoint_id], 'key': selection.keys[key_id],
+                'fetched_at': fetched_at.isoformat(), 'value': value,
+            }) + '\n'
+            for endpoint_id, key_id, fetched_at, value in rows
+        )
+
+    return _write_chunks(fobj, selection, format_chunk)
+
+
+def write_columnar(fobj, selection):
+    """Write the statistics in the :py:data:`Selection` *selection* in the columnar format to the
+    binary file-like object *fobj*. Return the number of statistics written.
+
+    """
+    endpoint_indexes = {pk: index for index, pk in enumerate(selection.endpoints)}
+    key_indexes = {pk: index for index, pk in enumerate(selection.keys)}
+
+    header = json.dumps({
+        'endpoints': list(selection.endpoints.values()), 'keys': list(selection.keys.values()),
+    }).encode('utf8')
+    fobj.write(COLUMNAR_MAGIC + _UINT32.pack(len(header)) + header)
+
+    def format_chunk(rows):
+        columns = (array.array('I'), array.array('I'), array.array('q'), array.array('d'))
+        for endpoint_id, key_id, fetched_at, value in rows:
+            columns[0].append(endpoint_indexes[endpoint_id])
+            columns[1].append(key_indexes[key_id])
+            columns[2].append((fetched_at - _EPOCH) // _MICROSECOND)
+            columns[3].append(value)
+        return _UINT32.pack(len(rows)) + b''.join(_little_endian(column) for column in columns)
+
+    count = _write_chunks(fobj, selection, format_chunk)
+    fobj.write(_UINT32.pack(0))
+    return count
+
+
+def read_columnar(fobj):
+    """A generator which reads a file in the columnar format from the binary file-like object
+    *fobj* and yields endpoint URL, key path, fetched_at, value tuples. Raises
+    :py:exc:`ValueError` if the file is not in the columnar format.
+
+    """
+    if fobj.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError('not a columnar statistics file')
+    header = json.loads(fobj.read(_read_uint32(fobj)).decode('utf8'))
+    endpoints, keys = header['endpoints'], header['keys']
+
+    while True:
+        count = _read_uint32(fobj)
+        if count == 0:
+            return
+        columns = []
+        for typecode in 'IIqd':
+            column = array.array(typecode)
+            column.frombytes(fobj.read(count * column.itemsize))
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+        for endpoint_index, key_index, timestamp, value in zip(*columns):
+            yield (
+                endpoints[endpoint_index], keys[key_index],
+                _EPOCH + timestamp * _MICROSECOND, value)
+
+
+#: Supported export formats. Maps name to a writer function, binary pair. The writer is passed a
+#: binary file-like object if binary is True and a text one otherwise.
+FORMATS = collections.OrderedDict([
+    ('csv', (write_csv, False)),
+    ('ndjson', (write_ndjson, False)),
+    ('columnar', (write_columnar, True)),
+])
+
+
+def _write_chunks(fobj, selection, format_chunk):
+    """Read statistics from *selection* in chunks of :py:data:`CHUNK_SIZE` rows and write the
+    result of passing each chunk to *format_chunk* to *fobj*. Return the number of rows.
+
+    """
+    count, chunk = 0, []
+    for row in selection.statistics.iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            fobj.write(format_chunk(chunk))
+            count += len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        fobj.write(format_chunk(chunk))
+        count += len(chunk)
+    return count
+
+
+def _little_endian(column):
+    """Return the bytes of the array *column* in little-endian order."""
+    if sys.byteorder != 'little':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _read_uint32(fobj):
+    data = fobj.read(_UINT32.size)
+    if len(data) != _UINT32.size:
+        raise ValueError('truncated columnar statistics file')
+    value, = _UINT32.unpack(data)
+    return value
@@ -0,0 +1,51 @@
+"""
+Database locks used to co-ordinate multiple gatherstats processes sharing a database.
+
+"""
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class AdvisoryLock:
+    """
+    A session-level PostgreSQL advisory lock identified by the integer *lock_id*. Once acquired,
+    the lock is held until it is released or the database connection is closed.
+
+    Other database backends have no equivalent and so, for them, the lock can always be
+    acquired.
+
+    """
+    def __init__(self, lock_id, using=DEFAULT_DB_ALIAS):
+        self.lock_id = lock_id
+        self.using = using
+
+        # The DB-API connection on which the lock was acquired.
+        self._held_on = None
+
+    def try_acquire(self):
+        """Try to acquire the lock without waiting. Return True if the lock is held by this
+        process. If the lock was previously acquired but the database connection has since been
+        replaced, an attempt is made to re-acquire it.
+
+        """
+        connection = connections[self.using]
+        if connection.vendor != 'postgresql':
+            return True
+
+        connection.ensure_connection()
+        if self._held_on is not None and self._held_on is connection.connection:
+            return True
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', [self.lock_id])
+            acquired, = cursor.fetchone()
+
+        self._held_on = connection.connection if acquired else None
+        return acquired
+
+    def release(self):
+        """Release the lock if it is held."""
+        connection = connections[self.using]
+        if self._held_on is not None and self._held_on is connection.connection:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [self.lock_id])
+        self._held_on = None
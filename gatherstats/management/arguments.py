@@ -0,0 +1,44 @@
+"""
+Argument types shared by the gatherstats management commands.
+
+"""
+import argparse
+import datetime
+import re
+
+from django.utils import dateparse, timezone
+
+
+def interval(value):
+    """Parse an interval such as "90", "30s", "5m", "1h" or "7d" and return the number of
+    seconds.
+
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([smhd]?)\s*$', value)
+    if match is None:
+        raise argparse.ArgumentTypeError('invalid interval: {!r}'.format(value))
+    number, unit = match.groups()
+    seconds = float(number) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[unit]
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError('interval must be positive: {!r}'.format(value))
+    return seconds
+
+
+def date_time(value):
+    """Parse an ISO 8601 date or date and time and return an aware datetime. Dates and times
+    without a time zone are taken to be in the current time zone.
+
+    """
+    try:
+        parsed = dateparse.parse_datetime(value)
+        if parsed is None:
+            date = dateparse.parse_date(value)
+            if date is not None:
+                parsed = datetime.datetime.combine(date, datetime.time())
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise argparse.ArgumentTypeError('invalid date or time: {!r}'.format(value))
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
@@ -0,0 +1,311 @@
+"""
+backfillstats
+-------------
+
+Load an archive of previously fetched stats endpoint responses, one JSON file per response, into
+the DB as if each had been gathered at the time it was originally fetched.
+
+Files are given as directories, which are searched recursively for files ending in ``.json``, or
+as glob patterns. The fetch time of each file is taken from one of:
+
+``name``
+    A date and time in the file name, e.g. ``stats-2018-01-02T03:04:05.json`` or
+    ``20180102_030405.json``. The default. A different regular expression may be given with the
+    ``--name-pattern`` option. It must have named groups "year", "month" and "day" and may have
+    named groups "hour", "minute" and "second".
+
+``mtime``
+    The file's modification time.
+
+``field``
+    A field of the response body named by the ``--field`` option, given as a key path such as
+    ``meta.generated_at``. The value may be an ISO 8601 date and time or a number of seconds
+    since the epoch. The field is not recorded as a statistic.
+
+Dates and times without a time zone are taken to be in the current time zone.
+
+Files are parsed and flattened by a pool of ``--workers`` processes. Statistics are written by
+``--writers`` threads, each with its own database connection and each writing one file per
+transaction using batched inserts. Only a bounded number of parsed files are held in memory
+waiting to be written. SQLite only allows one writer at a time and so a single writer is always
+used with it. Delta storage needs each file to be written after the file fetched before it and so
+a single writer is also used when the ``GATHERSTATS_DELTA_STORAGE`` setting is True. Files are
+written in order of fetch time where possible.
+
+Backfilling is restartable. By default, a file is skipped if a snapshot already exists for the
+endpoint at the file's fetch time and so an interrupted backfill can be re-run with the same
+arguments. Files are written with the "skip" conflict policy and so overlapping backfills do not
+fail either. With ``--on-conflict overwrite``, files are re-read and any values which differ from
+those recorded replace them. With ``--on-conflict error``, files already ingested fail. See
+:py:meth:`~gatherstats.models.StatisticManager.create_from_stats_response`.
+
+"""
+import concurrent.futures
+import datetime
+import glob
+import json
+import os
+import queue
+import re
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import dateparse, timezone
+
+from gatherstats.models import (
+    CONFLICT_POLICIES, ON_CONFLICT_SKIP, Snapshot, Statistic, _body_hash, _flatten_dict)
+
+#: Default regular expression matching the fetch time in a file name.
+DEFAULT_NAME_PATTERN = (
+    r'(?P<year>\d{4})-?(?P<month>\d{2})-?(?P<day>\d{2})'
+    r'(?:[T_ -]?(?P<hour>\d{2})[:-]?(?P<minute>\d{2})(?:[:-]?(?P<second>\d{2}))?)?'
+)
+
+#: Sources of the fetch time of a file.
+FETCHED_AT_SOURCES = ('name', 'mtime', 'field')
+
+
+class Command(BaseCommand):
+    """Implementation of backfillstats management command."""
+
+    help = 'Load an archive of stats endpoint responses fetched in the past'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', metavar='DIRECTORY_OR_GLOB', type=str, nargs='+',
+            help='Directory containing or glob pattern matching stats response JSON files')
+        parser.add_argument(
+            '--endpoint', metavar='URL', type=str, required=True,
+            help='URL of the endpoint from which the responses were fetched')
+        parser.add_argument(
+            '--fetched-at', choices=FETCHED_AT_SOURCES, default='name',
+            help='Where to find the time at which each response was fetched. Default: name')
+        parser.add_argument(
+            '--name-pattern', metavar='REGEX', type=str, default=DEFAULT_NAME_PATTERN,
+            help='Regular expression matching the fetch time in each file name')
+        parser.add_argument(
+            '--field', metavar='KEY_PATH', type=str,
+            help='Key path of the response field holding the fetch time')
+        parser.add_argument(
+            '--workers', metavar='N', type=int, default=None,
+            help='Number of processes parsing files. Default: the number of CPUs')
+        parser.add_argument(
+            '--writers', metavar='N', type=int, default=None,
+            help='Maximum number of files written to the database concurrently')
+        parser.add_argument(
+            '--on-conflict', choices=CONFLICT_POLICIES, default=ON_CONFLICT_SKIP,
+            help='What to do with files which have already been ingested. Default: skip')
+
+    def handle(self, *args, **options):
+        source = options['fetched_at']
+        if source == 'field' and not options['field']:
+            raise CommandError('--field must be given with --fetched-at field')
+        try:
+            name_pattern = re.compile(options['name_pattern'])
+        except re.error as e:
+            raise CommandError('Invalid --name-pattern: {}'.format(e))
+
+        workers = options['workers'] if options['workers'] is not None else os.cpu_count()
+        writers = (
+            options['writers'] if options['writers'] is not None
+            else settings.GATHERSTATS_BACKFILL_WRITERS
+        )
+        if workers < 1 or writers < 1:
+            raise CommandError('--workers and --writers must be at least 1')
+        if connection.vendor == 'sqlite' or settings.GATHERSTATS_DELTA_STORAGE:
+            writers = 1
+
+        paths = _find_files(options['paths'])
+        if len(paths) == 0:
+            raise CommandError('No files found')
+
+        self._endpoint = options['endpoint']
+        self._on_conflict = options['on_conflict']
+        self._lock = threading.Lock()
+        self._ingested = set()
+        if self._on_conflict == ON_CONFLICT_SKIP:
+            self._ingested.update(
+                Snapshot.objects.filter(endpoint__url=self._endpoint)
+                .values_list('fetched_at', flat=True))
+        self._file_count, self._created_count, self._skipped_count = 0, 0, 0
+        self._failures = 0
+
+        # Fetch times known from the file name or modification time are used to skip files before
+        # parsing them and to order the writes.
+        if source != 'field':
+            files = []
+            for path in paths:
+                try:
+                    fetched_at = _fetched_at_from_file(path, source, name_pattern)
+                except ValueError as e:
+                    self._fail(path, e)
+                    continue
+                if fetched_at in self._ingested:
+                    self._skipped_count += 1
+                    continue
+                files.append((fetched_at, path))
+            files.sort()
+        else:
+            files = [(None, path) for path in paths]
+
+        if writers == 1:
+            self._load_all(files, workers, options['field'], self._write)
+        else:
+            self._load_all_concurrently(files, workers, writers, options['field'])
+
+        print(
+            'Created {} object(s) from {} file(s); skipped {} file(s) already ingested'.format(
+                self._created_count, self._file_count, self._skipped_count),
+            file=self.stdout)
+        if self._failures > 0:
+            raise CommandError('{} file(s) failed'.format(self._failures))
+
+    def _load_all(self, files, workers, field, write):
+        """Parse the files listed in *files*, a list of fetch time, path pairs, in a pool of
+        *workers* processes and pass each result of :py:func:`_load` to *write* in the order of
+        *files*. At most a small multiple of *workers* files are parsed ahead of being written.
+
+        """
+        window = 2 * workers
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for index in range(len(files) + window):
+                if index < len(files):
+                    fetched_at, path = files[index]
+                    pending.append((path, executor.submit(_load, path, fetched_at, field)))
+                if len(pending) > window or (index >= len(files) and len(pending) > 0):
+                    path, future = pending.pop(0)
+                    try:
+                        loaded = future.result()
+                    except Exception as e:
+                        self._fail(path, e)
+                    else:
+                        write(loaded)
+
+    def _load_all_concurrently(self, files, workers, writers, field):
+        """As :py:meth:`._load_all` but write files from *writers* threads."""
+        loaded_files = queue.Queue(maxsize=writers)
+
+        def writer():
+            try:
+                while True:
+                    loaded = loaded_files.get()
+                    if loaded is None:
+                        return
+                    self._write(loaded)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        try:
+            self._load_all(files, workers, field, loaded_files.put)
+        finally:
+            for _ in threads:
+                loaded_files.put(None)
+            for thread in threads:
+                thread.join()
+
+    def _write(self, loaded):
+        """Create statistics from a result of :py:func:`_load` unless a file with the same fetch
+        time has already been ingested by this command or, with the "skip" conflict policy,
+        before it.
+
+        """
+        path, fetched_at, items, body_hash = loaded
+        with self._lock:
+            if fetched_at in self._ingested:
+                self._skipped_count += 1
+                return
+            # Mark the fetch time as taken so that no other file with the same fetch time is
+            # written concurrently.
+            self._ingested.add(fetched_at)
+
+        try:
+            created_count = Statistic.objects.create_from_items(
+                endpoint=self._endpoint, items=items, fetched_at=fetched_at,
+                return_objects=False, body_hash=body_hash, on_conflict=self._on_conflict)
+        except Exception as e:
+            with self._lock:
+                self._ingested.discard(fetched_at)
+            self._fail(path, e)
+            return
+
+        with self._lock:
+            self._file_count += 1
+            self._created_count += created_count
+
+    def _fail(self, path, error):
+        with self._lock:
+            self._failures += 1
+        print('Failed to backfill {}: {}'.format(path, error), file=self.stderr)
+
+
+def _find_files(patterns):
+    """Return a sorted list of the paths of files in the directories or matching the glob
+    patterns *patterns*.
+
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*.json')
+        paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def _fetched_at_from_file(path, source, name_pattern):
+    """Return the fetch time of the file at *path* from its name, matched by the compiled regular
+    expression *name_pattern*, if *source* is "name" or its modification time if *source* is
+    "mtime". Raises :py:exc:`ValueError` if the name does not contain a date.
+
+    """
+    if source == 'mtime':
+        return datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc)
+
+    match = name_pattern.search(os.path.basename(path))
+    if match is None:
+        raise ValueError('no date and time in file name')
+    parts = match.groupdict()
+    fetched_at = datetime.datetime(*(
+        int(parts.get(name) or 0)
+        for name in ('year', 'month', 'day', 'hour', 'minute', 'second')
+    ))
+    return timezone.make_aware(fetched_at)
+
+
+def _parse_fetched_at(value):
+    """Parse a fetch time from a response field which is either an ISO 8601 date and time or a
+    number of seconds since the epoch. Raises :py:exc:`ValueError` if it is neither.
+
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    parsed = dateparse.parse_datetime(value) if isinstance(value, str) else None
+    if parsed is None:
+        raise ValueError('invalid fetch time: {!r}'.format(value))
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _load(path, fetched_at, field):
+    """Parse and flatten the response in the file at *path*. Run in a worker process. Return a
+    tuple of path, fetch time, list of key path, value pairs and body hash. If *fetched_at* is
+    None, the fetch time is taken from the field with key path *field* which is then omitted from
+    the pairs.
+
+    """
+    with open(path) as fobj:
+        body = json.load(fobj)
+    items = list(_flatten_dict(body))
+    if fetched_at is None:
+        values = dict(items)
+        if field not in values:
+            raise ValueError('no {} field'.format(field))
+        fetched_at = _parse_fetched_at(values[field])
+        items = [(key, value) for key, value in items if key != field]
+    return path, fetched_at, items, _body_hash(body)
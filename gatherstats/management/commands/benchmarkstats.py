@@ -0,0 +1,133 @@
+"""
+benchmarkstats
+--------------
+
+Time the ingest path using synthetic stats endpoint responses and save the results as JSON. See
+:py:mod:`gatherstats.benchmark`.
+
+The benchmarks are run in a test database created for the purpose, named as for the Django test
+runner, which is destroyed afterwards. The default database is not touched. A summary is printed
+and, with the ``--output`` option, the results are written to a file together with the commit,
+Python and Django versions and database backend. With the ``--compare`` option, the results are
+compared with those in a file written by a previous run.
+
+With the ``--queries`` option, the standard read queries are timed instead of the ingest path
+against a dataset of ``--snapshots`` snapshots from each of ``--endpoints`` endpoints. The plan
+of each query and the size of the statistic table and its indexes are included in the results
+and printed if ``--verbosity`` is 2 or more. Use this to measure the effect of an index on reads
+and, by running the ingest benchmarks too, on writes.
+
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from gatherstats import benchmark
+
+
+def _sizes(value):
+    """Parse a comma-separated list of numbers of institutions."""
+    return [int(size) for size in value.split(',')]
+
+
+class Command(BaseCommand):
+    """Implementation of benchmarkstats management command."""
+
+    help = 'Benchmark ingesting synthetic IAR statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--institutions', metavar='N[,N...]', type=_sizes, default=[10, 100],
+            help='Numbers of institutions in the synthetic responses. Default: 10,100')
+        parser.add_argument(
+            '--depth', metavar='N', type=int, default=1,
+            help='Depth of the breakdown of each institution\'s counts. Default: 1')
+        parser.add_argument(
+            '--breadth', metavar='N', type=int, default=4,
+            help='Number of values at each level of breakdown. Default: 4')
+        parser.add_argument(
+            '--counts', metavar='N', type=int, default=4,
+            help='Number of counts at each level. Default: 4')
+        parser.add_argument(
+            '--repeat', metavar='N', type=int, default=5,
+            help='Number of times each benchmark is run. Default: 5')
+        parser.add_argument(
+            '--queries', action='store_true',
+            help='Benchmark the standard read queries rather than ingest')
+        parser.add_argument(
+            '--snapshots', metavar='N', type=int, default=100,
+            help='Number of snapshots from each endpoint queried by --queries. Default: 100')
+        parser.add_argument(
+            '--endpoints', metavar='N', type=int, default=2,
+            help='Number of endpoints queried by --queries. Default: 2')
+        parser.add_argument(
+            '--output', metavar='PATH', type=str,
+            help='Write the results as JSON to PATH')
+        parser.add_argument(
+            '--compare', metavar='PATH', type=str,
+            help='Compare the results with those written by a previous run to PATH')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+        if options['queries'] and (options['snapshots'] < 1 or options['endpoints'] < 1):
+            raise CommandError('--snapshots and --endpoints must be at least 1')
+
+        baseline = None
+        if options['compare'] is not None:
+            with open(options['compare']) as fobj:
+                baseline = json.load(fobj)['results']
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            if options['queries']:
+                results = []
+                for size in options['institutions']:
+                    results.extend(benchmark.queries(
+                        size, options['snapshots'], options['endpoints'], options['depth'],
+                        options['breadth'], options['counts'], options['repeat']))
+            else:
+                results = benchmark.run(
+                    options['institutions'], options['depth'], options['breadth'],
+                    options['counts'], options['repeat'])
+            report = {
+                'environment': benchmark.environment(), 'storage': benchmark.storage(),
+                'results': results,
+            }
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for result in results:
+            if options['queries']:
+                description = 'institutions={institutions} rows={rows}'
+            else:
+                description = 'institutions={institutions} keys={keys}'
+            print(
+                '{name} {description}: median {median:.4f}s, min {min:.4f}s'.format(
+                    name=result['name'], median=result['median'], min=result['min'],
+                    description=description.format(**result['parameters'])),
+                file=self.stdout)
+            if options['verbosity'] >= 2 and 'plan' in result:
+                print(result['plan'], file=self.stdout)
+
+        if options['verbosity'] >= 2:
+            for index in report['storage']['indexes']:
+                print('index {} ({}){}'.format(
+                    index['name'], ', '.join(index['columns']),
+                    ': {} bytes'.format(index['size']) if 'size' in index else ''),
+                    file=self.stdout)
+
+        if baseline is not None:
+            for name, parameters, before, after, ratio in benchmark.compare(baseline, results):
+                print(
+                    '{} institutions={}: {:.4f}s -> {:.4f}s ({:+.1f}%)'.format(
+                        name, parameters['institutions'], before, after, 100 * (ratio - 1)),
+                    file=self.stdout)
+
+        if options['output'] is not None:
+            with open(options['output'], 'w') as fobj:
+                json.dump(report, fobj, indent=2)
@@ -0,0 +1,91 @@
+"""
+compactstats
+------------
+
+Compute hourly and daily rollups of the statistics gathered before a given date and optionally
+delete statistics which are older than a retention period.
+
+Rollups are normally maintained as statistics are gathered and so this command is only needed to
+compute rollups for statistics gathered before rollups were enabled or to re-compute them. Rollups
+are computed one day at a time. Existing rollups are left alone unless the ``--replace`` option
+is given.
+
+With the ``--retention`` option, statistics fetched before the start of the day that far in the
+past are deleted once rollups have been computed, except for the latest statistic for each key
+from each endpoint.
+
+"""
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from gatherstats.management.arguments import date_time, interval
+from gatherstats.models import Statistic, StatisticRollup
+
+
+class Command(BaseCommand):
+    """Implementation of compactstats management command."""
+
+    help = 'Compute rollups of gathered statistics and delete old statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', metavar='DATE', type=date_time,
+            help='Compute rollups for statistics fetched on or after DATE. Default: the earliest')
+        parser.add_argument(
+            '--before', metavar='DATE', type=date_time,
+            help='Compute rollups for statistics fetched before DATE. Default: today')
+        parser.add_argument(
+            '--replace', action='store_true',
+            help='Replace existing rollups rather than leaving them alone')
+        parser.add_argument(
+            '--retention', metavar='INTERVAL', type=interval,
+            help=(
+                'Delete statistics fetched more than INTERVAL ago, e.g. "90d". The latest '
+                'statistic for each key is retained'))
+
+    def handle(self, *args, **options):
+        def day_start(when):
+            return StatisticRollup.period_start_for(StatisticRollup.DAY, when)
+
+        now = timezone.now()
+        before = day_start(options['before'] if options['before'] is not None else now)
+
+        cutoff = None
+        if options['retention'] is not None:
+            if len(settings.GATHERSTATS_ROLLUP_PERIODS) == 0:
+                raise CommandError('--retention may not be used when rollups are disabled')
+            cutoff = day_start(now - datetime.timedelta(seconds=options['retention']))
+            if cutoff > before:
+                raise CommandError(
+                    '--retention would delete statistics fetched after --before which have not '
+                    'been rolled up')
+
+        since = options['since']
+        if since is None:
+            since = (
+                Statistic.objects.filter(fetched_at__lt=before)
+                .aggregate(earliest=Min('fetched_at'))['earliest']
+            )
+        since = day_start(since) if since is not None else before
+
+        rollup_count = 0
+        start = since
+        while start < before:
+            end = start + datetime.timedelta(days=1)
+            rollup_count += StatisticRollup.objects.rebuild(start, end, options['replace'])
+            start = end
+        print(
+            'Computed {} rollup(s) from statistics fetched from {} to {}'.format(
+                rollup_count, since.isoformat(), before.isoformat()),
+            file=self.stdout)
+
+        if cutoff is not None:
+            deleted_count = Statistic.objects.prune(cutoff)
+            print(
+                'Deleted {} statistic(s) fetched before {}'.format(
+                    deleted_count, cutoff.isoformat()),
+                file=self.stdout)
@@ -0,0 +1,69 @@
+"""
+exportstats
+-----------
+
+Export statistics as CSV, newline-delimited JSON or a compact columnar binary format. See
+:py:mod:`gatherstats.export` for the formats.
+
+Statistics may be selected by endpoint, by key path glob pattern or prefix and by fetch time.
+They are streamed from the database and written in constant memory and so exports of tens of
+millions of statistics are possible. Output is written to standard output unless the ``--output``
+option is given. The columnar format can only be written to a file. The number of statistics
+exported is reported on standard error.
+
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from gatherstats import export
+from gatherstats.management.arguments import date_time
+
+
+class Command(BaseCommand):
+    """Implementation of exportstats management command."""
+
+    help = 'Export gathered statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--endpoint', metavar='URL', type=str, action='append', dest='endpoints',
+            help='Export statistics from the endpoint URL. May be repeated. Default: all')
+        parser.add_argument(
+            '--key', metavar='PATTERN', type=str, action='append', dest='patterns', default=[],
+            help='Export keys matching the key path or glob pattern PATTERN. May be repeated')
+        parser.add_argument(
+            '--prefix', metavar='PREFIX', type=str, action='append', dest='prefixes',
+            default=[],
+            help='Export keys whose path starts with PREFIX. May be repeated')
+        parser.add_argument(
+            '--since', metavar='DATE', type=date_time,
+            help='Export statistics fetched on or after DATE')
+        parser.add_argument(
+            '--before', metavar='DATE', type=date_time,
+            help='Export statistics fetched before DATE')
+        parser.add_argument(
+            '--format', choices=list(export.FORMATS), default='csv',
+            help='Output format. Default: csv')
+        parser.add_argument(
+            '--output', metavar='PATH', type=str,
+            help='Write to PATH rather than standard output')
+
+    def handle(self, *args, **options):
+        writer, binary = export.FORMATS[options['format']]
+        if binary and options['output'] is None:
+            raise CommandError('--output must be given for the {} format'.format(
+                options['format']))
+
+        selection = export.select(
+            endpoints=options['endpoints'], patterns=options['patterns'],
+            prefixes=options['prefixes'], since=options['since'], before=options['before'])
+
+        if options['output'] is None:
+            count = writer(self.stdout, selection)
+        elif binary:
+            with open(options['output'], 'wb') as fobj:
+                count = writer(fobj, selection)
+        else:
+            with open(options['output'], 'w', newline='') as fobj:
+                count = writer(fobj, selection)
+
+        print('Exported {} statistic(s)'.format(count), file=self.stderr)
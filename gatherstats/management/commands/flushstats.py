@@ -0,0 +1,68 @@
+"""
+flushstats
+----------
+
+Write the responses in a gatherstats spool to the database. See :py:mod:`gatherstats.spool`.
+
+The spool directory is given by the ``--spool`` option or the ``GATHERSTATS_SPOOL_DIR`` setting.
+If the database is unavailable, the flush is retried up to ``--retries`` times, waiting
+``--retry-delay`` between attempts, and the command fails if responses remain in the spool.
+
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from gatherstats.management.arguments import interval
+from gatherstats.spool import Spool
+
+
+class Command(BaseCommand):
+    """Implementation of flushstats management command."""
+
+    help = 'Write spooled responses to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--spool', metavar='DIRECTORY', type=str,
+            help='Spool directory. Default: the GATHERSTATS_SPOOL_DIR setting')
+        parser.add_argument(
+            '--retries', metavar='N', type=int, default=0,
+            help='Number of times to retry if the database is unavailable. Default: 0')
+        parser.add_argument(
+            '--retry-delay', metavar='INTERVAL', type=interval, default=30,
+            help='Time to wait between retries, e.g. "30s" or "5m". Default: 30s')
+
+    def handle(self, *args, **options):
+        spool_dir = (
+            options['spool'] if options['spool'] is not None else settings.GATHERSTATS_SPOOL_DIR
+        )
+        if spool_dir is None:
+            raise CommandError('--spool must be given if GATHERSTATS_SPOOL_DIR is not set')
+        spool = Spool(spool_dir)
+
+        flushed, failed = 0, 0
+        for attempt in range(options['retries'] + 1):
+            if attempt > 0:
+                time.sleep(options['retry_delay'])
+                # Re-connect on the next query.
+                connections.close_all()
+
+            result = spool.flush()
+            flushed, failed = flushed + result.flushed, failed + result.failed
+            if result.error is None:
+                break
+            print('Database unavailable: {}'.format(result.error), file=self.stderr)
+
+        print(
+            'Flushed {} spooled response(s); {} remain'.format(flushed, result.remaining),
+            file=self.stdout)
+        if failed > 0:
+            print(
+                '{} spooled response(s) could not be written and were moved to {}'.format(
+                    failed, spool.failed_directory),
+                file=self.stderr)
+        if result.remaining > 0:
+            raise CommandError('{} spooled response(s) remain'.format(result.remaining))
@@ -2,65 +2,588 @@
 gatherstats
 -----------
 
-Gather statistics from an IAR endpoint and write records to the DB.
+Gather statistics from one or more IAR endpoints and write records to the DB.
+
+Endpoints may be given on the command line or listed, one per line, in a file passed via the
+``--endpoints-file`` option. Responses are fetched, flattened and written by a
+:py:class:`~gatherstats.pipeline.Pipeline` so that fetching and flattening later responses
+overlaps with writing earlier ones. Responses are fetched concurrently by a bounded pool of
+``--workers`` threads which share one pooled HTTP session and flattened by
+``--flatten-workers`` threads. Statistics are written by a single thread. Only a bounded number
+of responses wait to be flattened or written and so fetching slows to the pace of the database.
+The statistics from each endpoint are written in their own transaction and so a failure
+fetching or recording one endpoint does not affect the others. A per-endpoint summary is printed
+and the command fails if any endpoint failed.
+
+With the ``--stream`` option, the response body is parsed incrementally and statistics are
+written to the database in batches as they are parsed so that memory usage does not grow with the
+size of the response. Streamed endpoints are processed one after another.
+
+Unless the ``GATHERSTATS_SKIP_UNCHANGED`` setting is False, endpoints are fetched conditionally
+using the ETag and Last-Modified headers of the previous response. If the server replies "304 Not
+Modified", or the response body is the same as the previous one, only an unchanged snapshot is
+recorded and no statistics are written.
+
+The time spent fetching, parsing, flattening and writing each endpoint, along with the numbers
+of bytes, keys, statistics and database queries, are logged via the "gatherstats.metrics" logger
+after each gather. If the ``GATHERSTATS_METRICS_TEXTFILE`` setting is set, they are also written
+to that file in the Prometheus text format. See :py:mod:`gatherstats.metrics`.
+
+With the ``--spool`` option, or if the ``GATHERSTATS_SPOOL_DIR`` setting is set, each fetched
+response is first appended to a local on-disk spool together with its fetch time and the spool
+is then flushed to the database. If the database is unavailable, responses stay in the spool until
+a later gather, or the flushstats management command, flushes them. See
+:py:mod:`gatherstats.spool`. Spooling cannot be combined with ``--stream``.
+
+With the ``--every`` option, the command runs as a long-lived scheduler which gathers the
+endpoints at a fixed interval. The process, its database connection and its HTTP session are
+re-used between gathers. Each gather is delayed by a random jitter so that many schedulers
+started together do not all fetch at the same instant. The scheduler stops cleanly, after any
+in-progress gather, on SIGTERM or SIGINT. On PostgreSQL, a scheduler only gathers while it holds
+a database advisory lock and so, if several schedulers are running against one database, only
+one of them ingests at a time and the others stand by.
 
 """
+import collections
+import contextlib
 import json
+import random
+import signal
+import threading
+import time
 from urllib.parse import urlsplit, urlunsplit
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
 from django.utils import timezone
-import requests
 
-from gatherstats.models import Statistic
+from gatherstats import metrics
+from gatherstats.locks import AdvisoryLock
+from gatherstats.management.arguments import interval
+from gatherstats.models import (
+    Endpoint, Snapshot, Statistic, _BodyHasher, _body_hash, _flatten_dict)
+from gatherstats.pipeline import Pipeline
+from gatherstats.spool import Spool
 
 
 class Command(BaseCommand):
     """Implementation of gatherstats management command."""
 
-    help = 'Gather IAR statistics from an API endpoint'
+    help = 'Gather IAR statistics from one or more API endpoints'
 
     def add_arguments(self, parser):
         parser.add_argument(
-            'stats_endpoint', metavar='URL_OR_PATH', type=str,
+            'stats_endpoints', metavar='URL_OR_PATH', type=str, nargs='*',
             help='URL pointing to or file containing an IAR stats resource')
+        parser.add_argument(
+            '--endpoints-file', metavar='PATH', type=str,
+            help=(
+                'File listing URLs or paths of IAR stats resources, one per line. Blank lines '
+                'and lines starting with "#" are ignored'))
         parser.add_argument(
             '--endpoint', metavar='URL', type=str,
-            help='Override the endpoint used to record this statistic in the database')
+            help=(
+                'Override the endpoint used to record this statistic in the database. Only '
+                'valid if a single URL or path is given'))
+        parser.add_argument(
+            '--stream', action='store_true',
+            help='Parse the response incrementally and write statistics as they are parsed')
+        parser.add_argument(
+            '--spool', metavar='DIRECTORY', type=str,
+            help=(
+                'Append fetched responses to a spool in DIRECTORY before writing them to the '
+                'database'))
+        parser.add_argument(
+            '--workers', metavar='N', type=int, default=None,
+            help='Maximum number of endpoints to fetch concurrently')
+        parser.add_argument(
+            '--flatten-workers', metavar='N', type=int, default=None,
+            help='Number of threads flattening fetched responses')
+        parser.add_argument(
+            '--every', metavar='INTERVAL', type=interval,
+            help=(
+                'Run as a scheduler gathering every INTERVAL, e.g. "90", "30s", "5m" or "1h". '
+                'Bare numbers are seconds'))
+        parser.add_argument(
+            '--jitter', metavar='INTERVAL', type=interval,
+            help=(
+                'Maximum random delay added to each scheduled gather. Default: one tenth of the '
+                'interval'))
+        parser.add_argument(
+            '--max-runs', metavar='N', type=int,
+            help='When running as a scheduler, exit after N scheduled gathers')
 
     def handle(self, *args, **options):
-        # Take argument and parse as URL. If the scheme is empty, use file.
-        endpoint_parts = urlsplit(options['stats_endpoint'], scheme='file')
-        endpoint = urlunsplit(endpoint_parts)
-
-        # Allow overriding the endpoint from CLI
-        if options['endpoint'] is not None:
-            endpoint = options['endpoint']
-
-        # Fetch stats and record the time the fetch completed
-        body = (
-            _file_contents(endpoint_parts.path)
-            if endpoint_parts.scheme == 'file' else
-            _url_contents(endpoint)
+        stats_endpoints = list(options['stats_endpoints'])
+        if options['endpoints_file'] is not None:
+            stats_endpoints.extend(_read_endpoints_file(options['endpoints_file']))
+
+        if len(stats_endpoints) == 0:
+            raise CommandError('At least one URL or path must be specified')
+
+        if options['endpoint'] is not None and len(stats_endpoints) > 1:
+            raise CommandError('--endpoint may only be used with a single URL or path')
+
+        workers = (
+            options['workers'] if options['workers'] is not None
+            else settings.GATHERSTATS_FETCH_WORKERS
         )
-        fetched_at = timezone.now()
+        if workers < 1:
+            raise CommandError('--workers must be at least 1')
+
+        flatten_workers = (
+            options['flatten_workers'] if options['flatten_workers'] is not None
+            else settings.GATHERSTATS_FLATTEN_WORKERS
+        )
+        if flatten_workers < 1:
+            raise CommandError('--flatten-workers must be at least 1')
+        self._flatten_workers = flatten_workers
+
+        spool_dir = (
+            options['spool'] if options['spool'] is not None else settings.GATHERSTATS_SPOOL_DIR
+        )
+        if spool_dir is not None and options['stream']:
+            raise CommandError('--stream may not be used with a spool')
+        self._spool = Spool(spool_dir) if spool_dir is not None else None
+
+        sources = []
+        for stats_endpoint in stats_endpoints:
+            # Take argument and parse as URL. If the scheme is empty, use file.
+            endpoint_parts = urlsplit(stats_endpoint, scheme='file')
+            endpoint = urlunsplit(endpoint_parts)
+
+            # Allow overriding the endpoint from CLI
+            if options['endpoint'] is not None:
+                endpoint = options['endpoint']
+
+            sources.append((endpoint_parts, endpoint))
+
+        with contextlib.ExitStack() as stack:
+            # Only start the HTTP stack if there are URLs to fetch.
+            session = None
+            if any(endpoint_parts.scheme != 'file' for endpoint_parts, _ in sources):
+                session = stack.enter_context(_pooled_session(workers))
+
+            if options['every'] is None:
+                failures = self._run(sources, session, workers, options['stream'])
+                if failures > 0:
+                    raise CommandError(
+                        '{} of {} endpoint(s) failed'.format(failures, len(sources)))
+            else:
+                jitter = (
+                    options['jitter'] if options['jitter'] is not None
+                    else options['every'] / 10
+                )
+                self._schedule(
+                    sources, session, workers, options['stream'], options['every'], jitter,
+                    options['max_runs'])
+
+    def _run(self, sources, session, workers, stream):
+        """Gather statistics from each of *sources* once and print a summary. Return the number
+        of endpoints which failed.
+
+        """
+        if stream:
+            results = self._stream_all(sources, session)
+        else:
+            results = self._gather_all(sources, session, workers)
+
+        failures = 0
+        for endpoint, created_count, error, _ in results:
+            if error is None and self._spool is not None:
+                print('Spooled response from {}'.format(endpoint), file=self.stdout)
+            elif error is None:
+                print(
+                    'Created {} object(s) from {}'.format(created_count, endpoint),
+                    file=self.stdout)
+            else:
+                failures += 1
+                print('Failed to gather {}: {}'.format(endpoint, error), file=self.stderr)
+
+        gather_metrics = [result[3] for result in results]
+        metrics.log(gather_metrics)
+        if settings.GATHERSTATS_METRICS_TEXTFILE is not None:
+            try:
+                metrics.write_textfile(settings.GATHERSTATS_METRICS_TEXTFILE, gather_metrics)
+            except OSError as e:
+                print('Failed to write metrics: {}'.format(e), file=self.stderr)
+
+        if self._spool is not None:
+            self._flush_spool()
+
+        return failures
+
+    def _flush_spool(self):
+        """Flush the spool to the database and print a summary."""
+        result = self._spool.flush()
+        print(
+            'Flushed {} spooled response(s); {} remain'.format(result.flushed, result.remaining),
+            file=self.stdout)
+        if result.failed > 0:
+            print(
+                '{} spooled response(s) could not be written and were moved to {}'.format(
+                    result.failed, self._spool.failed_directory),
+                file=self.stderr)
+        if result.error is not None:
+            print('Database unavailable: {}'.format(result.error), file=self.stderr)
+
+    def _schedule(self, sources, session, workers, stream, interval, jitter, max_runs):
+        """Gather statistics from *sources* every *interval* seconds, delaying each gather by a
+        random amount of up to *jitter* seconds, until a SIGTERM or SIGINT is received or
+        *max_runs* gathers have been scheduled.
+
+        """
+        self._stop_requested = threading.Event()
+        previous_handlers = {
+            signum: signal.signal(signum, self._request_stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+
+        lock = AdvisoryLock(settings.GATHERSTATS_ADVISORY_LOCK_ID)
+        try:
+            run_count, was_leader = 0, False
+            next_run_at = time.monotonic()
+            while max_runs is None or run_count < max_runs:
+                delay = next_run_at + random.uniform(0, jitter) - time.monotonic()
+                if self._stop_requested.wait(max(0, delay)):
+                    break
+
+                run_count += 1
+                try:
+                    try:
+                        is_leader = lock.try_acquire()
+                    except DatabaseError:
+                        # With a spool, the scheduler which held the lock keeps gathering while
+                        # the database is unavailable.
+                        if self._spool is None or not was_leader:
+                            raise
+                        is_leader = True
+                    was_leader = is_leader
+
+                    if is_leader:
+                        self._run(sources, session, workers, stream)
+                    else:
+                        print(
+                            'Another scheduler holds the gather lock; not gathering',
+                            file=self.stdout)
+                except Exception as e:
+                    print('Scheduled gather failed: {}'.format(e), file=self.stderr)
+
+                _close_unusable_connections()
+
+                # Skip any runs which were missed because this run overran.
+                now = time.monotonic()
+                next_run_at += interval
+                if next_run_at < now:
+                    next_run_at += interval * ((now - next_run_at) // interval + 1)
+        finally:
+            lock.release()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def _request_stop(self, signum, frame):
+        """Signal handler asking the scheduler to stop once any in-progress gather finishes."""
+        print('Received signal {}, stopping'.format(signum), file=self.stdout)
+        self._stop_requested.set()
+
+    def _gather_all(self, sources, session, workers):
+        """Fetch responses from *sources* concurrently with *workers* threads, flatten them and
+        create statistics from each as it arrives. Return a list of endpoint, created count,
+        error, metrics tuples. The error is None if the endpoint succeeded. The metrics are a
+        :py:class:`~gatherstats.metrics.GatherMetrics` instance.
+
+        """
+        skip_unchanged = settings.GATHERSTATS_SKIP_UNCHANGED
+        validators = {}
+        if skip_unchanged:
+            try:
+                validators = _validators(sources)
+            except DatabaseError:
+                # Responses are spooled unconditionally if the database is unavailable.
+                if self._spool is None:
+                    raise
+                _close_unusable_connections()
+
+        def fetch(task):
+            endpoint_parts, endpoint, gather_metrics = task
+            return _fetch(
+                endpoint_parts, endpoint, session, gather_metrics,
+                *validators.get(endpoint, ('', '')))
+
+        def flatten(task, response):
+            # Spooled responses are stored as they were fetched.
+            if self._spool is not None:
+                return response
+            return _flatten(response, task.gather_metrics)
+
+        def write(task, response):
+            fetch_duration = response.fetched_at - response.fetch_started_at
+            if self._spool is not None:
+                # The spool is flushed to the database once all endpoints are fetched.
+                with task.gather_metrics.phase('spool'):
+                    self._spool.append(
+                        task.endpoint, response.body, response.fetched_at,
+                        fetch_duration=fetch_duration, etag=response.etag,
+                        last_modified=response.last_modified)
+                return None
+            with task.gather_metrics.recording(), task.gather_metrics.phase('ingest'):
+                return _create(task.endpoint, response, fetch_duration, skip_unchanged)
 
-        # Create Statistics
-        objects = Statistic.objects.create_from_stats_response(
-            endpoint=endpoint, body=body, fetched_at=fetched_at
+        tasks = (
+            _Task(endpoint_parts, endpoint, metrics.GatherMetrics(endpoint))
+            for endpoint_parts, endpoint in sources
         )
+        pipeline = Pipeline(
+            fetch, flatten, write, fetcher_count=workers, flatten_count=self._flatten_workers,
+            queue_size=settings.GATHERSTATS_PIPELINE_QUEUE_SIZE)
 
-        print('Created {} object(s)'.format(len(objects)), file=self.stdout)
+        # Statistics are written from this thread alone so that all database access shares one
+        # connection.
+        results = []
+        for task, created_count, error in pipeline.run(tasks):
+            task.gather_metrics.finish(error)
+            results.append((task.endpoint, created_count, error, task.gather_metrics))
+        return results
 
+    def _stream_all(self, sources, session):
+        """Create statistics from each of *sources* in turn while the response is being parsed.
+        Return results as for :py:meth:`._gather_all`.
 
-def _url_contents(url):
-    """GET a URL and parse body as JSON."""
-    response = requests.get(url)
+        """
+        validators = _validators(sources) if settings.GATHERSTATS_SKIP_UNCHANGED else {}
+
+        results = []
+        for endpoint_parts, endpoint in sources:
+            gather_metrics = metrics.GatherMetrics(endpoint)
+            try:
+                with gather_metrics.recording():
+                    created_count = _stream(
+                        endpoint_parts, endpoint, session, gather_metrics,
+                        *validators.get(endpoint, ('', '')))
+            except Exception as e:
+                gather_metrics.finish(e)
+                results.append((endpoint, None, e, gather_metrics))
+            else:
+                gather_metrics.finish()
+                results.append((endpoint, created_count, None, gather_metrics))
+        return results
+
+
+def _close_unusable_connections():
+    """Close any database connections which have become unusable after an error so that they
+    are re-opened for the next gather. Healthy connections are left open.
+
+    """
+    for connection in connections.all():
+        if connection.connection is not None and connection.errors_occurred:
+            if connection.is_usable():
+                connection.errors_occurred = False
+            else:
+                connection.close()
+
+
+def _validators(sources):
+    """Return a dictionary mapping the endpoints of *sources* to the ETag and Last-Modified
+    header values of their previous responses.
+
+    """
+    endpoints = {endpoint for _, endpoint in sources}
+    return {
+        url: (etag, last_modified)
+        for url, etag, last_modified in Endpoint.objects.values_list(
+            'url', 'etag', 'last_modified')
+        if url in endpoints
+    }
+
+
+def _read_endpoints_file(path):
+    """Return a list of the URLs or paths listed in the file at *path*."""
+    with open(path) as fobj:
+        lines = [line.strip() for line in fobj]
+    return [line for line in lines if line != '' and not line.startswith('#')]
+
+
+@contextlib.contextmanager
+def _pooled_session(pool_size):
+    """Context manager which returns a :py:class:`requests.Session` whose connection pools can
+    hold *pool_size* connections to each host.
+
+    """
+    # Requests is imported here so that gathering from files does not import it.
+    import requests
+    import requests.adapters
+
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        yield session
+
+
+#: An endpoint to be gathered by the pipeline of :py:meth:`Command._gather_all`.
+_Task = collections.namedtuple('_Task', 'endpoint_parts endpoint gather_metrics')
+
+#: A fetched response. The body is None if the server replied "304 Not Modified". The etag and
+#: last_modified fields are the values of the corresponding headers or empty if absent.
+_Response = collections.namedtuple(
+    '_Response', 'body fetch_started_at fetched_at etag last_modified')
+
+#: A flattened response. The items are a list of key path, value pairs and body_hash is the hash
+#: of the body. Both are None if the server replied "304 Not Modified".
+_FlatResponse = collections.namedtuple(
+    '_FlatResponse', 'items body_hash fetch_started_at fetched_at etag last_modified')
+
+
+def _fetch(endpoint_parts, endpoint, session, gather_metrics, etag='', last_modified=''):
+    """Fetch and parse the whole response, conditional on the validators *etag* and
+    *last_modified* if given. The fetch and parse phases and the number of bytes fetched are
+    recorded in the :py:class:`~gatherstats.metrics.GatherMetrics` *gather_metrics*. Return a
+    :py:data:`_Response`.
+
+    """
+    fetch_started_at = timezone.now()
+    with gather_metrics.phase('fetch'):
+        if endpoint_parts.scheme == 'file':
+            content, etag, last_modified = _file_contents(endpoint_parts.path), '', ''
+        else:
+            content, etag, last_modified = _url_contents(endpoint, session, etag, last_modified)
+    fetched_at = timezone.now()
+
+    body = None
+    if content is not None:
+        gather_metrics.increment('bytes', len(content))
+        with gather_metrics.phase('parse'):
+            body = json.loads(content)
+    return _Response(body, fetch_started_at, fetched_at, etag, last_modified)
+
+
+def _flatten(response, gather_metrics):
+    """Return a :py:data:`_FlatResponse` from the :py:data:`_Response` *response*. The time
+    taken is recorded as the flatten phase of the :py:class:`~gatherstats.metrics.GatherMetrics`
+    *gather_metrics*.
+
+    """
+    items, body_hash = None, None
+    if response.body is not None:
+        with gather_metrics.phase('flatten'):
+            items, body_hash = list(_flatten_dict(response.body)), _body_hash(response.body)
+    return _FlatResponse(
+        items, body_hash, response.fetch_started_at, response.fetched_at, response.etag,
+        response.last_modified)
+
+
+def _create(endpoint, response, fetch_duration, skip_unchanged):
+    """Create statistics, or an unchanged snapshot, from the :py:data:`_FlatResponse`
+    *response*. Return the number of statistics created.
+
+    """
+    if response.items is None:
+        Snapshot.objects.create_unchanged(
+            endpoint, response.fetched_at, fetch_duration=fetch_duration,
+            etag=response.etag, last_modified=response.last_modified)
+        return 0
+    return Statistic.objects.create_from_items(
+        endpoint=endpoint, items=response.items, fetched_at=response.fetched_at,
+        return_objects=False, body_hash=response.body_hash, fetch_duration=fetch_duration,
+        skip_unchanged=skip_unchanged, etag=response.etag, last_modified=response.last_modified
+    )
+
+
+def _stream(endpoint_parts, endpoint, session, gather_metrics, etag='', last_modified=''):
+    """Create statistics while the response is being parsed. The fetch time is recorded as the
+    time at which the response started to arrive. Metrics are recorded in the
+    :py:class:`~gatherstats.metrics.GatherMetrics` *gather_metrics*. Return the number of
+    statistics created.
+
+    """
+    # The incremental JSON parser is only needed when streaming.
+    from gatherstats.streaming import CountingReader, iter_items
+
+    fetch_started_at = timezone.now()
+    with contextlib.ExitStack() as stack:
+        with gather_metrics.phase('fetch'):
+            fobj, etag, last_modified = stack.enter_context(
+                _body_stream(endpoint_parts, endpoint, session, etag, last_modified))
+        fetched_at = timezone.now()
+
+        with gather_metrics.phase('ingest'):
+            if fobj is None:
+                Snapshot.objects.create_unchanged(
+                    endpoint, fetched_at, fetch_duration=fetched_at - fetch_started_at,
+                    etag=etag, last_modified=last_modified)
+                return 0
+
+            reader, hasher = CountingReader(fobj), _BodyHasher()
+            try:
+                return Statistic.objects.create_from_items(
+                    endpoint=endpoint, items=hasher.hash_items(iter_items(reader)),
+                    fetched_at=fetched_at, return_objects=False, body_hash=hasher.hexdigest,
+                    fetch_duration=fetched_at - fetch_started_at, etag=etag,
+                    last_modified=last_modified
+                )
+            finally:
+                gather_metrics.increment('bytes', reader.bytes_read)
+
+
+def _conditional_headers(etag, last_modified):
+    """Return the headers for a request conditional on the validators *etag* and
+    *last_modified*. Either may be empty.
+
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def _url_contents(url, session, etag='', last_modified=''):
+    """GET a URL, conditional on the validators *etag* and *last_modified* if given. Return the
+    body as bytes and the ETag and Last-Modified header values of the response. The body is None
+    if the server replied "304 Not Modified".
+
+    """
+    # Requests asks for and decodes gzip compressed responses by default.
+    response = session.get(url, headers=_conditional_headers(etag, last_modified))
+    if response.status_code == 304:
+        return None, response.headers.get('ETag', etag), last_modified
     response.raise_for_status()
-    return response.json()
+    return (
+        response.content, response.headers.get('ETag', ''),
+        response.headers.get('Last-Modified', ''))
 
 
 def _file_contents(path):
-    """Return contents of file parsed as JSON."""
-    with open(path) as fobj:
-        return json.load(fobj)
+    """Return contents of file as bytes."""
+    with open(path, 'rb') as fobj:
+        return fobj.read()
+
+
+@contextlib.contextmanager
+def _body_stream(endpoint_parts, url, session, etag='', last_modified=''):
+    """Context manager which returns a tuple of a binary file-like object reading the response
+    body from a URL or file and the ETag and Last-Modified header values of the response. URLs
+    are fetched conditionally as for :py:func:`_url_contents` and the file-like object is None if
+    the server replied "304 Not Modified".
+
+    """
+    if endpoint_parts.scheme == 'file':
+        with open(endpoint_parts.path, 'rb') as fobj:
+            yield fobj, '', ''
+        return
+
+    response = session.get(url, stream=True, headers=_conditional_headers(etag, last_modified))
+    try:
+        if response.status_code == 304:
+            yield None, response.headers.get('ETag', etag), last_modified
+            return
+        response.raise_for_status()
+        # Have urllib3 undo any Content-Encoding such as gzip.
+        response.raw.decode_content = True
+        yield (
+            response.raw, response.headers.get('ETag', ''),
+            response.headers.get('Last-Modified', ''))
+    finally:
+        response.close()
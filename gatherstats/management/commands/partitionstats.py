@@ -0,0 +1,99 @@
+"""
+partitionstats
+--------------
+
+Manage the partitions of a statistic table partitioned by fetch time on PostgreSQL. See
+:py:mod:`gatherstats.partitions`.
+
+With the ``--convert`` option, an ordinary statistic table is converted into a partitioned one.
+Gathering should be stopped while converting.
+
+Otherwise, the command creates any missing partitions for the current period and the number of
+following periods given by the ``GATHERSTATS_PARTITIONS_AHEAD`` setting, or the ``--ahead``
+option. It should be run regularly, e.g. daily, so that partitions always exist before they are
+needed. Statistics fetched outside of every partition are stored in a default partition and are
+moved when a partition covering them is created.
+
+With the ``--retention`` option, partitions which only contain statistics fetched more than the
+given interval ago are detached from the statistic table and, with the ``--drop`` option,
+dropped. Unlike the compactstats command, this does not retain the latest statistic of each key
+and so rollups should be computed by compactstats before partitions are detached.
+
+"""
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from gatherstats import partitions
+from gatherstats.management.arguments import interval
+
+
+class Command(BaseCommand):
+    """Implementation of partitionstats management command."""
+
+    help = 'Create and expire partitions of the statistic table on PostgreSQL'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert', action='store_true',
+            help='Convert an unpartitioned statistic table into a partitioned one')
+        parser.add_argument(
+            '--ahead', metavar='N', type=int,
+            help='Number of partitions after the current one to create')
+        parser.add_argument(
+            '--retention', metavar='INTERVAL', type=interval,
+            help=(
+                'Detach partitions only containing statistics fetched more than INTERVAL ago, '
+                'e.g. "365d"'))
+        parser.add_argument(
+            '--drop', action='store_true',
+            help='Drop partitions once they have been detached')
+
+    def handle(self, *args, **options):
+        if not partitions.is_supported():
+            raise CommandError('Partitioning requires PostgreSQL 11 or later')
+
+        interval_name = settings.GATHERSTATS_PARTITION_INTERVAL
+        if interval_name not in partitions.INTERVALS:
+            raise CommandError(
+                'Unknown GATHERSTATS_PARTITION_INTERVAL: {!r}'.format(interval_name))
+
+        ahead = (
+            options['ahead'] if options['ahead'] is not None
+            else settings.GATHERSTATS_PARTITIONS_AHEAD
+        )
+        if ahead < 0:
+            raise CommandError('--ahead must not be negative')
+
+        if options['drop'] and options['retention'] is None:
+            raise CommandError('--drop may only be used with --retention')
+
+        # The end of the last partition to create.
+        now = timezone.now()
+        ahead_until = partitions.partition_start(now, interval_name)
+        for _ in range(ahead + 1):
+            ahead_until = partitions.next_partition_start(ahead_until, interval_name)
+
+        if options['convert']:
+            if partitions.is_partitioned():
+                raise CommandError('The statistic table is already partitioned')
+            try:
+                partitions.convert(interval_name, ahead_until)
+            except ValueError as e:
+                raise CommandError(str(e))
+            print('Converted the statistic table into a partitioned table', file=self.stdout)
+        elif not partitions.is_partitioned():
+            raise CommandError(
+                'The statistic table is not partitioned. Use --convert to partition it')
+
+        for name in partitions.create_partitions(now, ahead_until, interval_name):
+            print('Created partition {}'.format(name), file=self.stdout)
+
+        if options['retention'] is not None:
+            before = now - datetime.timedelta(seconds=options['retention'])
+            for name in partitions.detach_partitions(before, drop=options['drop']):
+                print(
+                    '{} partition {}'.format('Dropped' if options['drop'] else 'Detached', name),
+                    file=self.stdout)
@@ -0,0 +1,233 @@
+"""
+Timing and counting of the phases of gathering statistics from an endpoint.
+
+A :py:class:`GatherMetrics` instance records, for one endpoint, the time spent in each phase of
+a gather and counts such as the number of bytes fetched, keys seen, statistics created and
+database queries made. Within :py:meth:`GatherMetrics.recording`, the module-level
+:py:func:`phase` and :py:func:`increment` functions record into that instance so that code such
+as :py:class:`~gatherstats.models.StatisticManager` can be instrumented without being passed the
+instance. Outside of a recording, they do nothing.
+
+The phases recorded by the gatherstats management command are:
+
+``fetch``
+    Making the HTTP request and reading the response body. For streamed gathers, only reading
+    the response headers.
+
+``parse``
+    Parsing the response body as JSON. Not recorded for streamed gathers.
+
+``flatten``
+    Flattening the parsed body into key path, value pairs. For streamed gathers, this includes
+    reading and parsing the body.
+
+``resolve_keys``
+    Looking up or creating the endpoint and key rows.
+
+``insert``
+    Inserting statistics.
+
+``derived``
+    Updating the latest values and rollups.
+
+``ingest``
+    The whole database transaction, including the phases above apart from ``fetch`` and
+    ``parse``.
+
+Once a gather finishes, each endpoint's metrics are logged as one JSON object per line via the
+"gatherstats.metrics" logger and, if the ``GATHERSTATS_METRICS_TEXTFILE`` setting is set, written
+to that file in the Prometheus text format for node-exporter's textfile collector.
+
+"""
+import collections
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+LOG = logging.getLogger(__name__)
+
+# Holds the GatherMetrics being recorded in each thread.
+_local = threading.local()
+
+
+class GatherMetrics:
+    """
+    Metrics of one gather of the endpoint with URL *endpoint*.
+
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+        #: Mapping from phase name to total seconds spent in that phase, in the order in which
+        #: phases were first entered.
+        self.durations = collections.OrderedDict()
+
+        #: Mapping from count name to value.
+        self.counts = collections.OrderedDict()
+
+        #: The exception which caused the gather to fail or None if it succeeded.
+        self.error = None
+
+        #: Time at which the gather finished, in seconds since the epoch, or None if it has not.
+        self.finished_at = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager which adds the time spent within it to the phase *name*."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - started
+
+    def increment(self, name, amount=1):
+        """Add *amount* to the count *name*."""
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    @contextlib.contextmanager
+    def recording(self, using=DEFAULT_DB_ALIAS):
+        """Context manager within which calls to the module-level :py:func:`phase` and
+        :py:func:`increment` functions on this thread record into this instance. Queries made
+        on the database connection *using* are counted as "queries".
+
+        """
+        def count_query(execute, sql, params, many, context):
+            self.increment('queries')
+            return execute(sql, params, many, context)
+
+        previous = getattr(_local, 'metrics', None)
+        _local.metrics = self
+        try:
+            with connections[using].execute_wrapper(count_query):
+                yield self
+        finally:
+            _local.metrics = previous
+
+    def finish(self, error=None):
+        """Mark the gather as finished, failing with the exception *error* if not None."""
+        self.error = error
+        self.finished_at = time.time()
+
+    def as_dict(self):
+        """Return the metrics as a dictionary suitable for serialising as JSON."""
+        return {
+            'endpoint': self.endpoint,
+            'status': 'ok' if self.error is None else 'failed',
+            'error': str(self.error) if self.error is not None else None,
+            'durations': dict(self.durations),
+            'counts': dict(self.counts),
+        }
+
+
+def phase(name):
+    """Return a context manager adding the time spent within it to the phase *name* of the
+    metrics being recorded on this thread, if any.
+
+    """
+    metrics = getattr(_local, 'metrics', None)
+    # An empty suppress() does nothing. contextlib.nullcontext() needs Python 3.7.
+    return metrics.phase(name) if metrics is not None else contextlib.suppress()
+
+
+def increment(name, amount=1):
+    """Add *amount* to the count *name* of the metrics being recorded on this thread, if any."""
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics.increment(name, amount)
+
+
+def timed(name, iterable):
+    """A generator which yields the items of *iterable*, adding the time spent producing them to
+    the phase *name* of the metrics being recorded on this thread, if any.
+
+    """
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def log(metrics_list):
+    """Log each of the :py:class:`GatherMetrics` in *metrics_list* as a JSON object."""
+    for metrics in metrics_list:
+        LOG.info('%s', json.dumps(metrics.as_dict(), sort_keys=True))
+
+
+def prometheus_text(metrics_list):
+    """Return the :py:class:`GatherMetrics` in *metrics_list* in the Prometheus text format."""
+    families = collections.OrderedDict([
+        ('gatherstats_gather_success', (
+            'Whether the last gather of the endpoint succeeded.', [])),
+        ('gatherstats_gather_finished_timestamp_seconds', (
+            'Time at which the last gather of the endpoint finished.', [])),
+        ('gatherstats_gather_phase_duration_seconds', (
+            'Time spent in each phase of the last gather of the endpoint.', [])),
+        ('gatherstats_gather_count', (
+            'Bytes, keys, statistics and queries counted by the last gather of the endpoint.',
+            [])),
+    ])
+    for metrics in metrics_list:
+        labels = {'endpoint': metrics.endpoint}
+        families['gatherstats_gather_success'][1].append(
+            (labels, 1 if metrics.error is None else 0))
+        if metrics.finished_at is not None:
+            families['gatherstats_gather_finished_timestamp_seconds'][1].append(
+                (labels, metrics.finished_at))
+        for name, seconds in metrics.durations.items():
+            families['gatherstats_gather_phase_duration_seconds'][1].append(
+                (dict(labels, phase=name), seconds))
+        for name, value in metrics.counts.items():
+            families['gatherstats_gather_count'][1].append((dict(labels, count=name), value))
+
+    return format_gauges(families)
+
+
+def format_gauges(families):
+    """Return gauges in the Prometheus text format. *families* is a mapping from metric name to
+    a help text, samples pair where samples is a list of labels dictionary, value pairs.
+
+    """
+    lines = []
+    for family, (help_text, samples) in families.items():
+        lines.extend([
+            '# HELP {} {}'.format(family, help_text),
+            '# TYPE {} gauge'.format(family),
+        ])
+        for labels, value in samples:
+            lines.append('{}{{{}}} {}'.format(family, _format_labels(labels), repr(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, metrics_list):
+    """Write the :py:class:`GatherMetrics` in *metrics_list* to the file at *path* in the
+    Prometheus text format. The file is replaced atomically so that a collector never reads a
+    partially written file.
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.gatherstats', suffix='.prom')
+    try:
+        with os.fdopen(fd, 'w') as fobj:
+            fobj.write(prometheus_text(metrics_list))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def _format_labels(labels):
+    return ','.join(
+        '{}="{}"'.format(
+            name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in sorted(labels.items()))
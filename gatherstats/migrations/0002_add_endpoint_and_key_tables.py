@@ -0,0 +1,50 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0001_create_statistic_model'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Endpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(help_text='URL of endpoint which stats were fetched from', max_length=1204, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StatisticKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(help_text='Dot-separated JavaScript style key path', max_length=512, unique=True)),
+            ],
+        ),
+        # The denormalised columns are made nullable so that they can be removed and, when
+        # migrating backwards, re-added to a populated table.
+        migrations.AlterField(
+            model_name='statistic',
+            name='endpoint',
+            field=models.URLField(help_text='URL of endpoint which this stat was fetched from', max_length=1204, null=True),
+        ),
+        migrations.AlterField(
+            model_name='statistic',
+            name='key',
+            field=models.CharField(help_text='Dot-separated JavaScript style key path', max_length=512, null=True),
+        ),
+        migrations.AddField(
+            model_name='statistic',
+            name='endpoint_ref',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='gatherstats.Endpoint'),
+        ),
+        migrations.AddField(
+            model_name='statistic',
+            name='key_ref',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='gatherstats.StatisticKey'),
+        ),
+    ]
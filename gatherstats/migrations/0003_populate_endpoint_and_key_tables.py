@@ -0,0 +1,58 @@
+"""
+Intern the endpoint URLs and key paths of existing statistics into the endpoint and key tables.
+This is done in SQL rather than via the ORM since the statistic table may have many millions of
+rows.
+
+"""
+from django.db import migrations
+
+
+FORWARD_SQL = [
+    '''
+    INSERT INTO gatherstats_endpoint (url)
+        SELECT DISTINCT endpoint FROM gatherstats_statistic
+    ''',
+    '''
+    INSERT INTO gatherstats_statistickey (path)
+        SELECT DISTINCT "key" FROM gatherstats_statistic
+    ''',
+    '''
+    UPDATE gatherstats_statistic SET
+        endpoint_ref_id = (
+            SELECT e.id FROM gatherstats_endpoint e
+            WHERE e.url = gatherstats_statistic.endpoint
+        ),
+        key_ref_id = (
+            SELECT k.id FROM gatherstats_statistickey k
+            WHERE k.path = gatherstats_statistic."key"
+        )
+    ''',
+]
+
+REVERSE_SQL = [
+    '''
+    UPDATE gatherstats_statistic SET
+        endpoint = (
+            SELECT e.url FROM gatherstats_endpoint e
+            WHERE e.id = gatherstats_statistic.endpoint_ref_id
+        ),
+        "key" = (
+            SELECT k.path FROM gatherstats_statistickey k
+            WHERE k.id = gatherstats_statistic.key_ref_id
+        )
+    ''',
+    'UPDATE gatherstats_statistic SET endpoint_ref_id = NULL, key_ref_id = NULL',
+    'DELETE FROM gatherstats_statistickey',
+    'DELETE FROM gatherstats_endpoint',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0002_add_endpoint_and_key_tables'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0003_populate_endpoint_and_key_tables'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='statistic',
+            name='gatherstats_endpoin_ca0383_idx',
+        ),
+        migrations.AlterUniqueTogether(
+            name='statistic',
+            unique_together=set(),
+        ),
+        migrations.RemoveField(
+            model_name='statistic',
+            name='endpoint',
+        ),
+        migrations.RemoveField(
+            model_name='statistic',
+            name='key',
+        ),
+        migrations.RenameField(
+            model_name='statistic',
+            old_name='endpoint_ref',
+            new_name='endpoint',
+        ),
+        migrations.RenameField(
+            model_name='statistic',
+            old_name='key_ref',
+            new_name='key',
+        ),
+        migrations.AlterField(
+            model_name='statistic',
+            name='endpoint',
+            field=models.ForeignKey(db_index=False, help_text='Endpoint which this stat was fetched from', on_delete=django.db.models.deletion.PROTECT, related_name='statistics', to='gatherstats.Endpoint'),
+        ),
+        migrations.AlterField(
+            model_name='statistic',
+            name='key',
+            field=models.ForeignKey(help_text='Key path of this stat', on_delete=django.db.models.deletion.PROTECT, related_name='statistics', to='gatherstats.StatisticKey'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='statistic',
+            unique_together={('endpoint', 'key', 'fetched_at')},
+        ),
+        migrations.AddIndex(
+            model_name='statistic',
+            index=models.Index(fields=['endpoint', 'key', 'fetched_at'], name='gatherstats_endpoin_8ee5aa_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0004_normalise_statistic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Snapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fetched_at', models.DateTimeField(help_text='Date and time when the endpoint was fetched')),
+                ('key_count', models.PositiveIntegerField(default=0, help_text='Number of statistics recorded from the response')),
+                ('body_hash', models.CharField(blank=True, help_text='SHA-256 hex digest of the response body', max_length=64)),
+                ('fetch_duration', models.DurationField(blank=True, help_text='Time taken to fetch the response', null=True)),
+                ('endpoint', models.ForeignKey(db_index=False, help_text='Endpoint which was fetched', on_delete=django.db.models.deletion.PROTECT, related_name='snapshots', to='gatherstats.Endpoint')),
+            ],
+            options={
+                'get_latest_by': 'fetched_at',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='snapshot',
+            index=models.Index(fields=['fetched_at'], name='gatherstats_fetched_65a3d0_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='snapshot',
+            unique_together={('endpoint', 'fetched_at')},
+        ),
+        migrations.AddField(
+            model_name='statistic',
+            name='snapshot',
+            field=models.ForeignKey(help_text='Fetch which this stat was recorded from', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='gatherstats.Snapshot'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+"""
+Create a snapshot for each distinct endpoint and fetch time in the existing statistics and point
+the statistics at them. The response bodies of existing snapshots are not known and so their body
+hash is left blank.
+
+"""
+from django.db import migrations
+
+
+FORWARD_SQL = [
+    '''
+    INSERT INTO gatherstats_snapshot (endpoint_id, fetched_at, key_count, body_hash)
+        SELECT endpoint_id, fetched_at, COUNT(*), ''
+        FROM gatherstats_statistic
+        GROUP BY endpoint_id, fetched_at
+    ''',
+    '''
+    UPDATE gatherstats_statistic SET
+        snapshot_id = (
+            SELECT s.id FROM gatherstats_snapshot s
+            WHERE
+                s.endpoint_id = gatherstats_statistic.endpoint_id
+                AND s.fetched_at = gatherstats_statistic.fetched_at
+        )
+    ''',
+]
+
+REVERSE_SQL = [
+    'UPDATE gatherstats_statistic SET snapshot_id = NULL',
+    'DELETE FROM gatherstats_snapshot',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0005_add_snapshot_model'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0006_populate_snapshots'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='statistic',
+            name='snapshot',
+            field=models.ForeignKey(help_text='Fetch which this stat was recorded from', on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='gatherstats.Snapshot'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0007_statistic_snapshot_not_null'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='delta',
+            field=models.BooleanField(default=False, help_text='Only changed values were recorded'),
+        ),
+        migrations.AlterField(
+            model_name='snapshot',
+            name='key_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of keys in the response'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0008_snapshot_delta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatisticRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], help_text='Length of period summarised', max_length=8)),
+                ('period_start', models.DateTimeField(help_text='Start of period summarised')),
+                ('sample_count', models.PositiveIntegerField(help_text='Number of values observed')),
+                ('total', models.FloatField(help_text='Sum of values observed')),
+                ('minimum', models.FloatField(help_text='Smallest value observed')),
+                ('maximum', models.FloatField(help_text='Largest value observed')),
+                ('last_value', models.FloatField(help_text='Most recent value observed')),
+                ('last_fetched_at', models.DateTimeField(help_text='Date and time when the most recent value was fetched')),
+                ('endpoint', models.ForeignKey(db_index=False, help_text='Endpoint which the stats were fetched from', on_delete=django.db.models.deletion.PROTECT, related_name='rollups', to='gatherstats.Endpoint')),
+                ('key', models.ForeignKey(db_index=False, help_text='Key path of the stats', on_delete=django.db.models.deletion.PROTECT, related_name='rollups', to='gatherstats.StatisticKey')),
+            ],
+            options={
+                'unique_together': {('endpoint', 'key', 'period', 'period_start')},
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0009_statisticrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statistickey',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Number of components in key path'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='statistickey',
+            name='dimension',
+            field=models.CharField(blank=True, default='', help_text='Dimension, e.g. "institution"', max_length=512),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='statistickey',
+            name='dimension_value',
+            field=models.CharField(blank=True, default='', help_text='Value of dimension, e.g. an institution', max_length=512),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='statistickey',
+            name='leaf',
+            field=models.CharField(default='', help_text='Last component of key path', max_length=512),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='statistickey',
+            name='parent',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='Key path of parent object', max_length=512),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='statistickey',
+            index=models.Index(fields=['dimension', 'dimension_value', 'leaf'], name='gatherstats_dimensi_7536e4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='statistickey',
+            index=models.Index(fields=['leaf'], name='gatherstats_leaf_7a3c2f_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+"""
+Derive the structured parts of existing key paths. This is done in Python since splitting paths
+in SQL differs between database backends and the number of distinct keys is small.
+
+"""
+from django.db import migrations
+
+
+def split_path(path):
+    # A copy of gatherstats.models._split_path as it was when this migration was written.
+    components = path.split('.')
+    parts = {
+        'depth': len(components),
+        'parent': '.'.join(components[:-1]),
+        'leaf': components[-1],
+        'dimension': '',
+        'dimension_value': '',
+    }
+    for idx, component in enumerate(components[:-2]):
+        if component.startswith('by_') and len(component) > len('by_'):
+            parts['dimension'] = component[len('by_'):]
+            parts['dimension_value'] = components[idx + 1]
+            break
+    return parts
+
+
+def populate_path_parts(apps, schema_editor):
+    StatisticKey = apps.get_model('gatherstats', 'StatisticKey')
+    keys = list(StatisticKey.objects.using(schema_editor.connection.alias).all())
+    for key in keys:
+        for name, value in split_path(key.path).items():
+            setattr(key, name, value)
+    StatisticKey.objects.using(schema_editor.connection.alias).bulk_update(
+        keys, ['depth', 'parent', 'leaf', 'dimension', 'dimension_value'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0010_statistickey_path_parts'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_path_parts, migrations.RunPython.noop),
+    ]
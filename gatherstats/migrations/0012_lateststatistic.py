@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0011_populate_statistickey_path_parts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatestStatistic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('numeric_value', models.FloatField(help_text='Value of numeric statistic')),
+                ('fetched_at', models.DateTimeField(help_text='Date and time when this value was fetched')),
+                ('endpoint', models.ForeignKey(db_index=False, help_text='Endpoint which this stat was fetched from', on_delete=django.db.models.deletion.PROTECT, related_name='latest_statistics', to='gatherstats.Endpoint')),
+                ('key', models.ForeignKey(db_index=False, help_text='Key path of this stat', on_delete=django.db.models.deletion.PROTECT, related_name='latest_statistics', to='gatherstats.StatisticKey')),
+            ],
+            options={
+                'unique_together': {('endpoint', 'key')},
+            },
+        ),
+    ]
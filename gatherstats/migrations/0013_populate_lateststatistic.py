@@ -0,0 +1,33 @@
+"""
+Record the latest statistic for each endpoint and key in the existing statistics.
+
+"""
+from django.db import migrations
+
+
+FORWARD_SQL = [
+    '''
+    INSERT INTO gatherstats_lateststatistic (endpoint_id, key_id, numeric_value, fetched_at)
+        SELECT s.endpoint_id, s.key_id, s.numeric_value, s.fetched_at
+        FROM gatherstats_statistic s
+        WHERE s.fetched_at = (
+            SELECT MAX(l.fetched_at) FROM gatherstats_statistic l
+            WHERE l.endpoint_id = s.endpoint_id AND l.key_id = s.key_id
+        )
+    ''',
+]
+
+REVERSE_SQL = [
+    'DELETE FROM gatherstats_lateststatistic',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0012_lateststatistic'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+    ]
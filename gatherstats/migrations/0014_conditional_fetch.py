@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0013_populate_lateststatistic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpoint',
+            name='body_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 hex digest of most recent response body', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='endpoint',
+            name='etag',
+            field=models.CharField(blank=True, help_text='ETag of most recent response', max_length=1024),
+        ),
+        migrations.AddField(
+            model_name='endpoint',
+            name='last_fetched_at',
+            field=models.DateTimeField(blank=True, help_text='Date and time when most recent response was fetched', null=True),
+        ),
+        migrations.AddField(
+            model_name='endpoint',
+            name='last_modified',
+            field=models.CharField(blank=True, help_text='Last-Modified header of most recent response', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='unchanged',
+            field=models.BooleanField(default=False, help_text='Response was unchanged and no statistics were recorded'),
+        ),
+    ]
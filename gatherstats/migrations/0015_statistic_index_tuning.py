@@ -0,0 +1,51 @@
+"""
+Tune the indexes of the statistic table. The explicit endpoint/key/fetched_at index duplicates
+the index of the unique constraint on the same columns and the key index is a prefix of the new
+key/fetched_at index, so both are dropped. On PostgreSQL, a BRIN index on fetched_at is created
+for scans of a range of time. Other backends do not support BRIN indexes.
+
+"""
+from django.db import migrations, models
+import django.db.models.deletion
+
+BRIN_INDEX_NAME = 'gatherstats_statistic_fetched_at_brin'
+
+
+def create_brin_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Statistic = apps.get_model('gatherstats', 'Statistic')
+    qn = schema_editor.quote_name
+    schema_editor.execute('CREATE INDEX {} ON {} USING brin ({})'.format(
+        qn(BRIN_INDEX_NAME), qn(Statistic._meta.db_table), qn('fetched_at')))
+
+
+def drop_brin_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS {}'.format(
+        schema_editor.quote_name(BRIN_INDEX_NAME)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0014_conditional_fetch'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='statistic',
+            index=models.Index(fields=['key', 'fetched_at', 'numeric_value'], name='gatherstats_key_id_a72593_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='statistic',
+            name='gatherstats_endpoin_8ee5aa_idx',
+        ),
+        migrations.AlterField(
+            model_name='statistic',
+            name='key',
+            field=models.ForeignKey(db_index=False, help_text='Key path of this stat', on_delete=django.db.models.deletion.PROTECT, related_name='statistics', to='gatherstats.StatisticKey'),
+        ),
+        migrations.RunPython(create_brin_index, drop_brin_index),
+    ]
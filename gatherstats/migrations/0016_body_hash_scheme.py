@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatherstats', '0015_statistic_index_tuning'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='endpoint',
+            name='body_hash',
+            field=models.CharField(blank=True, help_text='Hash of the keys and values of the most recent response body', max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='snapshot',
+            name='body_hash',
+            field=models.CharField(blank=True, help_text='Hash of the keys and values of the response body', max_length=64),
+        ),
+    ]
@@ -1,8 +1,29 @@
-from django.db import models, transaction
+import datetime
+import hashlib
+import io
+import itertools
+import json
+import math
+import re
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.db.models import Count, Max, Min, OuterRef, Subquery, Sum
+from django.db.models.functions import TruncDay, TruncHour
 from django.utils import timezone
 
+from gatherstats import caching, metrics
+
+#: Policies for statistics which already exist when a response is re-delivered. See
+#: :py:meth:`StatisticManager.create_from_stats_response`.
+ON_CONFLICT_ERROR, ON_CONFLICT_SKIP, ON_CONFLICT_OVERWRITE = 'error', 'skip', 'overwrite'
+
+#: All conflict policies.
+CONFLICT_POLICIES = (ON_CONFLICT_ERROR, ON_CONFLICT_SKIP, ON_CONFLICT_OVERWRITE)
+
 
-def _flatten_dict(d, prefix_path=[]):
+def _flatten_dict(d, prefix=''):
     """A generator which yields key/value pairs from a flattened dict. E.g., given the following
     dict::
 
@@ -22,7 +43,7 @@ def _flatten_dict(d, prefix_path=[]):
         ('bar.bang', 'hello')
 
     The ordering is not guaranteed beyond the dictionary will be explored in a breadth first
-    manner.
+    manner. The optional *prefix* is prepended to each key path.
 
     """
     if not isinstance(d, dict):
@@ -31,15 +52,320 @@ def _flatten_dict(d, prefix_path=[]):
     dict_items = []
     for k, v in d.items():
         if not isinstance(v, dict):
-            yield '.'.join(prefix_path + [k]), v
+            yield prefix + k, v
         else:
             dict_items.append((k, v))
 
     # Process dict items after all non-dict items to ensure breadth-first navigation
     for k, v in dict_items:
         assert isinstance(v, dict)
-        for item in _flatten_dict(v, prefix_path=prefix_path + [k]):
-            yield item
+        yield from _flatten_dict(v, prefix=prefix + k + '.')
+
+
+class _BodyHasher:
+    """
+    Compute the body hash of a response from its key path, value pairs as they are generated.
+    This is the hash stored in :py:attr:`Snapshot.body_hash` and :py:attr:`Endpoint.body_hash`
+    whether a response was flattened with :py:func:`_flatten_dict` or parsed incrementally by
+    :py:func:`gatherstats.streaming.iter_items`.
+
+    The hash is the sum modulo 2**256 of the SHA-256 digests of the canonical JSON serialisation
+    of each pair, as 64 hex digits. It does not depend on the order of the pairs and so neither
+    on the order of keys in the body, which differs between the two ways of flattening a body,
+    and it can be computed without holding the body in memory. Bodies which differ only in empty
+    objects, and so have the same statistics, have the same hash. It is intended for detecting
+    unchanged responses and is not a digest of the bytes of the body.
+
+    """
+    _MODULUS = 2 ** 256
+
+    def __init__(self):
+        self._sum = 0
+
+    def update(self, key, value):
+        """Add the key path *key* and its value *value* to the hash."""
+        pair = json.dumps([key, value], sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha256(pair.encode('utf8')).digest()
+        self._sum = (self._sum + int.from_bytes(digest, 'big')) % self._MODULUS
+
+    def hash_items(self, items):
+        """A generator which yields each key path, value pair from *items* after adding it to
+        the hash.
+
+        """
+        for key, value in items:
+            self.update(key, value)
+            yield key, value
+
+    def hexdigest(self):
+        """Return the hash of the pairs added so far."""
+        return '{:064x}'.format(self._sum)
+
+
+def _body_hash(body):
+    """Return the body hash of the dictionary *body*. See :py:class:`_BodyHasher`."""
+    hasher = _BodyHasher()
+    for key, value in _flatten_dict(body):
+        hasher.update(key, value)
+    return hasher.hexdigest()
+
+
+def _batched(iterable, batch_size):
+    """A generator which yields lists of at most *batch_size* items taken from *iterable*. Only
+    one batch is held in memory at a time.
+
+    """
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _copy_text_value(value):
+    """Format a database-prepared value for PostgreSQL's ``COPY`` text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return repr(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+def _can_copy(connection):
+    """Return True if rows can be written to *connection* using ``COPY ... FROM STDIN``."""
+    if not settings.GATHERSTATS_INGEST_USE_COPY or connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        # The raw psycopg2 cursor is wrapped by Django.
+        return hasattr(cursor.cursor, 'copy_expert')
+
+
+def _copy_objects(connection, model, objs):
+    """Write unsaved model instances *objs* to the database using PostgreSQL's ``COPY`` command.
+    Primary keys are not set on *objs*.
+
+    """
+    opts = model._meta
+    fields = [f for f in opts.concrete_fields if f is not opts.auto_field]
+    qn = connection.ops.quote_name
+
+    buf = io.StringIO()
+    for obj in objs:
+        buf.write('\t'.join(
+            _copy_text_value(f.get_db_prep_save(getattr(obj, f.attname), connection))
+            for f in fields
+        ))
+        buf.write('\n')
+    buf.seek(0)
+
+    sql = 'COPY {} ({}) FROM STDIN'.format(
+        qn(opts.db_table), ', '.join(qn(f.column) for f in fields))
+    with connection.cursor() as cursor, connection.wrap_database_errors:
+        cursor.cursor.copy_expert(sql, buf)
+
+
+def _can_return(connection):
+    """Return True if ``INSERT ... ON CONFLICT`` statements on *connection* may have a
+    ``RETURNING`` clause. PostgreSQL and SQLite 3.35 or later support this.
+
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)
+
+
+def _upsert_rows(connection, model, field_names, conflict_field_names, rows, on_conflict,
+                 returning=()):
+    """Insert *rows*, each a tuple of values for the fields of *model* named in *field_names*,
+    using multi-row ``INSERT ... ON CONFLICT`` statements. The conflict target is the unique
+    constraint on the fields named in *conflict_field_names* and *on_conflict* is the conflict
+    action, e.g. ``DO NOTHING``. In *on_conflict*, "{table}" is replaced by the quoted table name
+    and "{<field name>}" by the quoted column name of that field. Both PostgreSQL and SQLite
+    3.24 or later support this syntax. Return the number of rows inserted or updated.
+
+    If *returning* names fields of *model*, return a list of tuples of their column values for
+    each row inserted or updated instead. This requires :py:func:`_can_return`.
+
+    """
+    opts = model._meta
+    qn = connection.ops.quote_name
+    fields = [opts.get_field(name) for name in field_names]
+    table = qn(opts.db_table)
+    column = {field.name: qn(field.column) for field in opts.concrete_fields}
+
+    sql = 'INSERT INTO {} ({}) VALUES {{}} ON CONFLICT ({}) {}'.format(
+        table, ', '.join(column[name] for name in field_names),
+        ', '.join(column[name] for name in conflict_field_names),
+        on_conflict.format(table=table, **column).replace('{', '{{').replace('}', '}}'))
+    if len(returning) > 0:
+        sql += ' RETURNING {}'.format(', '.join(column[name] for name in returning))
+    row_placeholder = '({})'.format(', '.join(['%s'] * len(fields)))
+
+    # Respect the backend's limit on the number of query parameters.
+    rows_per_statement = max(1, connection.ops.bulk_batch_size(fields, rows))
+    row_count, returned_rows = 0, []
+    with connection.cursor() as cursor:
+        for batch in _batched(rows, rows_per_statement):
+            cursor.execute(
+                sql.format(', '.join([row_placeholder] * len(batch))),
+                [
+                    field.get_db_prep_save(value, connection)
+                    for row in batch for field, value in zip(fields, row)
+                ])
+            if len(returning) > 0:
+                returned_rows.extend(cursor.fetchall())
+            else:
+                row_count += cursor.rowcount
+    return returned_rows if len(returning) > 0 else row_count
+
+
+class _InternCache:
+    """
+    An in-memory cache mapping values of a unique field on an "interning" model to the primary
+    keys of the corresponding rows. Rows for values which do not yet exist are created in bulk.
+
+    Newly resolved primary keys are only added to the cache once the enclosing transaction
+    commits so that the cache never refers to rows which were rolled back.
+
+    If *factory_name* is not None, it names a class method of the model which is passed a value
+    and returns an unsaved instance for it. Otherwise, instances are created with just the field
+    set.
+
+    """
+    def __init__(self, model_name, field_name, factory_name=None):
+        self.model_name = model_name
+        self.field_name = field_name
+        self.factory_name = factory_name
+        self._ids = {}
+
+    @property
+    def model(self):
+        return apps.get_model('gatherstats', self.model_name)
+
+    def clear(self):
+        """Forget all cached primary keys."""
+        self._ids.clear()
+
+    def resolve(self, values, using, batch_size):
+        """Return a dictionary mapping each value in *values* to the primary key of its row,
+        creating rows as necessary. At most *batch_size* values are looked up per query.
+
+        """
+        ids = {v: self._ids[v] for v in values if v in self._ids}
+        missing = [v for v in set(values) if v not in ids]
+        if not missing:
+            return ids
+
+        manager = self.model._default_manager.db_manager(using)
+        resolved = self._fetch(manager, missing, batch_size)
+
+        new_values = [v for v in missing if v not in resolved]
+        if len(new_values) > 0:
+            # Another ingest may create some of these rows concurrently, so ignore conflicts and
+            # read back the primary keys afterwards.
+            manager.bulk_create(
+                [self._make(v) for v in new_values],
+                batch_size=batch_size, ignore_conflicts=True)
+            resolved.update(self._fetch(manager, new_values, batch_size))
+
+        transaction.on_commit(lambda: self._ids.update(resolved), using=using)
+        ids.update(resolved)
+        return ids
+
+    def _make(self, value):
+        if self.factory_name is not None:
+            return getattr(self.model, self.factory_name)(value)
+        return self.model(**{self.field_name: value})
+
+    def _fetch(self, manager, values, batch_size):
+        fetched = {}
+        for batch in _batched(values, batch_size):
+            fetched.update(
+                manager.filter(**{self.field_name + '__in': batch})
+                .values_list(self.field_name, 'pk'))
+        return fetched
+
+
+#: Cache of :py:class:`Endpoint` primary keys indexed by URL.
+_endpoint_ids = _InternCache('Endpoint', 'url')
+
+#: Cache of :py:class:`StatisticKey` primary keys indexed by key path.
+_key_ids = _InternCache('StatisticKey', 'path', 'for_path')
+
+
+class _LastValueCache:
+    """
+    An in-memory cache of the most recently recorded value of each key of an endpoint. It is used
+    to decide which values have changed when only changed values are stored.
+
+    Each entry records the :py:class:`Snapshot` it is up to date with. If a newer snapshot for the
+    endpoint has since been recorded, for example by another process, the entry is re-read from
+    the database. As with :py:class:`_InternCache`, entries are only updated once the enclosing
+    transaction commits.
+
+    """
+    def __init__(self):
+        # Map from endpoint primary key to snapshot primary key, {key primary key: value} pairs.
+        self._entries = {}
+
+    def clear(self):
+        """Forget all cached values."""
+        self._entries.clear()
+
+    def get(self, endpoint_id, snapshot_id, using):
+        """Return a dictionary mapping key primary keys to the latest value recorded for them
+        from the endpoint with primary key *endpoint_id* as of the snapshot with primary key
+        *snapshot_id*. The returned dictionary must not be modified.
+
+        """
+        entry = self._entries.get(endpoint_id)
+        if entry is not None and entry[0] == snapshot_id:
+            return entry[1]
+
+        return dict(
+            Statistic.objects.db_manager(using)
+            ._latest_per_key(endpoint_id=endpoint_id)
+            .values_list('key_id', 'numeric_value'))
+
+    def update(self, endpoint_id, snapshot_id, last_values, changed_values, using):
+        """Once the current transaction commits, record that the snapshot with primary key
+        *snapshot_id* changed the values in the dictionary *changed_values* from those in
+        *last_values*, as returned by :py:meth:`.get`.
+
+        """
+        def on_commit():
+            values = dict(last_values)
+            values.update(changed_values)
+            self._entries[endpoint_id] = (snapshot_id, values)
+
+        transaction.on_commit(on_commit, using=using)
+
+    def discard(self, endpoint_id, using):
+        """Once the current transaction commits, forget the values cached for the endpoint with
+        primary key *endpoint_id*.
+
+        """
+        transaction.on_commit(lambda: self._entries.pop(endpoint_id, None), using=using)
+
+
+#: Cache of the latest value of each key indexed by endpoint primary key.
+_last_values = _LastValueCache()
 
 
 class StatisticManager(models.Manager):
@@ -47,27 +373,880 @@ class StatisticManager(models.Manager):
     Custom object manager for :py:class:`Statistic`. Accessed via :py:attr:`Statistic.objects`.
     """
 
-    @transaction.atomic
-    def create_from_stats_response(self, endpoint, body, fetched_at=None):
+    def create_from_stats_response(self, endpoint, body, fetched_at=None, batch_size=None,
+                                   return_objects=True, body_hash=None, fetch_duration=None,
+                                   delta=None, skip_unchanged=False, etag='', last_modified='',
+                                   on_conflict=None):
         """Create :py:class:`Statistic` instances from a dictionary representation of a stats
-        endpoint response body.
+        endpoint response body. The *endpoint* is the URL of the endpoint.
 
         The object creation is done within a database atomic transaction so other users of the
         database never see a partially processed object.
 
         If *fetched_at* is None, :py:func:`timezone.now` is used.
 
+        A :py:class:`Snapshot` recording this fetch is created and each statistic refers to it.
+        The optional *body_hash* and *fetch_duration* are recorded in the snapshot. If
+        *body_hash* is None, it is computed from *body*.
+
+        Rows are written in batches of at most *batch_size* rows using multi-row INSERT
+        statements or, on PostgreSQL with psycopg2, ``COPY``. If *batch_size* is None, the
+        ``GATHERSTATS_INGEST_BATCH_SIZE`` setting is used. The :py:class:`Endpoint` and
+        :py:class:`StatisticKey` rows for each batch are resolved in bulk and cached in memory.
+
+        If *delta* is True, a statistic is only created for a key if its value differs from the
+        value most recently recorded for that key from the same endpoint. Use
+        :py:meth:`.values_at` to reconstruct the full set of values at a given time. Since
+        "most recent" is only meaningful when responses are recorded in the order they were
+        fetched, all values are recorded if the endpoint already has a snapshot fetched after
+        *fetched_at*. In that case, the values which the next snapshot carried forward from
+        earlier ones and which this response would otherwise replace are recorded in the next
+        snapshot, so that the values reconstructed for later times are unchanged. If *delta* is
+        None, the ``GATHERSTATS_DELTA_STORAGE`` setting is used.
+
+        The :py:class:`LatestStatistic` rows for the endpoint and the :py:class:`StatisticRollup`
+        rows summarising the period containing *fetched_at* are updated with the value of every
+        key in the response, whether or not a statistic was created for it.
+
+        The body hash and the HTTP validators *etag* and *last_modified* from the response are
+        stored in the :py:class:`Endpoint` unless a later response has already been recorded. If
+        *skip_unchanged* is True and the body hash matches that of the latest response recorded
+        before *fetched_at*, only an unchanged :py:class:`Snapshot` is created. See
+        :py:meth:`SnapshotManager.create_unchanged`.
+
+        The policy *on_conflict* determines what happens if the endpoint already has a snapshot
+        fetched at *fetched_at*, for example because a response is re-delivered by a repeated
+        backfill or spool flush. It is one of :py:data:`CONFLICT_POLICIES`:
+
+        * ``"error"`` raises :py:exc:`django.db.IntegrityError` and nothing is written.
+        * ``"skip"`` keeps the existing statistics and only creates those for new keys.
+        * ``"overwrite"`` replaces the values of existing statistics which differ and creates
+          those for new keys. Rollups are adjusted for the new values but their minimum and
+          maximum may still reflect a replaced value.
+
+        Statistics are then written with ``INSERT ... ON CONFLICT`` statements and the numbers of
+        statistics skipped and overwritten are recorded in any
+        :py:class:`gatherstats.metrics.GatherMetrics` being recorded. Delta storage is not used
+        for re-delivered responses. If *on_conflict* is None, the
+        ``GATHERSTATS_INGEST_ON_CONFLICT`` setting is used.
+
+        If *return_objects* is True, a list of the created :py:class:`Statistic` instances is
+        returned. Otherwise, only the number of statistics created, or overwritten, is returned
+        and the created rows are not read back from the database.
+
+        """
+        return self.create_from_items(
+            endpoint=endpoint, items=_flatten_dict(body), fetched_at=fetched_at,
+            batch_size=batch_size, return_objects=return_objects,
+            body_hash=body_hash if body_hash is not None else _body_hash(body),
+            fetch_duration=fetch_duration, delta=delta, skip_unchanged=skip_unchanged,
+            etag=etag, last_modified=last_modified, on_conflict=on_conflict)
+
+    @transaction.atomic
+    def create_from_items(self, endpoint, items, fetched_at=None, batch_size=None,
+                          return_objects=True, body_hash='', fetch_duration=None, delta=None,
+                          skip_unchanged=False, etag='', last_modified='', on_conflict=None):
+        """Create :py:class:`Statistic` instances from an iterable of key path, value pairs as
+        generated by :py:func:`_flatten_dict` or :py:func:`gatherstats.streaming.iter_items`.
+        Arguments are as for :py:meth:`.create_from_stats_response`.
+
+        Only one batch of *items* is held in memory at a time. Since a streamed body can only be
+        hashed once it has been read, *body_hash* may be a callable which takes no arguments. It
+        is called once *items* has been exhausted. In that case, *skip_unchanged* has no effect.
+
+        The time spent in each phase of ingest and the numbers of keys and statistics are recorded
+        in any :py:class:`gatherstats.metrics.GatherMetrics` being recorded.
+
         """
         fetched_at = fetched_at if fetched_at is not None else timezone.now()
+        batch_size = (
+            batch_size if batch_size is not None else settings.GATHERSTATS_INGEST_BATCH_SIZE
+        )
+        delta = delta if delta is not None else settings.GATHERSTATS_DELTA_STORAGE
+        on_conflict = (
+            on_conflict if on_conflict is not None else settings.GATHERSTATS_INGEST_ON_CONFLICT
+        )
+        if on_conflict not in CONFLICT_POLICIES:
+            raise ValueError('unknown conflict policy: {!r}'.format(on_conflict))
+
+        connection = connections[self.db]
+        use_copy = _can_copy(connection)
+
+        with metrics.phase('resolve_keys'):
+            endpoint_id = _endpoint_ids.resolve([endpoint], self.db, batch_size)[endpoint]
+
+        # If the policy is to raise an error, creating the snapshot below does so.
+        snapshot = None
+        if on_conflict != ON_CONFLICT_ERROR:
+            snapshot = (
+                Snapshot.objects.db_manager(self.db)
+                .filter(endpoint_id=endpoint_id, fetched_at=fetched_at).first()
+            )
+        if snapshot is not None:
+            return self._merge_items(
+                endpoint, snapshot, items, batch_size, return_objects, body_hash, fetch_duration,
+                etag, last_modified, on_conflict)
+
+        if skip_unchanged and not callable(body_hash):
+            previous_hash, previous_fetched_at = (
+                Endpoint.objects.db_manager(self.db).filter(pk=endpoint_id)
+                .values_list('body_hash', 'last_fetched_at').get()
+            )
+            if (previous_hash == body_hash and previous_fetched_at is not None
+                    and previous_fetched_at <= fetched_at):
+                Snapshot.objects.db_manager(self.db).create_unchanged(
+                    endpoint, fetched_at, fetch_duration=fetch_duration, etag=etag,
+                    last_modified=last_modified)
+                return [] if return_objects else 0
+
+        # If responses are being recorded out of order, the next snapshot may have carried
+        # values forward which this one would otherwise replace.
+        next_snapshot = self._next_snapshot(endpoint_id, fetched_at)
+        if next_snapshot is not None:
+            delta = False
+            _last_values.discard(endpoint_id, self.db)
+
+        if delta:
+            # Unchanged snapshots have no statistics and so are ignored.
+            previous_snapshot_id = (
+                Snapshot.objects.db_manager(self.db)
+                .filter(endpoint_id=endpoint_id, unchanged=False)
+                .order_by('-fetched_at').values_list('pk', flat=True).first()
+            )
+            last_values = (
+                _last_values.get(endpoint_id, previous_snapshot_id, self.db)
+                if previous_snapshot_id is not None else {}
+            )
+            changed_values = {}
+
+        snapshot = Snapshot.objects.db_manager(self.db).create(
+            endpoint_id=endpoint_id, fetched_at=fetched_at, fetch_duration=fetch_duration,
+            delta=delta)
+
+        key_count, created_count = 0, 0
+        for batch in metrics.timed('flatten', _batched(items, batch_size)):
+            key_count += len(batch)
+            with metrics.phase('resolve_keys'):
+                key_ids = _key_ids.resolve([key for key, _ in batch], self.db, batch_size)
+            batch = [(key_ids[key], value) for key, value in batch]
+            observed_values = batch
+            if delta:
+                batch = [
+                    (key_id, value) for key_id, value in batch
+                    if key_id not in last_values or last_values[key_id] != value
+                ]
+                changed_values.update(batch)
+
+            objs = [
+                self.model(
+                    endpoint_id=endpoint_id, key_id=key_id, snapshot_id=snapshot.pk,
+                    numeric_value=value, fetched_at=fetched_at)
+                for key_id, value in batch
+            ]
+            if len(objs) > 0:
+                with metrics.phase('insert'):
+                    if next_snapshot is not None:
+                        self._preserve_carried_values(next_snapshot, batch)
+                    if use_copy:
+                        _copy_objects(connection, self.model, objs)
+                    else:
+                        self.bulk_create(objs, batch_size=batch_size)
+                created_count += len(objs)
+
+            # Latest values and rollups reflect every value observed, including unchanged values
+            # which were not recorded in delta mode.
+            with metrics.phase('derived'):
+                LatestStatistic.objects.db_manager(self.db).record(
+                    endpoint_id, fetched_at, observed_values)
+                StatisticRollup.objects.db_manager(self.db).record(
+                    endpoint_id, fetched_at, observed_values)
+
+        if delta:
+            _last_values.update(endpoint_id, snapshot.pk, last_values, changed_values, self.db)
+
+        snapshot.key_count = key_count
+        snapshot.body_hash = body_hash() if callable(body_hash) else body_hash
+        snapshot.save(update_fields=['key_count', 'body_hash'])
+
+        Endpoint.objects.db_manager(self.db)._record_response(
+            endpoint_id, fetched_at, snapshot.body_hash, etag, last_modified)
+        caching.invalidate_on_commit(endpoint, self.db)
+
+        metrics.increment('keys', key_count)
+        metrics.increment('statistics', created_count)
+
+        if not return_objects:
+            return created_count
+
+        # Not all database backends can return primary keys from a bulk insert and COPY never
+        # does so read back the created rows.
+        return list(snapshot.statistics.select_related('endpoint', 'key', 'snapshot'))
+
+    def _merge_items(self, endpoint, snapshot, items, batch_size, return_objects, body_hash,
+                     fetch_duration, etag, last_modified, on_conflict):
+        """Merge the key path, value pairs *items* from a re-delivered response for the
+        endpoint with URL *endpoint* into the existing :py:class:`Snapshot` *snapshot* according
+        to the conflict policy *on_conflict*. Other arguments are as for
+        :py:meth:`.create_from_items`.
+
+        If *snapshot* only recorded changed values or was unchanged, a key it did not record is
+        treated as existing with the value carried forward from an earlier snapshot as for
+        :py:meth:`.values_at`. Otherwise, where the database supports it, values which already
+        exist are detected by the statement inserting the new ones so that each batch of a
+        skipped re-delivery is written in one round trip. Overwriting a value needs the value it
+        replaces and so these are read first.
+
+        """
+        connection = connections[self.db]
+        endpoint_id, fetched_at = snapshot.endpoint_id, snapshot.fetched_at
+        statistic_fields = ['endpoint', 'key', 'snapshot', 'numeric_value', 'fetched_at']
+        next_snapshot = self._next_snapshot(endpoint_id, fetched_at)
+        read_existing = (
+            snapshot.delta or snapshot.unchanged or on_conflict == ON_CONFLICT_OVERWRITE
+            or next_snapshot is not None or not _can_return(connection))
+
+        if snapshot.unchanged and on_conflict == ON_CONFLICT_SKIP:
+            # The existing snapshot records that there were no new values.
+            metrics.increment('skipped', sum(1 for _ in items))
+            return [] if return_objects else 0
+
+        if on_conflict == ON_CONFLICT_SKIP:
+            conflict_action = 'DO NOTHING'
+        else:
+            conflict_action = 'DO UPDATE SET {numeric_value} = excluded.{numeric_value}'
+
+        key_count, written_count, skipped_count, overwritten_count = 0, 0, 0, 0
+        for batch in metrics.timed('flatten', _batched(items, batch_size)):
+            key_count += len(batch)
+            with metrics.phase('resolve_keys'):
+                key_ids = _key_ids.resolve([key for key, _ in batch], self.db, batch_size)
+            batch = [(key_ids[key], value) for key, value in batch]
+
+            # Only new or changed values are passed on to the latest values and rollups.
+            if read_existing:
+                with metrics.phase('resolve_conflicts'):
+                    batch_key_ids = [key_id for key_id, _ in batch]
+                    if snapshot.delta or snapshot.unchanged:
+                        existing = self._latest_per_key(
+                            fetched_at, key_ids=batch_key_ids, endpoint_id=endpoint_id)
+                    else:
+                        existing = self.filter(
+                            endpoint_id=endpoint_id, fetched_at=fetched_at,
+                            key_id__in=batch_key_ids)
+                    existing_values = dict(existing.values_list('key_id', 'numeric_value'))
+                new_values = [
+                    (key_id, value) for key_id, value in batch if key_id not in existing_values]
+                changes = []
+                if on_conflict == ON_CONFLICT_OVERWRITE:
+                    changes = [
+                        (key_id, existing_values[key_id], value) for key_id, value in batch
+                        if key_id in existing_values and existing_values[key_id] != value
+                    ]
+                written_values = new_values + [(key_id, value) for key_id, _, value in changes]
+
+                with metrics.phase('insert'):
+                    if next_snapshot is not None:
+                        self._preserve_carried_values(next_snapshot, written_values)
+                    row_count = _upsert_rows(
+                        connection, self.model, statistic_fields,
+                        ['endpoint', 'key', 'fetched_at'],
+                        [
+                            (endpoint_id, key_id, snapshot.pk, value, fetched_at)
+                            for key_id, value in written_values
+                        ],
+                        conflict_action)
+            else:
+                with metrics.phase('insert'):
+                    inserted_ids = {
+                        key_id for key_id, in _upsert_rows(
+                            connection, self.model, statistic_fields,
+                            ['endpoint', 'key', 'fetched_at'],
+                            [
+                                (endpoint_id, key_id, snapshot.pk, value, fetched_at)
+                                for key_id, value in batch
+                            ],
+                            conflict_action, returning=['key'])
+                    }
+                new_values = [(key_id, value) for key_id, value in batch if key_id in inserted_ids]
+                changes, written_values, row_count = [], new_values, len(new_values)
+            written_count += row_count
+            skipped_count += len(batch) - row_count
+            overwritten_count += len(changes)
+
+            with metrics.phase('derived'):
+                LatestStatistic.objects.db_manager(self.db).record(
+                    endpoint_id, fetched_at, written_values)
+                rollups = StatisticRollup.objects.db_manager(self.db)
+                rollups.record(endpoint_id, fetched_at, new_values)
+                rollups.record_changes(endpoint_id, fetched_at, changes)
+
+        if overwritten_count > 0 or (next_snapshot is not None and written_count > 0):
+            _last_values.discard(endpoint_id, self.db)
+
+        update_fields = ['key_count']
+        snapshot.key_count = max(snapshot.key_count, key_count)
+        if on_conflict == ON_CONFLICT_OVERWRITE:
+            snapshot.body_hash = body_hash() if callable(body_hash) else body_hash
+            if snapshot.unchanged:
+                # Only the values which differ from those carried forward were recorded.
+                snapshot.unchanged, snapshot.delta = False, True
+            if fetch_duration is not None:
+                snapshot.fetch_duration = fetch_duration
+            update_fields.extend(['body_hash', 'unchanged', 'delta', 'fetch_duration'])
+            Endpoint.objects.db_manager(self.db)._record_response(
+                endpoint_id, fetched_at, snapshot.body_hash, etag, last_modified)
+        snapshot.save(update_fields=update_fields)
+        if written_count > 0:
+            caching.invalidate_on_commit(endpoint, self.db)
+
+        metrics.increment('keys', key_count)
+        metrics.increment('statistics', written_count)
+        metrics.increment('skipped', skipped_count)
+        metrics.increment('overwritten', overwritten_count)
+
+        if not return_objects:
+            return written_count
+        return list(snapshot.statistics.select_related('endpoint', 'key', 'snapshot'))
+
+    def as_matrix(self, endpoint, patterns, start=None, end=None, prefixes=()):
+        """Return a :py:class:`gatherstats.analysis.TimeSeriesMatrix` of the values of the keys
+        matching the glob pattern or list of glob patterns *patterns*, or starting with
+        *prefixes*, fetched from the endpoint with URL *endpoint* at or after *start* and before
+        *end* if not None. Requires NumPy. See :py:func:`gatherstats.analysis.load_matrix`.
+
+        """
+        # Imported here since NumPy is an optional dependency.
+        from gatherstats.analysis import load_matrix
+
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        return caching.get_or_compute(
+            endpoint, 'matrix', [self.db, patterns, prefixes, start, end],
+            lambda: load_matrix(endpoint, patterns, prefixes, start, end, using=self.db))
+
+    def compare(self, endpoint, before, after, patterns=(), prefixes=()):
+        """Return a list of :py:data:`gatherstats.comparison.KeyChange` tuples giving the
+        absolute and relative change in the value of each key from the endpoint with URL
+        *endpoint* between the datetimes *before* and *after*, optionally restricted to the keys
+        matching the glob patterns *patterns* or starting with *prefixes*. See
+        :py:func:`gatherstats.comparison.compare`.
+
+        """
+        # Imported here since the comparison module depends on this one.
+        from gatherstats.comparison import compare
+
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        return caching.get_or_compute(
+            endpoint, 'compare', [self.db, before, after, patterns, prefixes],
+            lambda: compare(endpoint, before, after, patterns, prefixes, using=self.db))
+
+    def compare_with_previous(self, snapshot, patterns=(), prefixes=()):
+        """As :py:meth:`.compare` but compare the values as of the :py:class:`Snapshot`
+        *snapshot* with those as of the previous snapshot of the same endpoint. See
+        :py:func:`gatherstats.comparison.compare_with_previous`.
 
-        created_objects = [
-            Statistic.objects.create(
-                endpoint=endpoint, key=key, numeric_value=value, fetched_at=fetched_at
+        """
+        from gatherstats.comparison import compare_with_previous
+
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        return compare_with_previous(snapshot, patterns, prefixes, using=self.db)
+
+    def values_at(self, endpoint, when):
+        """Return a queryset of the latest :py:class:`Statistic` recorded for each key from the
+        endpoint with URL *endpoint* at or before the datetime *when*. This reconstructs the full
+        set of values as of *when* even if only changed values were recorded, by carrying the
+        last observation of each key forward. Keys which were removed from the response continue
+        to appear with their last recorded value.
+
+        The result is computed in a single query which performs one index lookup per known key.
+
+        """
+        return self._latest_per_key(when, endpoint__url=endpoint)
+
+    def prune(self, before):
+        """Delete statistics fetched before the datetime *before* except for the latest
+        statistic of each key from each endpoint. These are retained so that
+        :py:meth:`.values_at` continues to return every key for times after *before*. Return the
+        number of statistics deleted.
+
+        Statistics are deleted one endpoint and one day at a time so that no single transaction
+        grows too large. Rollups should be computed for the statistics before they are deleted.
+
+        """
+        deleted_count = 0
+        endpoint_ids = Endpoint.objects.db_manager(self.db).values_list('pk', flat=True)
+        for endpoint_id in endpoint_ids:
+            statistics = self.filter(endpoint_id=endpoint_id, fetched_at__lt=before)
+            earliest = statistics.aggregate(earliest=Min('fetched_at'))['earliest']
+            if earliest is None:
+                continue
+
+            retained_ids = (
+                self._latest_per_key(endpoint_id=endpoint_id, fetched_at__lt=before).values('pk'))
+            day_start = StatisticRollup.period_start_for(StatisticRollup.DAY, earliest)
+            while day_start < before:
+                day_end = min(day_start + datetime.timedelta(days=1), before)
+                with transaction.atomic(using=self.db):
+                    count, _ = (
+                        statistics
+                        .filter(fetched_at__gte=day_start, fetched_at__lt=day_end)
+                        .exclude(pk__in=retained_ids)
+                        .delete()
+                    )
+                deleted_count += count
+                day_start = day_end
+
+        if deleted_count > 0:
+            caching.invalidate()
+        return deleted_count
+
+    def _next_snapshot(self, endpoint_id, fetched_at):
+        """Return the first :py:class:`Snapshot` of the endpoint with primary key *endpoint_id*
+        fetched after *fetched_at* or None if there is no such snapshot.
+
+        """
+        return (
+            Snapshot.objects.db_manager(self.db)
+            .filter(endpoint_id=endpoint_id, fetched_at__gt=fetched_at)
+            .order_by('fetched_at').first()
+        )
+
+    def _preserve_carried_values(self, snapshot, values):
+        """Prepare to record the key primary key, value pairs *values* at a time before the
+        :py:class:`Snapshot` *snapshot* and after the snapshot preceding it. If *snapshot* did
+        not record every value, :py:meth:`.values_at` reconstructs the values it did not record
+        from earlier statistics. Those which *values* would change are recorded in *snapshot* so
+        that the values reconstructed for it and later snapshots are unaffected. An unchanged
+        snapshot which records values in this way becomes a delta snapshot. Return the number of
+        statistics created.
+
+        This must be called before *values* are recorded.
+
+        """
+        if not (snapshot.delta or snapshot.unchanged):
+            return 0
+
+        values = dict(values)
+        carried_values = [
+            (key_id, value) for key_id, value, fetched_at in (
+                self._latest_per_key(
+                    snapshot.fetched_at, key_ids=list(values), endpoint_id=snapshot.endpoint_id)
+                .values_list('key_id', 'numeric_value', 'fetched_at')
             )
-            for key, value in _flatten_dict(body)
+            if fetched_at < snapshot.fetched_at and value != values[key_id]
         ]
+        if len(carried_values) == 0:
+            return 0
+
+        if snapshot.unchanged:
+            snapshot.unchanged, snapshot.delta = False, True
+            snapshot.save(update_fields=['unchanged', 'delta'])
+
+        # Rollups already include these values since every value observed is added to them.
+        return _upsert_rows(
+            connections[self.db], self.model,
+            ['endpoint', 'key', 'snapshot', 'numeric_value', 'fetched_at'],
+            ['endpoint', 'key', 'fetched_at'],
+            [
+                (snapshot.endpoint_id, key_id, snapshot.pk, value, snapshot.fetched_at)
+                for key_id, value in carried_values
+            ],
+            'DO NOTHING')
+
+    def _latest_per_key(self, when=None, key_ids=None, **filters):
+        """Return a queryset of the latest :py:class:`Statistic` for each key among those
+        matching the keyword arguments *filters* at or before *when*. If *when* is None, the
+        latest statistics overall are returned. If *key_ids* is not None, only the keys with
+        those primary keys are considered.
+
+        """
+        latest = self.filter(key_id=OuterRef('pk'), **filters)
+        if when is not None:
+            latest = latest.filter(fetched_at__lte=when)
+        latest = latest.order_by('-fetched_at').values('pk')[:1]
+
+        keys = StatisticKey.objects.db_manager(self.db).all()
+        if key_ids is not None:
+            keys = keys.filter(pk__in=key_ids)
+        latest_ids = (
+            keys
+            .annotate(latest_id=Subquery(latest))
+            .filter(latest_id__isnull=False)
+            .values('latest_id')
+        )
+        return self.filter(pk__in=latest_ids)
+
+
+class EndpointManager(models.Manager):
+    """
+    Custom object manager for :py:class:`Endpoint`. Accessed via :py:attr:`Endpoint.objects`.
+    """
+
+    def _record_response(self, endpoint_id, fetched_at, body_hash, etag, last_modified):
+        """Record details of the response fetched at *fetched_at* from the endpoint with primary
+        key *endpoint_id* unless a later response has already been recorded.
+
+        """
+        not_later = (
+            models.Q(last_fetched_at__isnull=True) | models.Q(last_fetched_at__lte=fetched_at))
+        self.filter(not_later, pk=endpoint_id).update(
+            last_fetched_at=fetched_at, body_hash=body_hash, etag=etag,
+            last_modified=last_modified)
+
+
+class Endpoint(models.Model):
+    """
+    A stats endpoint which statistics have been fetched from. Endpoint URLs are stored once here
+    rather than being repeated in every :py:class:`Statistic` row.
+
+    The validators and body hash of the most recent response are recorded so that the endpoint
+    can be fetched conditionally and an unchanged response need not be recorded again.
+
+    """
+    objects = EndpointManager()
+
+    #: URL of the endpoint.
+    url = models.URLField(
+        max_length=1204, unique=True,
+        help_text='URL of endpoint which stats were fetched from')
+
+    #: Date and time when the most recent response was fetched. NULL if the endpoint has not
+    #: been fetched since this field was added.
+    last_fetched_at = models.DateTimeField(
+        null=True, blank=True, help_text='Date and time when most recent response was fetched')
+
+    #: Hash of the key path, value pairs of the most recent response body. See
+    #: :py:class:`_BodyHasher`.
+    body_hash = models.CharField(
+        max_length=64, blank=True,
+        help_text='Hash of the keys and values of the most recent response body')
+
+    #: ETag header of the most recent response, if any.
+    etag = models.CharField(
+        max_length=1024, blank=True, help_text='ETag of most recent response')
+
+    #: Last-Modified header of the most recent response, if any.
+    last_modified = models.CharField(
+        max_length=64, blank=True, help_text='Last-Modified header of most recent response')
+
+    def __str__(self):
+        return self.url
+
+
+#: Prefix of a key path component which introduces a dimension. The following component is the
+#: dimension value. E.g. the "institution" dimension has the value "UIS" in the key path
+#: "asset_counts.by_institution.UIS.total".
+_DIMENSION_PREFIX = 'by_'
 
-        return created_objects
+
+def _split_path(path):
+    """Return a dictionary of the structured parts of the key path *path*. The parts are the
+    depth, parent path, leaf name, dimension and dimension value. If the path has no dimension,
+    the dimension and value are empty. Only the first dimension in a path is recognised. E.g.
+    for "asset_counts.by_institution.UIS.total" the parts are::
+
+        {
+            'depth': 4,
+            'parent': 'asset_counts.by_institution.UIS',
+            'leaf': 'total',
+            'dimension': 'institution',
+            'dimension_value': 'UIS',
+        }
+
+    """
+    components = path.split('.')
+    parts = {
+        'depth': len(components),
+        'parent': '.'.join(components[:-1]),
+        'leaf': components[-1],
+        'dimension': '',
+        'dimension_value': '',
+    }
+    # The dimension value may not be the leaf.
+    for idx, component in enumerate(components[:-2]):
+        if component.startswith(_DIMENSION_PREFIX) and len(component) > len(_DIMENSION_PREFIX):
+            parts['dimension'] = component[len(_DIMENSION_PREFIX):]
+            parts['dimension_value'] = components[idx + 1]
+            break
+    return parts
+
+
+#: Characters with a special meaning in a key path glob pattern.
+_GLOB_CHARACTERS = frozenset('*?')
+
+
+def _glob_regex(pattern):
+    """Return a regular expression matching key paths which match the glob *pattern*. In the
+    pattern, "**" matches any sequence of characters, "*" matches any sequence of characters
+    within one component of the key path and "?" matches one character other than ".". The
+    expression is understood by both Python and PostgreSQL.
+
+    """
+    parts = []
+    for token in re.split(r'(\*\*|\*|\?)', pattern):
+        if token == '**':
+            parts.append('.*')
+        elif token == '*':
+            parts.append('[^.]*')
+        elif token == '?':
+            parts.append('[^.]')
+        else:
+            # Escape every non-alphanumeric character the same way whatever the Python version.
+            parts.append(''.join(c if c.isalnum() else '\\' + c for c in token))
+    return '^' + ''.join(parts) + '$'
+
+
+class StatisticKeyManager(models.Manager):
+    """
+    Custom object manager for :py:class:`StatisticKey`. Accessed via
+    :py:attr:`StatisticKey.objects`.
+    """
+
+    def matching(self, patterns=(), prefixes=()):
+        """Return a queryset of the keys whose path matches any of the glob patterns
+        *patterns* or starts with any of *prefixes*. Patterns without wildcards match a path
+        exactly. See :py:func:`_glob_regex` for the pattern syntax.
+
+        """
+        exact_paths = [p for p in patterns if not _GLOB_CHARACTERS.intersection(p)]
+        condition = models.Q(path__in=exact_paths)
+        for pattern in patterns:
+            if pattern not in exact_paths:
+                condition |= models.Q(path__regex=_glob_regex(pattern))
+        for prefix in prefixes:
+            condition |= models.Q(path__startswith=prefix)
+        return self.filter(condition)
+
+    def dimension_values(self, dimension):
+        """Return a sorted list of the values of the dimension *dimension* which appear in key
+        paths. E.g. ``dimension_values('institution')`` lists institutions.
+
+        """
+        return list(
+            self.filter(dimension=dimension).order_by('dimension_value')
+            .values_list('dimension_value', flat=True).distinct())
+
+    def in_dimension(self, dimension, value=None, leaf=None):
+        """Return a queryset of the keys with dimension *dimension*. If not None, only keys
+        with dimension value *value* or leaf name *leaf* are included. E.g.
+        ``in_dimension('institution', leaf='total')`` selects the total for each institution.
+
+        """
+        qs = self.filter(dimension=dimension)
+        if value is not None:
+            qs = qs.filter(dimension_value=value)
+        if leaf is not None:
+            qs = qs.filter(leaf=leaf)
+        return qs
+
+
+class StatisticKey(models.Model):
+    """
+    A key path which has appeared in a stats endpoint response. Key paths are stored once here
+    rather than being repeated in every :py:class:`Statistic` row.
+
+    """
+    objects = StatisticKeyManager()
+
+    #: Key path for statistic. E.g. "asset_counts.by_institution.UIS.total".
+    path = models.CharField(
+        max_length=512, unique=True,
+        help_text='Dot-separated JavaScript style key path')
+
+    # The remaining fields are derived from the path by _split_path() so that keys can be
+    # selected by index lookups rather than regular expression matches.
+
+    #: Number of components in the path.
+    depth = models.PositiveSmallIntegerField(help_text='Number of components in key path')
+
+    #: Path without its last component. Empty for top-level keys.
+    parent = models.CharField(
+        max_length=512, blank=True, db_index=True, help_text='Key path of parent object')
+
+    #: Last component of the path. E.g. "total".
+    leaf = models.CharField(max_length=512, help_text='Last component of key path')
+
+    #: Dimension named by the first "by_..." component of the path which is followed by a value
+    #: and a leaf. E.g. "institution". Empty if there is no such component.
+    dimension = models.CharField(
+        max_length=512, blank=True, help_text='Dimension, e.g. "institution"')
+
+    #: Value of the dimension. E.g. "UIS". Empty if the path has no dimension.
+    dimension_value = models.CharField(
+        max_length=512, blank=True, help_text='Value of dimension, e.g. an institution')
+
+    class Meta:
+        indexes = [
+            # Per-dimension queries, optionally for one value and one leaf.
+            models.Index(fields=['dimension', 'dimension_value', 'leaf']),
+            # Per-metric queries across all dimensions.
+            models.Index(fields=['leaf']),
+        ]
+
+    @classmethod
+    def for_path(cls, path):
+        """Return an unsaved instance for the key path *path* with the derived fields set."""
+        return cls(path=path, **_split_path(path))
+
+    def save(self, *args, **kwargs):
+        for name, value in _split_path(self.path).items():
+            setattr(self, name, value)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.path
+
+
+class SnapshotManager(models.Manager):
+    """
+    Custom object manager for :py:class:`Snapshot`. Accessed via :py:attr:`Snapshot.objects`.
+    """
+
+    def latest_for_endpoint(self, endpoint):
+        """Return the most recent :py:class:`Snapshot` for the endpoint with URL *endpoint*.
+        Raises :py:exc:`Snapshot.DoesNotExist` if the endpoint has never been fetched.
+
+        """
+        return self.filter(endpoint__url=endpoint).latest()
+
+    @transaction.atomic
+    def create_unchanged(self, endpoint, fetched_at=None, fetch_duration=None, etag='',
+                         last_modified='', on_conflict=None):
+        """Record a fetch of the endpoint with URL *endpoint* whose response was the same as the
+        previous one, either because the server replied "304 Not Modified" or because the body
+        hash matched. An unchanged :py:class:`Snapshot` is created with the key count and body
+        hash of the previous snapshot and no statistics are written. The values as of the
+        previous snapshot are observed again and so are added to the :py:class:`StatisticRollup`
+        rows containing *fetched_at* and the :py:class:`LatestStatistic` rows are marked as
+        fetched at *fetched_at*. Rollups therefore count every fetch whether or not its response
+        changed. The endpoint's validators are updated from *etag* and *last_modified* if given.
+        Returns the new snapshot.
+
+        If *fetched_at* is None, :py:func:`timezone.now` is used.
+
+        If the endpoint already has a snapshot fetched at *fetched_at* and the conflict policy
+        *on_conflict* is ``"skip"`` or ``"overwrite"``, the existing snapshot is returned
+        unmodified. See :py:meth:`StatisticManager.create_from_stats_response`.
+
+        """
+        fetched_at = fetched_at if fetched_at is not None else timezone.now()
+        on_conflict = (
+            on_conflict if on_conflict is not None else settings.GATHERSTATS_INGEST_ON_CONFLICT
+        )
+        if on_conflict not in CONFLICT_POLICIES:
+            raise ValueError('unknown conflict policy: {!r}'.format(on_conflict))
+
+        endpoint_id = _endpoint_ids.resolve(
+            [endpoint], self.db, settings.GATHERSTATS_INGEST_BATCH_SIZE)[endpoint]
+
+        if on_conflict != ON_CONFLICT_ERROR:
+            existing = self.filter(endpoint_id=endpoint_id, fetched_at=fetched_at).first()
+            if existing is not None:
+                return existing
+
+        previous = (
+            self.filter(endpoint_id=endpoint_id, fetched_at__lt=fetched_at)
+            .order_by('-fetched_at').values_list('key_count', 'body_hash').first()
+        )
+        key_count, body_hash = previous if previous is not None else (0, '')
+
+        snapshot = self.create(
+            endpoint_id=endpoint_id, fetched_at=fetched_at, fetch_duration=fetch_duration,
+            key_count=key_count, body_hash=body_hash, unchanged=True)
+
+        if previous is not None:
+            # Values older than the latest full snapshot were not part of the previous response.
+            filters = {'endpoint_id': endpoint_id}
+            lower_bound = (
+                self.filter(
+                    endpoint_id=endpoint_id, fetched_at__lt=fetched_at, unchanged=False,
+                    delta=False)
+                .order_by('-fetched_at').values_list('fetched_at', flat=True).first()
+            )
+            if lower_bound is not None:
+                filters['fetched_at__gte'] = lower_bound
+
+            previous_values = (
+                Statistic.objects.db_manager(self.db)._latest_per_key(fetched_at, **filters)
+                .values_list('key_id', 'numeric_value')
+            )
+            batch_size = settings.GATHERSTATS_INGEST_BATCH_SIZE
+            for batch in _batched(previous_values.iterator(), batch_size):
+                LatestStatistic.objects.db_manager(self.db).record(endpoint_id, fetched_at, batch)
+                StatisticRollup.objects.db_manager(self.db).record(
+                    endpoint_id, fetched_at, batch)
+
+        endpoint_manager = Endpoint.objects.db_manager(self.db)
+        if etag or last_modified:
+            endpoint_manager._record_response(
+                endpoint_id, fetched_at, body_hash, etag, last_modified)
+        else:
+            endpoint_manager.filter(pk=endpoint_id, last_fetched_at__lte=fetched_at).update(
+                last_fetched_at=fetched_at)
+
+        metrics.increment('unchanged')
+        return snapshot
+
+
+class Snapshot(models.Model):
+    """
+    A single fetch of a stats endpoint. All the :py:class:`Statistic` rows created from one
+    response refer to the same snapshot and so listing gather runs, or finding the latest one,
+    only needs to query this table.
+
+    """
+    objects = SnapshotManager()
+
+    #: Endpoint which was fetched.
+    endpoint = models.ForeignKey(
+        Endpoint, on_delete=models.PROTECT, related_name='snapshots', db_index=False,
+        help_text='Endpoint which was fetched')
+
+    #: Date and time when the endpoint was fetched. Matches the fetched_at field of each
+    #: statistic in the snapshot.
+    fetched_at = models.DateTimeField(
+        help_text='Date and time when the endpoint was fetched')
+
+    #: Number of keys in the response.
+    key_count = models.PositiveIntegerField(
+        default=0, help_text='Number of keys in the response')
+
+    #: Hash of the key path, value pairs of the response body. See :py:class:`_BodyHasher`.
+    #: Blank for snapshots which pre-date this field.
+    body_hash = models.CharField(
+        max_length=64, blank=True, help_text='Hash of the keys and values of the response body')
+
+    #: How long fetching the response took, if known.
+    fetch_duration = models.DurationField(
+        null=True, blank=True, help_text='Time taken to fetch the response')
+
+    #: If True, statistics were only recorded for values which changed since the previous
+    #: snapshot and key_count may be larger than the number of statistics in this snapshot.
+    delta = models.BooleanField(
+        default=False, help_text='Only changed values were recorded')
+
+    #: If True, the response was the same as the previous one and no statistics were recorded.
+    unchanged = models.BooleanField(
+        default=False, help_text='Response was unchanged and no statistics were recorded')
+
+    class Meta:
+        get_latest_by = 'fetched_at'
+
+        unique_together = (
+            # An endpoint can only be fetched once at a given time. The corresponding index also
+            # serves "latest snapshot for endpoint" queries.
+            ('endpoint', 'fetched_at'),
+        )
+
+        indexes = [
+            # Listing recent runs across all endpoints.
+            models.Index(fields=['fetched_at']),
+        ]
+
+    def __str__(self):
+        return '{} at {}'.format(self.endpoint, self.fetched_at.isoformat())
 
 
 class Statistic(models.Model):
@@ -95,44 +1274,60 @@ class Statistic(models.Model):
         }
 
     In order to allow this schema to change in the future, we convert this structured table into a
-    series of rows recording the JavaScript-style key path and the value. For example, one row from
-    the above would be created as::
+    series of rows recording the JavaScript-style key path and the value. The endpoint URL and key
+    path are interned in the :py:class:`Endpoint` and :py:class:`StatisticKey` tables. For
+    example, one row from the above would be created as::
 
         from django.utils import timezone
-        from gatherstats.models import Stat
+        from gatherstats.models import Endpoint, Statistic, StatisticKey
 
         Statistic(
-            endpoint='http://iar-backend.invalid/stats',
-            key='asset_counts.by_institution.INSTA.completed',
+            endpoint=Endpoint.objects.get(url='http://iar-backend.invalid/stats'),
+            key=StatisticKey.objects.get(path='asset_counts.by_institution.INSTA.completed'),
             numeric_value=123,
             fetched_at=now(),
         )
 
-    Sufficiently clever SQL can be used to query various things from this DB. For example, to get a
-    list of all institutions with available statistics:
+    Key paths are split into structured parts which are stored alongside the path in
+    :py:class:`StatisticKey` and can be queried using indexes. For example, to get a list of all
+    institutions with available statistics::
+
+        StatisticKey.objects.dimension_values('institution')
+
+    or, in SQL:
 
     .. code:: sql
 
-        SELECT DISTINCT
-            SUBSTRING(key FROM '^by_institution\.([^\.]+)\.[^\.]+$') AS institution
-        FROM
-            gatherstats_statistic
-        WHERE key ~ '^by_institution\.([^\.]+)\.[^\.]+$'
-        ORDER BY
-            institution;
+        SELECT DISTINCT dimension_value AS institution
+        FROM gatherstats_statistickey
+        WHERE dimension = 'institution'
+        ORDER BY institution;
+
+    and to get the totals for each institution::
+
+        Statistic.objects.filter(
+            key__in=StatisticKey.objects.in_dimension('institution', leaf='total'))
 
     """
     objects = StatisticManager()
 
-    #: URL for the endpoint this statistic was fetched from.
-    endpoint = models.URLField(
-        max_length=1204,
-        help_text='URL of endpoint which this stat was fetched from')
+    #: Endpoint this statistic was fetched from. The column is not indexed on its own since it is
+    #: the leading column of the endpoint/key/fetched_at index.
+    endpoint = models.ForeignKey(
+        Endpoint, on_delete=models.PROTECT, related_name='statistics', db_index=False,
+        help_text='Endpoint which this stat was fetched from')
 
-    #: Key path for statistic. E.g. "asset_counts.by_institution.UIS.total".
-    key = models.CharField(
-        max_length=512,
-        help_text='Dot-separated JavaScript style key path')
+    #: Key path for statistic. The column is not indexed on its own since it is the leading
+    #: column of the key/fetched_at index.
+    key = models.ForeignKey(
+        StatisticKey, on_delete=models.PROTECT, related_name='statistics', db_index=False,
+        help_text='Key path of this stat')
+
+    #: Fetch of the endpoint which this statistic was recorded from. The endpoint and fetched_at
+    #: fields are duplicated from the snapshot so that they can be indexed together with key.
+    snapshot = models.ForeignKey(
+        Snapshot, on_delete=models.CASCADE, related_name='statistics',
+        help_text='Fetch which this stat was recorded from')
 
     #: This field is called "numeric_value" to allow for other types to be stored in the future.
     #: When that future comes, this field needs to have null and blank set to True and a custom
@@ -149,13 +1344,361 @@ class Statistic(models.Model):
 
     class Meta:
         unique_together = (
-            # A given endpoint must only have one key value for a given fetched at time.
+            # A given endpoint must only have one key value for a given fetched at time. The
+            # constraint's index also serves queries filtering by endpoint, key and time, the
+            # most common filtering options, and so no separate index is created for them.
             ('endpoint', 'key', 'fetched_at'),
         )
 
         indexes = [
-            # Generate index for endpoint/key/fetched_at combination since these are likely to be
-            # the most common filtering options. More indexes can be created should it become
-            # necessary.
-            models.Index(fields=['endpoint', 'key', 'fetched_at']),
+            # Queries for one key across all endpoints. The value is included so that they can
+            # be answered from the index alone.
+            models.Index(fields=['key', 'fetched_at', 'numeric_value']),
         ]
+
+        # On PostgreSQL, migration 0015 also creates a BRIN index on fetched_at for scans of a
+        # range of time. Statistics are inserted in order of fetch time and so the index is a
+        # small fraction of the size of a B-tree index. It cannot be declared here since other
+        # database backends do not support it. See gatherstats.benchmark.queries for
+        # measurements of these indexes.
+
+
+class LatestStatisticManager(models.Manager):
+    """
+    Custom object manager for :py:class:`LatestStatistic`. Accessed via
+    :py:attr:`LatestStatistic.objects`.
+    """
+
+    def for_endpoint(self, endpoint):
+        """Return a queryset of the latest value of each key fetched from the endpoint with URL
+        *endpoint*. The query is an index lookup whose cost does not depend on the number of
+        times the endpoint has been fetched.
+
+        """
+        return self.filter(endpoint__url=endpoint)
+
+    def record(self, endpoint_id, fetched_at, values):
+        """Record the values observed from the endpoint with primary key *endpoint_id* at
+        *fetched_at* unless a later value has already been recorded for the key. The iterable
+        *values* yields key primary key, value pairs.
+
+        """
+        _upsert_rows(
+            connections[self.db], self.model,
+            ['endpoint', 'key', 'numeric_value', 'fetched_at'], ['endpoint', 'key'],
+            [(endpoint_id, key_id, value, fetched_at) for key_id, value in values],
+            'DO UPDATE SET {numeric_value} = excluded.{numeric_value}, '
+            '{fetched_at} = excluded.{fetched_at} '
+            'WHERE excluded.{fetched_at} >= {table}.{fetched_at}')
+
+
+class LatestStatistic(models.Model):
+    """
+    The most recently fetched value of a key from an endpoint. There is one row for each endpoint
+    and key which is updated as statistics are created so that the current values can be read
+    without searching the history in :py:class:`Statistic`. Keys which have disappeared from an
+    endpoint's response retain the last value fetched.
+
+    """
+    objects = LatestStatisticManager()
+
+    #: Endpoint which the value was fetched from. The column is not indexed on its own since it is
+    #: the leading column of the unique index.
+    endpoint = models.ForeignKey(
+        Endpoint, on_delete=models.PROTECT, related_name='latest_statistics', db_index=False,
+        help_text='Endpoint which this stat was fetched from')
+
+    #: Key path of the value. Latest values are always queried by endpoint and so this column is
+    #: not indexed on its own.
+    key = models.ForeignKey(
+        StatisticKey, on_delete=models.PROTECT, related_name='latest_statistics',
+        db_index=False, help_text='Key path of this stat')
+
+    #: Most recently fetched value.
+    numeric_value = models.FloatField(help_text='Value of numeric statistic')
+
+    #: Date and time when the value was fetched.
+    fetched_at = models.DateTimeField(help_text='Date and time when this value was fetched')
+
+    class Meta:
+        unique_together = (
+            ('endpoint', 'key'),
+        )
+
+    def __str__(self):
+        return '{} {} at {}'.format(self.endpoint, self.key, self.fetched_at.isoformat())
+
+
+class StatisticRollupManager(models.Manager):
+    """
+    Custom object manager for :py:class:`StatisticRollup`. Accessed via
+    :py:attr:`StatisticRollup.objects`.
+    """
+
+    # Fields written by _upsert() in the order values appear in each row.
+    _UPSERT_FIELDS = [
+        'endpoint', 'key', 'period', 'period_start', 'sample_count', 'total', 'minimum',
+        'maximum', 'last_value', 'last_fetched_at',
+    ]
+
+    # Fields identifying a rollup.
+    _CONFLICT_FIELDS = ['endpoint', 'key', 'period', 'period_start']
+
+    def series(self, endpoint, key, period, start=None, end=None):
+        """Return a queryset of the rollups of length *period* for the endpoint with URL
+        *endpoint* and the key path *key* in order of period start. If given, only rollups whose
+        period starts at or after *start* and before *end* are included.
+
+        """
+        qs = self.filter(endpoint__url=endpoint, key__path=key, period=period)
+        if start is not None:
+            qs = qs.filter(period_start__gte=start)
+        if end is not None:
+            qs = qs.filter(period_start__lt=end)
+        return qs.order_by('period_start')
+
+    def record(self, endpoint_id, fetched_at, values):
+        """Add the values observed from the endpoint with primary key *endpoint_id* at
+        *fetched_at* to the rollup for each period in the ``GATHERSTATS_ROLLUP_PERIODS`` setting
+        which contains *fetched_at*. The iterable *values* yields key primary key, value pairs.
+
+        """
+        values = [(key_id, float(value)) for key_id, value in values]
+        for period in settings.GATHERSTATS_ROLLUP_PERIODS:
+            period_start = StatisticRollup.period_start_for(period, fetched_at)
+            self._upsert([
+                (endpoint_id, key_id, period, period_start, 1, value, value, value, value,
+                 fetched_at)
+                for key_id, value in values
+            ], merge=True)
+
+    def record_changes(self, endpoint_id, fetched_at, changes):
+        """Adjust the rollups containing *fetched_at* for values observed from the endpoint with
+        primary key *endpoint_id* at *fetched_at* which have been replaced. The iterable
+        *changes* yields key primary key, old value, new value tuples. The sum and last value
+        are corrected and the minimum and maximum extended to include the new value but not
+        narrowed to exclude the old one.
+
+        """
+        changes = [(key_id, float(old), float(new)) for key_id, old, new in changes]
+        for period in settings.GATHERSTATS_ROLLUP_PERIODS:
+            period_start = StatisticRollup.period_start_for(period, fetched_at)
+            self._upsert([
+                (endpoint_id, key_id, period, period_start, 0, new - old, new, new, new,
+                 fetched_at)
+                for key_id, old, new in changes
+            ], merge=True)
+
+    @transaction.atomic
+    def rebuild(self, start, end, replace=False):
+        """Compute rollups from the :py:class:`Statistic` rows fetched at or after *start* and
+        before *end* for each period in the ``GATHERSTATS_ROLLUP_PERIODS`` setting. Both *start*
+        and *end* should fall on the boundary of the longest period. Return the number of
+        rollups computed.
+
+        Existing rollups were usually maintained as statistics were created and, for snapshots
+        which only recorded changed values or were unchanged, summarise more observations than
+        can be recovered from the statistics. They are therefore left alone unless *replace* is
+        True.
+
+        """
+        statistics = (
+            Statistic.objects.db_manager(self.db)
+            .filter(fetched_at__gte=start, fetched_at__lt=end)
+        )
+
+        rollup_count = 0
+        for period in settings.GATHERSTATS_ROLLUP_PERIODS:
+            trunc = StatisticRollup.TRUNCATE_FUNCTIONS[period]
+            rows = (
+                statistics
+                .annotate(period_start=trunc('fetched_at', tzinfo=datetime.timezone.utc))
+                .order_by()
+                .values('endpoint_id', 'key_id', 'period_start')
+                .annotate(
+                    sample_count=Count('pk'), total=Sum('numeric_value'),
+                    minimum=Min('numeric_value'), maximum=Max('numeric_value'),
+                    last_fetched_at=Max('fetched_at'))
+                .values_list(
+                    'endpoint_id', 'key_id', 'period_start', 'sample_count', 'total',
+                    'minimum', 'maximum', 'last_fetched_at')
+            )
+
+            # The last value cannot be computed by the aggregate query and so a placeholder is
+            # written and subsequently replaced.
+            batch_size = settings.GATHERSTATS_INGEST_BATCH_SIZE
+            for batch in _batched(rows.iterator(), batch_size):
+                self._upsert([
+                    (endpoint_id, key_id, period, period_start, sample_count, total, minimum,
+                     maximum, maximum, last_fetched_at)
+                    for (endpoint_id, key_id, period_start, sample_count, total, minimum,
+                         maximum, last_fetched_at) in batch
+                ], merge=False, replace=replace)
+                rollup_count += len(batch)
+
+            self._update_last_values(period, start, end)
+
+        caching.invalidate_on_commit(using=self.db)
+        return rollup_count
+
+    def _upsert(self, rows, merge, replace=True):
+        """Insert rollups given as tuples of values for the fields in _UPSERT_FIELDS. If a
+        rollup already exists and *merge* is True, the new row is combined with the existing
+        one. Otherwise, the new row replaces the existing one if *replace* is True and is
+        discarded if not.
+
+        """
+        if merge:
+            newer = 'excluded.{last_fetched_at} >= {table}.{last_fetched_at}'
+            on_conflict = 'DO UPDATE SET ' + ', '.join([
+                '{sample_count} = {table}.{sample_count} + excluded.{sample_count}',
+                '{total} = {table}.{total} + excluded.{total}',
+                '{minimum} = CASE WHEN excluded.{minimum} < {table}.{minimum} '
+                'THEN excluded.{minimum} ELSE {table}.{minimum} END',
+                '{maximum} = CASE WHEN excluded.{maximum} > {table}.{maximum} '
+                'THEN excluded.{maximum} ELSE {table}.{maximum} END',
+                '{last_value} = CASE WHEN ' + newer +
+                ' THEN excluded.{last_value} ELSE {table}.{last_value} END',
+                '{last_fetched_at} = CASE WHEN ' + newer +
+                ' THEN excluded.{last_fetched_at} ELSE {table}.{last_fetched_at} END',
+            ])
+        elif replace:
+            on_conflict = 'DO UPDATE SET ' + ', '.join(
+                '{{{0}}} = excluded.{{{0}}}'.format(name)
+                for name in self._UPSERT_FIELDS if name not in self._CONFLICT_FIELDS
+            )
+        else:
+            on_conflict = 'DO NOTHING'
+
+        _upsert_rows(
+            connections[self.db], self.model, self._UPSERT_FIELDS, self._CONFLICT_FIELDS, rows,
+            on_conflict)
+
+    def _update_last_values(self, period, start, end):
+        """Set the last value of rollups of length *period* starting at or after *start* and
+        before *end* from the statistic fetched at their last fetched at time.
+
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        rollup_opts, statistic_opts = self.model._meta, Statistic._meta
+
+        def rollup_column(name):
+            return qn(rollup_opts.get_field(name).column)
+
+        def statistic_column(name):
+            return qn(statistic_opts.get_field(name).column)
+
+        last_value = (
+            'SELECT s.{value} FROM {statistic} s WHERE s.{endpoint} = {rollup}.{r_endpoint} '
+            'AND s.{key} = {rollup}.{r_key} AND s.{fetched_at} = {rollup}.{last_fetched_at}'
+        ).format(
+            value=statistic_column('numeric_value'), statistic=qn(statistic_opts.db_table),
+            endpoint=statistic_column('endpoint'), key=statistic_column('key'),
+            fetched_at=statistic_column('fetched_at'), rollup=qn(rollup_opts.db_table),
+            r_endpoint=rollup_column('endpoint'), r_key=rollup_column('key'),
+            last_fetched_at=rollup_column('last_fetched_at'))
+
+        # In delta mode, the last observation of a rollup maintained during ingest need not
+        # have been recorded as a statistic.
+        sql = (
+            'UPDATE {rollup} SET {last_value} = ({subquery}) WHERE {period} = %s '
+            'AND {period_start} >= %s AND {period_start} < %s AND EXISTS ({subquery})'
+        ).format(
+            rollup=qn(rollup_opts.db_table), last_value=rollup_column('last_value'),
+            subquery=last_value, period=rollup_column('period'),
+            period_start=rollup_column('period_start'))
+
+        period_start_field = rollup_opts.get_field('period_start')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [
+                period,
+                period_start_field.get_db_prep_save(start, connection),
+                period_start_field.get_db_prep_save(end, connection),
+            ])
+
+
+class StatisticRollup(models.Model):
+    """
+    A summary of the statistics fetched from one endpoint for one key over an hour or a day. The
+    periods are aligned to UTC. Charts and reports covering long periods of time can read
+    rollups rather than every individual :py:class:`Statistic`.
+
+    Rollups are updated as statistics are created and may be computed from existing statistics
+    by the compactstats management command. That command may also delete old statistics leaving
+    only their rollups.
+
+    """
+    HOUR = 'hour'
+    DAY = 'day'
+
+    PERIOD_CHOICES = ((HOUR, 'Hour'), (DAY, 'Day'))
+
+    #: Database functions truncating a datetime to the start of each period.
+    TRUNCATE_FUNCTIONS = {HOUR: TruncHour, DAY: TruncDay}
+
+    objects = StatisticRollupManager()
+
+    #: Endpoint which statistics were fetched from. The column is not indexed on its own since it
+    #: is the leading column of the unique index.
+    endpoint = models.ForeignKey(
+        Endpoint, on_delete=models.PROTECT, related_name='rollups', db_index=False,
+        help_text='Endpoint which the stats were fetched from')
+
+    #: Key path of the statistics. Rollups are always queried by endpoint and key together and so
+    #: this column is not indexed on its own.
+    key = models.ForeignKey(
+        StatisticKey, on_delete=models.PROTECT, related_name='rollups', db_index=False,
+        help_text='Key path of the stats')
+
+    #: Length of the period summarised.
+    period = models.CharField(
+        max_length=8, choices=PERIOD_CHOICES, help_text='Length of period summarised')
+
+    #: Start of the period summarised.
+    period_start = models.DateTimeField(help_text='Start of period summarised')
+
+    #: Number of values observed in the period.
+    sample_count = models.PositiveIntegerField(help_text='Number of values observed')
+
+    #: Sum of the values observed in the period. Storing the sum rather than the mean allows
+    #: rollups to be updated incrementally.
+    total = models.FloatField(help_text='Sum of values observed')
+
+    #: Smallest value observed in the period.
+    minimum = models.FloatField(help_text='Smallest value observed')
+
+    #: Largest value observed in the period.
+    maximum = models.FloatField(help_text='Largest value observed')
+
+    #: Most recent value observed in the period.
+    last_value = models.FloatField(help_text='Most recent value observed')
+
+    #: Date and time when the most recent value in the period was fetched.
+    last_fetched_at = models.DateTimeField(
+        help_text='Date and time when the most recent value was fetched')
+
+    class Meta:
+        unique_together = (
+            # The corresponding index also serves time series queries for an endpoint and key.
+            ('endpoint', 'key', 'period', 'period_start'),
+        )
+
+    @property
+    def mean(self):
+        """Mean of the values observed in the period."""
+        return self.total / self.sample_count
+
+    @classmethod
+    def period_start_for(cls, period, when):
+        """Return the start of the period of length *period* containing the datetime *when*."""
+        when = when.astimezone(datetime.timezone.utc)
+        if period == cls.HOUR:
+            return when.replace(minute=0, second=0, microsecond=0)
+        if period == cls.DAY:
+            return when.replace(hour=0, minute=0, second=0, microsecond=0)
+        raise ValueError('unknown period: {!r}'.format(period))
+
+    def __str__(self):
+        return '{} {} {} from {}'.format(
+            self.endpoint, self.key, self.period, self.period_start.isoformat())
@@ -0,0 +1,246 @@
+"""
+Optional range partitioning of the :py:class:`~gatherstats.models.Statistic` table by fetch time
+on PostgreSQL 11 or later.
+
+A partitioned statistic table is split into one partition per month (or per day) of fetch time
+together with a default partition which receives any statistic not covered by another partition.
+Queries bounded by fetch time only read the partitions which overlap the bounds and old
+statistics can be removed by detaching or dropping whole partitions rather than by deleting rows.
+
+Partitioning is opt-in. An existing statistic table is converted with
+:py:func:`convert` and partitions must subsequently be created ahead of time with
+:py:func:`create_partitions`. The partitionstats management command does both. Other database
+backends continue to use an ordinary table.
+
+Since PostgreSQL requires the primary key and unique constraints of a partitioned table to
+include the partitioning column, the primary key of a partitioned statistic table is the
+combination of id and fetched_at. Ids remain unique since they are taken from a sequence.
+
+"""
+import datetime
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import dateparse
+
+from gatherstats import caching
+from gatherstats.models import Statistic
+
+#: Supported lengths of partition.
+INTERVALS = ('day', 'month')
+
+
+def is_supported(using=DEFAULT_DB_ALIAS):
+    """Return True if the database supports partitioning the statistic table."""
+    connection = connections[using]
+    return connection.vendor == 'postgresql' and connection.pg_version >= 110000
+
+
+def is_partitioned(using=DEFAULT_DB_ALIAS):
+    """Return True if the statistic table is partitioned."""
+    if connections[using].vendor != 'postgresql':
+        return False
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT COUNT(*) FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)',
+            [_table()])
+        count, = cursor.fetchone()
+    return count > 0
+
+
+def partition_start(when, interval):
+    """Return the start of the partition of length *interval* containing the datetime *when*.
+    Partitions are aligned to UTC.
+
+    """
+    when = when.astimezone(datetime.timezone.utc)
+    if interval == 'day':
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'month':
+        return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError('unknown partition interval: {!r}'.format(interval))
+
+
+def next_partition_start(start, interval):
+    """Return the start of the partition following the one starting at *start*."""
+    if interval == 'day':
+        return start + datetime.timedelta(days=1)
+    if interval == 'month':
+        return (start + datetime.timedelta(days=32)).replace(day=1)
+    raise ValueError('unknown partition interval: {!r}'.format(interval))
+
+
+def partition_name(start, interval):
+    """Return the table name of the partition of length *interval* starting at *start*. E.g.
+    "gatherstats_statistic_p2018_01" for the month of January 2018.
+
+    """
+    if interval == 'day':
+        suffix = start.strftime('%Y_%m_%d')
+    elif interval == 'month':
+        suffix = start.strftime('%Y_%m')
+    else:
+        raise ValueError('unknown partition interval: {!r}'.format(interval))
+    return '{}_p{}'.format(_table(), suffix)
+
+
+def list_partitions(using=DEFAULT_DB_ALIAS):
+    """Return a list of name, start, end tuples for the partitions of the statistic table in
+    order of start. The default partition is not included.
+
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) '
+            'FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = to_regclass(%s)', [_table()])
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        match = re.match(r"^FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)$", bound)
+        if match is not None:
+            start, end = (dateparse.parse_datetime(value) for value in match.groups())
+            partitions.append((name, start, end))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partitions(start, end, interval, using=DEFAULT_DB_ALIAS):
+    """Create any missing partitions of length *interval* covering the range from the datetime
+    *start* to the datetime *end*. Return a list of the names of the partitions created.
+
+    Any statistics for the new partitions' ranges are moved out of the default partition.
+
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    existing = {name for name, _, _ in list_partitions(using)}
+
+    created = []
+    partition = partition_start(start, interval)
+    while partition < end:
+        following = next_partition_start(partition, interval)
+        name = partition_name(partition, interval)
+        if name not in existing:
+            with transaction.atomic(using=using), connection.cursor() as cursor:
+                _create_partition(cursor, qn, name, partition, following)
+            created.append(name)
+        partition = following
+    return created
+
+
+def detach_partitions(before, drop=False, using=DEFAULT_DB_ALIAS):
+    """Detach the partitions of the statistic table which only contain statistics fetched before
+    the datetime *before*. If *drop* is True, the detached tables are dropped. Otherwise they are
+    left as ordinary tables which may be archived. Return a list of the names of the partitions
+    detached.
+
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    detached = []
+    for name, _, end in list_partitions(using):
+        if end > before:
+            continue
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(qn(_table()), qn(name)))
+            if drop:
+                cursor.execute('DROP TABLE {}'.format(qn(name)))
+        detached.append(name)
+
+    if len(detached) > 0:
+        caching.invalidate()
+    return detached
+
+
+def convert(interval, ahead_until, using=DEFAULT_DB_ALIAS):
+    """Convert an ordinary statistic table into a partitioned one, creating partitions of length
+    *interval* from the earliest statistic up to the datetime *ahead_until*. All statistics are
+    copied into the new table, the original table is dropped and its indexes and constraints
+    re-created on the new one. This is done in one transaction which holds an exclusive lock on
+    the statistic table throughout and so gathering must be stopped while converting a large
+    table.
+
+    Raises :py:exc:`ValueError` if the table has a unique constraint which does not include
+    fetched_at since such constraints are not possible on a partitioned table.
+
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = _table()
+    old_table = table + '_unpartitioned'
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        # Record the constraints and indexes of the existing table so that they can be re-created
+        # with the same names.
+        cursor.execute(
+            'SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint '
+            'WHERE conrelid = %s::regclass ORDER BY contype, conname', [table])
+        constraints = cursor.fetchall()
+        cursor.execute(
+            'SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index '
+            'WHERE indrelid = %s::regclass AND indexrelid NOT IN ('
+            '    SELECT conindid FROM pg_constraint WHERE conrelid = %s::regclass'
+            ') ORDER BY 1', [table, table])
+        indexes = cursor.fetchall()
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        sequence, = cursor.fetchone()
+        cursor.execute('SELECT MIN(fetched_at) FROM {}'.format(qn(table)))
+        earliest, = cursor.fetchone()
+
+        for name, kind, definition in constraints:
+            if kind == 'u' and 'fetched_at' not in definition:
+                raise ValueError(
+                    'Unique constraint {} does not include fetched_at'.format(name))
+
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(qn(table), qn(old_table)))
+        cursor.execute(
+            'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE (fetched_at)'
+            .format(qn(table), qn(old_table)))
+        cursor.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(
+            qn(table + '_default'), qn(table)))
+
+        partition = partition_start(
+            earliest if earliest is not None else ahead_until, interval)
+        while partition < ahead_until:
+            following = next_partition_start(partition, interval)
+            _create_partition(
+                cursor, qn, partition_name(partition, interval), partition, following)
+            partition = following
+
+        cursor.execute('INSERT INTO {} SELECT * FROM {}'.format(qn(table), qn(old_table)))
+        if sequence is not None:
+            cursor.execute('ALTER SEQUENCE {} OWNED BY {}.id'.format(sequence, qn(table)))
+        cursor.execute('DROP TABLE {}'.format(qn(old_table)))
+
+        # Indexes are created after the data has been copied since that is faster.
+        for name, kind, definition in constraints:
+            if kind == 'p':
+                definition = 'PRIMARY KEY (id, fetched_at)'
+            cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(
+                qn(table), qn(name), definition))
+        for name, definition in indexes:
+            cursor.execute(definition)
+
+
+def _create_partition(cursor, qn, name, start, end):
+    """Create the partition *name* for statistics fetched from *start* up to *end*. Any such
+    statistics in the default partition are moved to the new partition.
+
+    """
+    table, default = _table(), _table() + '_default'
+    cursor.execute('CREATE TEMPORARY TABLE gatherstats_moved ON COMMIT DROP AS '
+                   'SELECT * FROM {} WHERE fetched_at >= %s AND fetched_at < %s'
+                   .format(qn(default)), [start, end])
+    cursor.execute('DELETE FROM {} WHERE fetched_at >= %s AND fetched_at < %s'.format(
+        qn(default)), [start, end])
+    # Before PostgreSQL 12, partition bounds must be literals rather than parameters.
+    cursor.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+        qn(name), qn(table), start.isoformat(), end.isoformat()))
+    cursor.execute('INSERT INTO {} SELECT * FROM gatherstats_moved'.format(qn(table)))
+    cursor.execute('DROP TABLE gatherstats_moved')
+
+
+def _table():
+    return Statistic._meta.db_table
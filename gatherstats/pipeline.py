@@ -0,0 +1,172 @@
+"""
+A producer/consumer pipeline which overlaps fetching, flattening and writing responses.
+
+A :py:class:`Pipeline` runs three stages connected by bounded queues:
+
+1. A pool of fetcher threads, each taking the next task and fetching it.
+2. A pool of flatten workers, each preparing a fetched response for writing, for example by
+   flattening it into key path, value pairs.
+3. A single writer, the thread iterating over :py:meth:`Pipeline.run`, writing each prepared
+   response to the database. Since all writes are made from one thread, they share its database
+   connection.
+
+While one response is being written, the next ones are being flattened and fetched. The queues
+hold at most a fixed number of responses and so, if the database is slower than the network,
+fetchers block once the queues are full rather than holding every response in memory. Tasks are
+taken from the iterable given to :py:meth:`Pipeline.run` lazily and so it may be long or
+generated on demand.
+
+An exception raised by a stage for one task is recorded as the result of that task and the task
+skips the later stages. Other tasks continue. If the writer stops early, for example because the
+caller stops iterating or a :py:exc:`KeyboardInterrupt` is raised, or if iterating over the tasks
+raises an exception, the other stages are asked to stop, every thread is joined and any exception
+is re-raised.
+
+The flatten workers are threads and so flattening only runs in parallel with fetching and writing
+while those wait on the network or database. That is where a gather spends most of its time.
+
+"""
+import collections
+import queue
+import threading
+
+#: The result of one task. *value* is the value returned by the write stage and *error* is None
+#: if the task succeeded or the exception raised by the stage which failed.
+PipelineResult = collections.namedtuple('PipelineResult', 'task value error')
+
+# Marks the end of a queue.
+_DONE = object()
+
+# Seconds for which a blocked stage waits before checking whether the pipeline is stopping.
+_POLL_INTERVAL = 0.1
+
+
+class Pipeline:
+    """
+    A pipeline calling *fetch* with each task from *fetcher_count* threads, calling *flatten*
+    with each task and the value returned by *fetch* from *flatten_count* threads and calling
+    *write* with each task and the value returned by *flatten* from the thread iterating over
+    :py:meth:`.run`. At most *queue_size* fetched responses wait to be flattened and at most
+    *queue_size* flattened responses wait to be written.
+
+    """
+    def __init__(self, fetch, flatten, write, fetcher_count=1, flatten_count=1, queue_size=4):
+        if fetcher_count < 1 or flatten_count < 1 or queue_size < 1:
+            raise ValueError('Numbers of threads and queue size must be at least 1')
+        self.fetch, self.flatten, self.write = fetch, flatten, write
+        self.fetcher_count, self.flatten_count = fetcher_count, flatten_count
+        self.queue_size = queue_size
+
+    def run(self, tasks):
+        """A generator which runs each of the iterable *tasks* through the pipeline and yields a
+        :py:data:`PipelineResult` for each as it is written. The pipeline is stopped if the
+        generator is closed before it is exhausted.
+
+        """
+        fetched = queue.Queue(maxsize=self.queue_size)
+        flattened = queue.Queue(maxsize=self.queue_size)
+        stopping = threading.Event()
+        tasks = iter(tasks)
+        tasks_lock = threading.Lock()
+        errors = []
+
+        def next_task():
+            with tasks_lock:
+                return next(tasks, _DONE)
+
+        def fetcher():
+            while not stopping.is_set():
+                task = next_task()
+                if task is _DONE:
+                    break
+                _put(fetched, _call(self.fetch, task), stopping)
+
+        def flattener():
+            while True:
+                item = _get(fetched, stopping)
+                if item is _DONE:
+                    break
+                task, value, error = item
+                if error is None:
+                    item = _call(self.flatten, task, value)
+                _put(flattened, item, stopping)
+
+        def guarded(target, remaining, downstream, count):
+            # Once the last thread of a stage finishes, the next stage is told there is no more
+            # input. Unexpected errors stop the whole pipeline.
+            try:
+                target()
+            except BaseException as e:
+                errors.append(e)
+                stopping.set()
+            finally:
+                with remaining['lock']:
+                    remaining['count'] -= 1
+                    last = remaining['count'] == 0
+                if last:
+                    for _ in range(count):
+                        _put(downstream, _DONE, stopping)
+
+        fetchers_remaining = {'lock': threading.Lock(), 'count': self.fetcher_count}
+        flatteners_remaining = {'lock': threading.Lock(), 'count': self.flatten_count}
+        threads = [
+            threading.Thread(
+                target=guarded, args=(fetcher, fetchers_remaining, fetched, self.flatten_count),
+                name='gatherstats-fetch-{}'.format(idx), daemon=True)
+            for idx in range(self.fetcher_count)
+        ] + [
+            threading.Thread(
+                target=guarded, args=(flattener, flatteners_remaining, flattened, 1),
+                name='gatherstats-flatten-{}'.format(idx), daemon=True)
+            for idx in range(self.flatten_count)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = _get(flattened, stopping)
+                if item is _DONE:
+                    break
+                task, value, error = item
+                if error is None:
+                    task, value, error = _call(self.write, task, value)
+                yield PipelineResult(task, value, error)
+        finally:
+            stopping.set()
+            for thread in threads:
+                thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+
+def _call(func, task, *args):
+    """Return a task, value, error tuple from calling *func* with *task* and *args*."""
+    try:
+        return task, func(task, *args), None
+    except Exception as e:
+        return task, None, e
+
+
+def _put(q, item, stopping):
+    """Put *item* on the queue *q*, blocking while it is full unless *stopping* is set."""
+    while not stopping.is_set():
+        try:
+            q.put(item, timeout=_POLL_INTERVAL)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(q, stopping):
+    """Return the next item from the queue *q*, blocking while it is empty. Return
+    :py:data:`_DONE` if *stopping* is set.
+
+    """
+    while not stopping.is_set():
+        try:
+            return q.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _DONE
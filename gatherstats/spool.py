@@ -0,0 +1,148 @@
+"""
+A local on-disk spool of fetched responses waiting to be written to the database.
+
+When gathering with a spool, each fetched response is appended to the spool, together with its
+real fetch time, before any attempt is made to write it to the database. :py:meth:`Spool.flush`
+then drains the spool into the database. If the database is slow or unavailable, responses
+remain in the spool and are written by a later flush and so no fetches are lost.
+
+The spool is a directory containing one journal entry file per response. Entries are written to
+a temporary file which is renamed into place once complete and so a partially written entry is
+never read. Entry file names start with the fetch time and so sort in order of fetch time.
+Entries are flushed in that order and each is deleted once the transaction writing it has
+committed.
+
+Flushing is idempotent: entries are written with the "skip" conflict policy and so an entry
+which has already been written, e.g. by a flush which was interrupted before deleting the entry,
+writes nothing, not even to the rollups, and is simply deleted. This holds with delta storage
+too. Entries which cannot be written for reasons other than the
+database being unavailable are moved to the "failed" sub-directory so that they do not block the
+spool.
+
+"""
+import collections
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError
+from django.utils import dateparse
+
+from gatherstats.models import ON_CONFLICT_SKIP, Snapshot, Statistic
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+#: Result of :py:meth:`Spool.flush`. The numbers of entries written to the database, moved to
+#: the failed directory and remaining in the spool and the error which stopped the flush or None
+#: if the spool was drained.
+FlushResult = collections.namedtuple('FlushResult', 'flushed failed remaining error')
+
+
+class Spool:
+    """
+    A spool of fetched responses in the directory *directory*, which is created if necessary.
+
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.failed_directory = os.path.join(directory, 'failed')
+        os.makedirs(self.failed_directory, exist_ok=True)
+
+    def append(self, endpoint, body, fetched_at, fetch_duration=None, etag='', last_modified=''):
+        """Append a response from the endpoint with URL *endpoint* fetched at the datetime
+        *fetched_at*. The *body* is the parsed response body or None if the server replied "304
+        Not Modified". Other arguments are as for
+        :py:meth:`~gatherstats.models.StatisticManager.create_from_stats_response`. The entry is
+        on disk when this method returns. Return the path of the entry.
+
+        """
+        entry = {
+            'endpoint': endpoint,
+            'fetched_at': fetched_at.isoformat(),
+            'fetch_duration': (
+                fetch_duration.total_seconds() if fetch_duration is not None else None),
+            'etag': etag,
+            'last_modified': last_modified,
+            'body': body,
+        }
+        name = '{:020d}-{}.json'.format((fetched_at - _EPOCH) // _MICROSECOND, uuid.uuid4().hex)
+        path = os.path.join(self.directory, name)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fobj:
+                json.dump(entry, fobj)
+                fobj.flush()
+                os.fsync(fobj.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return path
+
+    def entries(self):
+        """Return a list of the paths of the entries in the spool in order of fetch time."""
+        return [
+            os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+            if name.endswith('.json') and not name.startswith('.')
+        ]
+
+    def __len__(self):
+        return len(self.entries())
+
+    def flush(self):
+        """Write the entries in the spool to the database in order of fetch time, deleting each
+        once written. Stop at the first entry which cannot be written because the database is
+        unavailable, leaving it and later entries in the spool. Return a :py:data:`FlushResult`.
+
+        """
+        entries = self.entries()
+        flushed, failed = 0, 0
+        for index, path in enumerate(entries):
+            try:
+                _write_entry(path)
+            except FileNotFoundError:
+                # Another flush wrote the entry.
+                continue
+            except (OperationalError, InterfaceError) as e:
+                return FlushResult(flushed, failed, len(entries) - index, e)
+            except Exception:
+                shutil.move(path, os.path.join(self.failed_directory, os.path.basename(path)))
+                failed += 1
+                continue
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            flushed += 1
+
+        return FlushResult(flushed, failed, 0, None)
+
+
+def _write_entry(path):
+    """Write the spool entry at *path* to the database unless it has already been written."""
+    with open(path) as fobj:
+        entry = json.load(fobj)
+
+    fetched_at = dateparse.parse_datetime(entry['fetched_at'])
+    fetch_duration = (
+        datetime.timedelta(seconds=entry['fetch_duration'])
+        if entry['fetch_duration'] is not None else None
+    )
+
+    if entry['body'] is None:
+        Snapshot.objects.create_unchanged(
+            entry['endpoint'], fetched_at, fetch_duration=fetch_duration, etag=entry['etag'],
+            last_modified=entry['last_modified'], on_conflict=ON_CONFLICT_SKIP)
+    else:
+        Statistic.objects.create_from_stats_response(
+            endpoint=entry['endpoint'], body=entry['body'], fetched_at=fetched_at,
+            return_objects=False, fetch_duration=fetch_duration,
+            skip_unchanged=settings.GATHERSTATS_SKIP_UNCHANGED, etag=entry['etag'],
+            last_modified=entry['last_modified'], on_conflict=ON_CONFLICT_SKIP)
@@ -0,0 +1,79 @@
+"""
+Incremental parsing of stats endpoint response bodies. Rather than loading a whole response into
+memory and flattening it with :py:func:`gatherstats.models._flatten_dict`, the functions in this
+module parse a body as it is read and generate the same key path, value pairs one at a time.
+
+"""
+import ijson
+
+
+class CountingReader:
+    """
+    Wrap a binary file-like object *fileobj* and count the bytes read from it.
+
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+        #: Number of bytes read so far.
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def iter_items(fileobj):
+    """A generator which incrementally parses a JSON object from the binary file-like object
+    *fileobj* and yields the same key path, value pairs as
+    :py:func:`gatherstats.models._flatten_dict` would for the parsed object. Pairs are generated
+    in document order rather than breadth first.
+
+    Arrays are not flattened and are yielded as values in the same way as
+    :py:func:`~gatherstats.models._flatten_dict`. Only the array being parsed is held in memory.
+
+    Raises :py:exc:`TypeError` if the body is not a JSON object.
+
+    """
+    events = ijson.parse(fileobj, use_float=True)
+
+    _, event, _ = next(events, (None, None, None))
+    if event != 'start_map':
+        raise TypeError('iter_items() must be passed a JSON object')
+
+    # Stack of key path prefixes for the enclosing objects.
+    prefixes = ['']
+    key = None
+    for _, event, value in events:
+        if event == 'map_key':
+            key = value
+        elif event == 'start_map':
+            prefixes.append(prefixes[-1] + key + '.')
+        elif event == 'end_map':
+            prefixes.pop()
+        elif event == 'start_array':
+            yield prefixes[-1] + key, _build_array(events)
+        else:
+            yield prefixes[-1] + key, value
+
+
+def _build_array(events):
+    """Consume events from *events* up to and including the end of an array whose start_array
+    event has already been consumed. Return the array.
+
+    """
+    builder = ijson.ObjectBuilder()
+    builder.event('start_array', None)
+
+    depth = 1
+    for _, event, value in events:
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                break
+
+    return builder.value
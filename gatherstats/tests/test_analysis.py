@@ -0,0 +1,112 @@
+"""
+Test loading statistics into NumPy arrays.
+
+"""
+import datetime
+import unittest
+import unittest.mock as mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from gatherstats.models import Statistic
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HOUR = datetime.timedelta(hours=1)
+
+
+@unittest.skipUnless(numpy is not None, 'NumPy is not installed')
+class MatrixTests(TestCase):
+    def setUp(self):
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        self.bodies = [
+            {'by_institution': {
+                'INSTA': {'total': 10, 'completed': 5},
+                'INSTB': {'total': 4, 'completed': 1},
+            }},
+            {'by_institution': {
+                'INSTA': {'total': 20, 'completed': 5},
+                'INSTB': {'total': 0, 'completed': 0},
+            }},
+            {'by_institution': {
+                'INSTA': {'total': 20, 'completed': 15},
+                'INSTC': {'total': 2, 'completed': 2},
+            }},
+        ]
+        for idx, body in enumerate(self.bodies):
+            Statistic.objects.create_from_stats_response(
+                endpoint=self.endpoint, body=body, fetched_at=self.then + idx * HOUR,
+                return_objects=False)
+        Statistic.objects.create_from_stats_response(
+            endpoint='https://other.invalid/', body=self.bodies[0], fetched_at=self.then,
+            return_objects=False)
+
+    def assertArrayEqual(self, actual, expected):
+        numpy.testing.assert_array_equal(actual, numpy.array(expected, dtype=float))
+
+    def test_as_matrix(self):
+        """Values are loaded into a keys by times matrix with NaN for missing values."""
+        matrix = Statistic.objects.as_matrix(self.endpoint, 'by_institution.*.total')
+        self.assertEqual(matrix.keys, [
+            'by_institution.INSTA.total', 'by_institution.INSTB.total',
+            'by_institution.INSTC.total',
+        ])
+        self.assertEqual(
+            [t.item().replace(tzinfo=datetime.timezone.utc) for t in matrix.times],
+            [self.then + idx * HOUR for idx in range(3)])
+        nan = numpy.nan
+        self.assertArrayEqual(matrix.values, [[10, 20, 20], [4, 0, nan], [nan, nan, 2]])
+        self.assertArrayEqual(matrix.mask, [[1, 1, 1], [1, 1, 0], [0, 0, 1]])
+        self.assertArrayEqual(matrix.row('by_institution.INSTB.total'), [4, 0, nan])
+
+    def test_time_range(self):
+        """Only values fetched within the time range are loaded."""
+        matrix = Statistic.objects.as_matrix(
+            self.endpoint, ['by_institution.INSTA.total'], start=self.then + HOUR,
+            end=self.then + 2 * HOUR)
+        self.assertArrayEqual(matrix.values, [[20]])
+
+    def test_chunks(self):
+        """Values are loaded in chunks."""
+        with mock.patch('gatherstats.analysis.CHUNK_SIZE', 2):
+            matrix = Statistic.objects.as_matrix(self.endpoint, [], prefixes=['by_'])
+        self.assertEqual(int(matrix.mask.sum()), 12)
+
+    def test_differences_and_growth_rates(self):
+        matrix = Statistic.objects.as_matrix(self.endpoint, 'by_institution.*.total')
+        nan = numpy.nan
+        self.assertArrayEqual(matrix.differences().values, [[10, 0], [-4, nan], [nan, nan]])
+        self.assertArrayEqual(matrix.growth_rates().values, [[1, 0], [-1, nan], [nan, nan]])
+        self.assertEqual(len(matrix.differences().times), 2)
+
+    def test_ratios(self):
+        """Completion ratios are computed for each institution."""
+        ratios = Statistic.objects.as_matrix(self.endpoint, 'by_institution.*.*').ratios()
+        self.assertEqual(
+            ratios.keys,
+            ['by_institution.INSTA', 'by_institution.INSTB', 'by_institution.INSTC'])
+        nan = numpy.nan
+        self.assertArrayEqual(ratios.values, [[0.5, 0.25, 0.75], [0.25, nan, nan], [nan, nan, 1]])
+
+    def test_fill_forward(self):
+        """Values recorded with delta storage can be filled forward."""
+        endpoint = 'https://delta.invalid/'
+        for idx, body in enumerate([{'a': 1, 'b': 2}, {'a': 1, 'b': 3}, {'a': 4, 'b': 3}]):
+            Statistic.objects.create_from_stats_response(
+                endpoint=endpoint, body=body, fetched_at=self.then + idx * HOUR, delta=True,
+                return_objects=False)
+        Statistic.objects.create_from_stats_response(
+            endpoint=endpoint, body={'a': 4, 'b': 3, 'c': 5}, fetched_at=self.then + 3 * HOUR,
+            delta=True, return_objects=False)
+
+        matrix = Statistic.objects.as_matrix(endpoint, '?')
+        nan = numpy.nan
+        self.assertArrayEqual(
+            matrix.values, [[1, nan, 4, nan], [2, 3, nan, nan], [nan, nan, nan, 5]])
+        self.assertArrayEqual(
+            matrix.fill_forward().values, [[1, 1, 4, 4], [2, 3, 3, 3], [nan, nan, nan, 5]])
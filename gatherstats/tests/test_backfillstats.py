@@ -0,0 +1,121 @@
+"""
+Test the backfillstats management command.
+
+"""
+import datetime
+import io
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+
+from gatherstats.models import Snapshot, Statistic
+
+
+class BackfillstatsTest(TestCase):
+    def setUp(self):
+        self.endpoint = 'https://iar-backend.invalid/stats'
+        self.then = timezone.make_aware(datetime.datetime(2018, 1, 2, 3, 4, 5))
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.archive = tmp_dir.name
+
+    def write(self, name, body, subdir=''):
+        os.makedirs(os.path.join(self.archive, subdir), exist_ok=True)
+        path = os.path.join(self.archive, subdir, name)
+        with open(path, 'w') as fobj:
+            json.dump(body, fobj)
+        return path
+
+    def backfill(self, *args, **kwargs):
+        out = io.StringIO()
+        call_command(
+            'backfillstats', *args, endpoint=self.endpoint, workers=2, stdout=out,
+            stderr=io.StringIO(), **kwargs)
+        return out.getvalue()
+
+    def snapshot_times(self):
+        return list(
+            Snapshot.objects.filter(endpoint__url=self.endpoint).order_by('fetched_at')
+            .values_list('fetched_at', flat=True))
+
+    def test_fetched_at_from_name(self):
+        """Fetch times are taken from file names and directories are searched recursively."""
+        self.write('stats-2018-01-02T03:04:05.json', {'a': 1})
+        self.write('20180102_0504.json', {'a': 2}, subdir='more')
+        self.write('notes.txt', {'a': 3})
+
+        out = self.backfill(self.archive)
+
+        self.assertIn('Created 2 object(s) from 2 file(s)', out)
+        self.assertEqual(self.snapshot_times(), [self.then, self.then.replace(hour=5, second=0)])
+        self.assertEqual(
+            list(Statistic.objects.order_by('fetched_at').values_list('numeric_value', flat=True)),
+            [1, 2])
+
+    def test_fetched_at_from_mtime(self):
+        """Fetch times can be taken from file modification times."""
+        path = self.write('a.json', {'a': 1})
+        os.utime(path, (self.then.timestamp(), self.then.timestamp()))
+        self.backfill(os.path.join(self.archive, '*.json'), fetched_at='mtime')
+        self.assertEqual(self.snapshot_times(), [self.then])
+
+    def test_fetched_at_from_field(self):
+        """Fetch times can be taken from a field which is not recorded as a statistic."""
+        self.write('a.json', {'a': 1, 'meta': {'at': self.then.isoformat()}})
+        self.write('b.json', {'a': 2, 'meta': {'at': self.then.timestamp() + 60}})
+        self.backfill(self.archive, fetched_at='field', field='meta.at')
+        self.assertEqual(
+            self.snapshot_times(), [self.then, self.then + datetime.timedelta(minutes=1)])
+        self.assertEqual(set(Statistic.objects.values_list('key__path', flat=True)), {'a'})
+
+    def test_restartable(self):
+        """Files which have already been ingested are skipped."""
+        self.write('2018-01-02T03:04:05.json', {'a': 1})
+        self.backfill(self.archive)
+        self.write('2018-01-02T04:04:05.json', {'a': 2})
+
+        out = self.backfill(self.archive)
+
+        self.assertIn('Created 1 object(s) from 1 file(s); skipped 1 file(s)', out)
+        self.assertEqual(Statistic.objects.count(), 2)
+
+    def test_overwrite(self):
+        """Files which have already been ingested can overwrite the recorded values."""
+        path = self.write('2018-01-02T03:04:05.json', {'a': 1})
+        self.backfill(self.archive)
+        self.write('2018-01-02T03:04:05.json', {'a': 2})
+
+        self.backfill(self.archive)
+        self.assertEqual(Statistic.objects.get().numeric_value, 1)
+
+        self.backfill(path, on_conflict='overwrite')
+        self.assertEqual(Statistic.objects.get().numeric_value, 2)
+
+        with self.assertRaisesRegex(CommandError, '1 file'):
+            self.backfill(path, on_conflict='error')
+
+    def test_failures(self):
+        """Bad files are reported without stopping the backfill."""
+        self.write('2018-01-02T03:04:05.json', {'a': 1})
+        self.write('undated.json', {'a': 2})
+        with open(os.path.join(self.archive, '2018-01-03.json'), 'w') as fobj:
+            fobj.write('{')
+
+        with self.assertRaisesRegex(CommandError, '2 file'):
+            self.backfill(self.archive)
+        self.assertEqual(self.snapshot_times(), [self.then])
+
+    def test_bad_arguments(self):
+        """Bad arguments are rejected."""
+        with self.assertRaises(CommandError):
+            self.backfill(self.archive)
+        with self.assertRaises(CommandError):
+            self.backfill(self.archive, fetched_at='field')
+        with self.assertRaises(CommandError):
+            self.backfill(self.archive, name_pattern='(')
@@ -0,0 +1,97 @@
+"""
+Test the ingest benchmarks.
+
+"""
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+
+from gatherstats import benchmark
+from gatherstats.models import Snapshot, _flatten_dict
+
+
+class SyntheticBodyTests(TestCase):
+    def test_key_count(self):
+        """Synthetic bodies have the documented number of keys."""
+        for institutions, depth, breadth, counts in [(1, 0, 1, 1), (10, 1, 4, 4), (3, 2, 3, 8)]:
+            body = benchmark.synthetic_body(institutions, depth, breadth, counts)
+            expected = counts * (
+                1 + institutions * sum(breadth ** level for level in range(depth + 1)))
+            self.assertEqual(len(list(_flatten_dict(body))), expected)
+
+    def test_shape(self):
+        """Synthetic bodies are broken down by institution and then by dimension."""
+        body = benchmark.synthetic_body(institutions=2, depth=1, breadth=2, counts=1)
+        paths = {path for path, _ in _flatten_dict(body)}
+        self.assertIn('asset_counts.all.total', paths)
+        self.assertIn(
+            'asset_counts.by_institution.INST0001.by_department.DEPARTMENT01.total', paths)
+
+    def test_reproducible(self):
+        """Bodies are reproducible for a given seed."""
+        self.assertEqual(benchmark.synthetic_body(seed=1), benchmark.synthetic_body(seed=1))
+        self.assertNotEqual(benchmark.synthetic_body(seed=1), benchmark.synthetic_body(seed=2))
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            benchmark.synthetic_body(counts=0)
+        with self.assertRaises(ValueError):
+            benchmark.synthetic_body(depth=len(benchmark.DIMENSIONS) + 1)
+
+
+class RunTests(TestCase):
+    def test_run(self):
+        """Each benchmark is run for each size and every repeat is ingested."""
+        results = benchmark.run(sizes=(1, 2), depth=0, counts=2, repeat=2)
+        self.assertEqual(
+            [(result['name'], result['parameters']['institutions']) for result in results],
+            [(name, size) for size in (1, 2) for name in benchmark.BENCHMARKS])
+        for result in results:
+            self.assertEqual(len(result['timings']), 2)
+        self.assertEqual(Snapshot.objects.filter(unchanged=False).count(), 2 * 2 * 3)
+
+    def test_compare(self):
+        """Results are compared with a baseline for the same benchmark and parameters."""
+        def result(name, institutions, median):
+            return {'name': name, 'parameters': {'institutions': institutions}, 'median': median}
+
+        comparisons = benchmark.compare(
+            [result('flatten', 1, 2.0), result('flatten', 2, 1.0)],
+            [result('flatten', 1, 1.0), result('flatten', 3, 1.0)])
+        self.assertEqual(comparisons, [('flatten', {'institutions': 1}, 2.0, 1.0, 0.5)])
+
+
+class QueriesTests(TestCase):
+    def test_queries(self):
+        """Each standard query is timed against the generated dataset and its plan recorded."""
+        results = benchmark.queries(
+            institutions=2, snapshots=4, endpoints=2, depth=0, counts=2, repeat=2)
+        self.assertEqual([result['name'] for result in results], list(benchmark.QUERIES))
+        for result in results:
+            self.assertEqual(len(result['timings']), 2)
+            self.assertEqual(result['parameters']['rows'], 4 * 2 * 2 * 3)
+            self.assertTrue(result['plan'])
+
+    def test_storage(self):
+        """No two indexes of the statistic table have the same columns."""
+        indexes = benchmark.storage()['indexes']
+        columns = [tuple(index['columns']) for index in indexes]
+        self.assertEqual(len(columns), len(set(columns)))
+        self.assertIn(('key_id', 'fetched_at', 'numeric_value'), columns)
+        self.assertIn(('endpoint_id', 'key_id', 'fetched_at'), columns)
+        self.assertNotIn(('key_id',), columns)
+
+
+class StartupTests(SimpleTestCase):
+    def test_ingest_startup(self):
+        """The ingest settings start up without the web interface or the HTTP stack and load
+        fewer modules than the settings under test.
+
+        """
+        ingest = benchmark.startup('gatherstats_project.settings.ingest', repeat=2)
+        regular = benchmark.startup(settings.SETTINGS_MODULE, repeat=2)
+
+        self.assertEqual(len(ingest['timings']), 2)
+        for module in ['django.contrib.admin', 'django.contrib.auth', 'requests', 'ijson']:
+            self.assertNotIn(module, ingest['modules'])
+        self.assertIn('gatherstats.models', ingest['modules'])
+        self.assertLess(len(ingest['modules']), len(regular['modules']))
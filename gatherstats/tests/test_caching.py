@@ -0,0 +1,167 @@
+"""
+Test the cache of statistic queries.
+
+"""
+import datetime
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from gatherstats import caching
+from gatherstats.models import Statistic, _endpoint_ids, _key_ids, _last_values
+
+HOUR = datetime.timedelta(hours=1)
+
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'gatherstats': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'gatherstats-tests',
+    },
+}
+
+
+@override_settings(CACHES=CACHES, GATHERSTATS_CACHE='gatherstats')
+class GetOrComputeTests(SimpleTestCase):
+    def setUp(self):
+        caches['gatherstats'].clear()
+        caching.reset_counts()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return {'calls': self.calls}
+
+    def test_cached(self):
+        self.assertEqual(caching.get_or_compute('a', 'test', [1], self.compute), {'calls': 1})
+        self.assertEqual(caching.get_or_compute('a', 'test', [1], self.compute), {'calls': 1})
+        self.assertEqual(caching.counts(), {'hits': 1, 'misses': 1})
+
+    def test_parameters_and_names_distinguished(self):
+        caching.get_or_compute('a', 'test', [1], self.compute)
+        caching.get_or_compute('a', 'test', [2], self.compute)
+        caching.get_or_compute('a', 'other', [1], self.compute)
+        caching.get_or_compute('b', 'test', [1], self.compute)
+        self.assertEqual(self.calls, 4)
+
+    def test_none_cached(self):
+        self.assertIsNone(caching.get_or_compute('a', 'test', [], lambda: None))
+        self.assertIsNone(caching.get_or_compute('a', 'test', [], self.compute))
+        self.assertEqual(self.calls, 0)
+
+    def test_invalidate_endpoint(self):
+        caching.get_or_compute('a', 'test', [], self.compute)
+        caching.get_or_compute('b', 'test', [], self.compute)
+        caching.invalidate('a')
+        self.assertEqual(caching.get_or_compute('a', 'test', [], self.compute), {'calls': 3})
+        self.assertEqual(caching.get_or_compute('b', 'test', [], self.compute), {'calls': 2})
+
+    def test_invalidate_all(self):
+        caching.get_or_compute('a', 'test', [], self.compute)
+        caching.get_or_compute('b', 'test', [], self.compute)
+        caching.invalidate()
+        caching.get_or_compute('a', 'test', [], self.compute)
+        caching.get_or_compute('b', 'test', [], self.compute)
+        self.assertEqual(self.calls, 4)
+
+    def test_evicted_generation(self):
+        caching.get_or_compute('a', 'test', [], self.compute)
+        caches['gatherstats'].delete(caching._GLOBAL)
+        caching.invalidate()
+        caching.get_or_compute('a', 'test', [], self.compute)
+        self.assertEqual(self.calls, 2)
+
+    def test_iterate(self):
+        rows = [('a', 1), ('b', 2)]
+        self.assertEqual(list(caching.iterate_or_compute('a', 'test', [], lambda: rows)), rows)
+        self.assertEqual(list(caching.iterate_or_compute('a', 'test', [], lambda: [])), rows)
+        self.assertEqual(caching.counts(), {'hits': 1, 'misses': 1})
+
+    def test_iterate_too_many_rows(self):
+        rows = [('a', 1), ('b', 2)]
+        with self.settings(GATHERSTATS_CACHE_MAX_ROWS=1):
+            list(caching.iterate_or_compute('a', 'test', [], lambda: rows))
+        self.assertEqual(list(caching.iterate_or_compute('a', 'test', [], lambda: [])), [])
+
+    @override_settings(GATHERSTATS_CACHE=None)
+    def test_disabled(self):
+        caching.get_or_compute('a', 'test', [], self.compute)
+        caching.get_or_compute('a', 'test', [], self.compute)
+        caching.invalidate('a')
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(caching.counts(), {'hits': 0, 'misses': 0})
+
+
+@override_settings(CACHES=CACHES, GATHERSTATS_CACHE='gatherstats', GATHERSTATS_API_PUBLIC=True)
+class IngestInvalidationTests(TransactionTestCase):
+    # Invalidation happens when the ingest transaction commits and so these tests commit.
+
+    def setUp(self):
+        for cache in [_endpoint_ids, _key_ids, _last_values]:
+            cache.clear()
+            self.addCleanup(cache.clear)
+        caches['gatherstats'].clear()
+        caching.reset_counts()
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        self.ingest(0, {'all': {'total': 10}, 'other': {'total': 1}})
+
+    def ingest(self, hours, body, endpoint=None):
+        Statistic.objects.create_from_stats_response(
+            endpoint=endpoint or self.endpoint, fetched_at=self.then + hours * HOUR, body=body)
+
+    def get_latest(self):
+        response = self.client.get(
+            reverse('gatherstats:latest'), {'endpoint': self.endpoint, 'prefix': 'all.'})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['values']
+
+    def test_latest_cached(self):
+        self.assertEqual(self.get_latest()['all.total'][1], 10)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_latest()['all.total'][1], 10)
+        self.assertEqual(caching.counts(), {'hits': 1, 'misses': 1})
+
+    def test_ingest_invalidates(self):
+        self.get_latest()
+        self.ingest(1, {'all': {'total': 11}})
+        self.assertEqual(self.get_latest()['all.total'][1], 11)
+
+    def test_other_endpoint_does_not_invalidate(self):
+        self.get_latest()
+        self.ingest(1, {'all': {'total': 11}}, endpoint='https://other.invalid/')
+        with self.assertNumQueries(0):
+            self.get_latest()
+
+    def test_series_cached(self):
+        params = {'endpoint': self.endpoint, 'key': 'all.total'}
+        first = self.client.get(reverse('gatherstats:series'), params)
+        self.assertEqual(b''.join(first.streaming_content).count(b'['), 3)
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('gatherstats:series'), params)
+            content = b''.join(second.streaming_content)
+        self.assertEqual(content.count(b'['), 3)
+
+        self.ingest(1, {'all': {'total': 11}})
+        third = self.client.get(reverse('gatherstats:series'), params)
+        self.assertEqual(b''.join(third.streaming_content).count(b'['), 4)
+
+    def test_compare_cached(self):
+        before, after = self.then, self.then + 2 * HOUR
+        Statistic.objects.compare(self.endpoint, before, after)
+        with self.assertNumQueries(0):
+            Statistic.objects.compare(self.endpoint, before, after)
+
+        self.ingest(1, {'all': {'total': 11}})
+        changes = Statistic.objects.compare(self.endpoint, before, after, prefixes=['all.'])
+        self.assertEqual(changes[0].after, 11)
+
+    def test_prune_invalidates(self):
+        self.ingest(1, {'all': {'total': 11}})
+        self.ingest(2, {'all': {'total': 12}})
+        self.get_latest()
+        self.assertEqual(Statistic.objects.prune(self.then + 2 * HOUR), 1)
+        with self.assertNumQueries(1):
+            self.get_latest()
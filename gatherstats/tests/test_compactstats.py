@@ -0,0 +1,72 @@
+"""
+Test the compactstats management command.
+
+"""
+import datetime
+import io
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+
+from gatherstats.models import Statistic, StatisticRollup
+
+
+class CompactstatsTest(TestCase):
+    def setUp(self):
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        # Three days of hourly statistics ending yesterday, gathered without rollups.
+        with self.settings(GATHERSTATS_ROLLUP_PERIODS=()):
+            for hours in range(1, 3 * 24 + 1):
+                Statistic.objects.create_from_stats_response(
+                    endpoint=self.endpoint, body={'a': hours, 'b': 1},
+                    fetched_at=self.today - datetime.timedelta(hours=hours),
+                    return_objects=False)
+
+    def test_rollups(self):
+        """Rollups are computed for all statistics."""
+        out = io.StringIO()
+        call_command('compactstats', stdout=out)
+        self.assertIn('Computed {} rollup(s)'.format(2 * (3 * 24 + 3)), out.getvalue())
+        self.assertEqual(
+            StatisticRollup.objects.filter(period=StatisticRollup.DAY).count(), 2 * 3)
+        self.assertEqual(Statistic.objects.count(), 2 * 3 * 24)
+
+    def test_since_and_before(self):
+        """Rollups are only computed for the days requested."""
+        yesterday = self.today - datetime.timedelta(days=1)
+        call_command(
+            'compactstats', '--since', yesterday.isoformat(), '--before', self.today.isoformat(),
+            stdout=io.StringIO())
+        self.assertEqual(
+            set(StatisticRollup.objects.values_list('period_start', flat=True)
+                .filter(period=StatisticRollup.DAY)),
+            {yesterday})
+
+    def test_retention(self):
+        """Statistics older than the retention period are deleted once rolled up."""
+        out = io.StringIO()
+        call_command('compactstats', '--retention', '1d', stdout=out)
+        self.assertIn('Deleted {} statistic(s)'.format(2 * (2 * 24 - 1)), out.getvalue())
+        self.assertEqual(
+            StatisticRollup.objects.filter(period=StatisticRollup.DAY).count(), 2 * 3)
+        self.assertEqual(
+            Statistic.objects.filter(
+                fetched_at__lt=self.today - datetime.timedelta(days=1)).count(),
+            2)
+
+    def test_retention_after_before(self):
+        """Statistics which would not be rolled up cannot be deleted."""
+        with self.assertRaises(CommandError):
+            call_command(
+                'compactstats', '--retention', '1d',
+                '--before', (self.today - datetime.timedelta(days=2)).isoformat(),
+                stdout=io.StringIO())
+
+    def test_retention_without_rollups(self):
+        """Statistics cannot be deleted if rollups are disabled."""
+        with self.settings(GATHERSTATS_ROLLUP_PERIODS=()), self.assertRaises(CommandError):
+            call_command('compactstats', '--retention', '1d', stdout=io.StringIO())
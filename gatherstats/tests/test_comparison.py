@@ -0,0 +1,102 @@
+"""
+Test comparing statistics between two instants.
+
+"""
+import datetime
+import unittest
+import unittest.mock as mock
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from gatherstats.comparison import KeyChange, _supports_window_functions
+from gatherstats.models import Snapshot, Statistic
+
+HOUR = datetime.timedelta(hours=1)
+
+
+class CompareTests(TestCase):
+    def setUp(self):
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        self.ingest({'all': {'total': 10}, 'INSTA': {'total': 4, 'completed': 0}}, self.then)
+        self.ingest(
+            {'all': {'total': 12}, 'INSTA': {'total': 4, 'completed': 2}}, self.then + HOUR)
+        self.ingest(
+            {'all': {'total': 15}, 'INSTA': {'total': 4, 'completed': 3}, 'INSTB': {'total': 1}},
+            self.then + 2 * HOUR)
+        Statistic.objects.create_from_stats_response(
+            endpoint='https://other.invalid/', fetched_at=self.then + HOUR, body={'all': 1})
+
+    def ingest(self, body, fetched_at, **kwargs):
+        Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=body, fetched_at=fetched_at, **kwargs)
+
+    def test_compare(self):
+        """Absolute and relative changes are returned for each key."""
+        self.assertEqual(
+            Statistic.objects.compare(self.endpoint, self.then, self.then + 2 * HOUR), [
+                KeyChange('INSTA.completed', 0, 3, 3, None),
+                KeyChange('INSTA.total', 4, 4, 0, 0),
+                KeyChange('INSTB.total', None, 1, None, None),
+                KeyChange('all.total', 10, 15, 5, 0.5),
+            ])
+
+    def test_between_snapshots(self):
+        """Values at instants between snapshots are those of the latest snapshot before."""
+        changes = Statistic.objects.compare(
+            self.endpoint, self.then + HOUR / 2, self.then + 3 * HOUR, patterns='all.*')
+        self.assertEqual(changes, [KeyChange('all.total', 10, 15, 5, 0.5)])
+
+    def test_patterns(self):
+        changes = Statistic.objects.compare(
+            self.endpoint, self.then, self.then + HOUR, patterns=['*.completed'],
+            prefixes=['all.'])
+        self.assertEqual([change.key for change in changes], ['INSTA.completed', 'all.total'])
+
+    def test_delta(self):
+        """Values are carried forward over snapshots which only recorded changes."""
+        self.ingest(
+            {'all': {'total': 16}, 'INSTA': {'total': 4, 'completed': 3}, 'INSTB': {'total': 1}},
+            self.then + 3 * HOUR, delta=True)
+        changes = Statistic.objects.compare(
+            self.endpoint, self.then + 2 * HOUR, self.then + 3 * HOUR)
+        self.assertEqual(
+            {change.key: change.change for change in changes},
+            {'all.total': 1, 'INSTA.total': 0, 'INSTA.completed': 0, 'INSTB.total': 0})
+
+    def test_compare_with_previous(self):
+        """A snapshot can be compared with its predecessor."""
+        first, second = Snapshot.objects.filter(endpoint__url=self.endpoint).order_by(
+            'fetched_at')[:2]
+        self.assertEqual(
+            Statistic.objects.compare_with_previous(second, patterns='INSTA.completed'),
+            [KeyChange('INSTA.completed', 0, 2, 2, None)])
+        self.assertEqual(
+            Statistic.objects.compare_with_previous(first, patterns='all.total'),
+            [KeyChange('all.total', None, 10, None, None)])
+
+    @unittest.skipUnless(
+        _supports_window_functions(connection), 'database does not support window functions')
+    def test_single_query(self):
+        """The statistics are read by a single query."""
+        with CaptureQueriesContext(connection) as queries:
+            Statistic.objects.compare(self.endpoint, self.then, self.then + 2 * HOUR)
+        statistic_queries = [
+            query for query in queries.captured_queries
+            if 'gatherstats_statistic"' in query['sql']]
+        self.assertEqual(len(statistic_queries), 1)
+
+    def test_without_window_functions(self):
+        """The result is the same on databases without window functions."""
+        expected = Statistic.objects.compare(self.endpoint, self.then + HOUR, self.then + 2 * HOUR)
+        with mock.patch('gatherstats.comparison._supports_window_functions', return_value=False):
+            self.assertEqual(
+                Statistic.objects.compare(self.endpoint, self.then + HOUR, self.then + 2 * HOUR),
+                expected)
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            Statistic.objects.compare(self.endpoint, self.then + HOUR, self.then)
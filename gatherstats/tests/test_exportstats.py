@@ -0,0 +1,105 @@
+"""
+Test the exportstats management command.
+
+"""
+import csv
+import datetime
+import io
+import json
+import os
+import tempfile
+import unittest.mock as mock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+
+from gatherstats import export
+from gatherstats.models import Statistic, StatisticKey
+
+HOUR = datetime.timedelta(hours=1)
+
+
+class ExportstatsTest(TestCase):
+    def setUp(self):
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8, 7))
+        for idx in range(3):
+            for endpoint in ('https://a.invalid/', 'https://b.invalid/'):
+                Statistic.objects.create_from_stats_response(
+                    endpoint=endpoint, fetched_at=self.then + idx * HOUR,
+                    body={'all': {'total': 10 + idx, 'completed': idx / 2}})
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.output = os.path.join(tmp_dir.name, 'export')
+
+    def export(self, *args, **kwargs):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('exportstats', *args, stdout=out, stderr=err, **kwargs)
+        return out.getvalue(), err.getvalue()
+
+    def expected_rows(self, endpoints=('https://a.invalid/', 'https://b.invalid/'), keys=None,
+                      hours=range(3)):
+        # Keys are exported in order of primary key.
+        if keys is None:
+            keys = StatisticKey.objects.order_by('pk').values_list('path', flat=True)
+        return [
+            (endpoint, key, self.then + idx * HOUR,
+             float(10 + idx if key == 'all.total' else idx / 2))
+            for endpoint in endpoints for key in keys for idx in hours
+        ]
+
+    def test_csv(self):
+        """Statistics are exported as CSV in endpoint, key and time order."""
+        out, err = self.export()
+        rows = list(csv.reader(io.StringIO(out)))
+        self.assertEqual(rows[0], ['endpoint', 'key', 'fetched_at', 'value'])
+        self.assertEqual(
+            [(e, k, t, float(v)) for e, k, t, v in rows[1:]],
+            [(e, k, t.isoformat(), v) for e, k, t, v in self.expected_rows()])
+        self.assertIn('Exported 12 statistic(s)', err)
+
+    def test_ndjson(self):
+        """Statistics are exported as newline-delimited JSON."""
+        self.export(format='ndjson', output=self.output)
+        with open(self.output) as fobj:
+            rows = [json.loads(line) for line in fobj]
+        self.assertEqual(
+            [(r['endpoint'], r['key'], r['fetched_at'], r['value']) for r in rows],
+            [(e, k, t.isoformat(), v) for e, k, t, v in self.expected_rows()])
+
+    def test_columnar(self):
+        """Statistics round trip through the columnar format."""
+        self.export(format='columnar', output=self.output)
+        with open(self.output, 'rb') as fobj:
+            self.assertEqual(list(export.read_columnar(fobj)), self.expected_rows())
+
+    def test_columnar_chunks(self):
+        """Columnar files may have several blocks."""
+        with mock.patch('gatherstats.export.CHUNK_SIZE', 5):
+            self.export(format='columnar', output=self.output)
+        with open(self.output, 'rb') as fobj:
+            self.assertEqual(list(export.read_columnar(fobj)), self.expected_rows())
+
+    def test_selection(self):
+        """Statistics are selected by endpoint, key and fetch time."""
+        self.export(
+            '--endpoint', 'https://b.invalid/', '--key', '*.total', '--since',
+            (self.then + HOUR).isoformat(), '--before', (self.then + 2 * HOUR).isoformat(),
+            format='columnar', output=self.output)
+        with open(self.output, 'rb') as fobj:
+            self.assertEqual(
+                list(export.read_columnar(fobj)),
+                self.expected_rows(
+                    endpoints=['https://b.invalid/'], keys=['all.total'], hours=[1]))
+
+    def test_bad_files(self):
+        """Files not in the columnar format are rejected."""
+        for contents in [b'', b'not a file', export.COLUMNAR_MAGIC + b'\x01']:
+            with self.assertRaises(ValueError):
+                list(export.read_columnar(io.BytesIO(contents)))
+
+    def test_columnar_needs_output(self):
+        with self.assertRaises(CommandError):
+            self.export(format='columnar')
@@ -2,6 +2,7 @@
 Test the gatherstats management command.
 
 """
+import argparse
 import contextlib
 import io
 import json
@@ -10,9 +11,11 @@ import tempfile
 import unittest.mock as mock
 
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 
-from gatherstats.models import Statistic, _flatten_dict
+from gatherstats.management.arguments import interval
+from gatherstats.models import Snapshot, Statistic, _body_hash, _flatten_dict
 
 
 STATS_FIXTURE = json.dumps({
@@ -41,6 +44,20 @@ def temporary_file_with_contents(contents):
         yield filename
 
 
+def mock_response(body=None, raw=None, status_code=200, headers=None):
+    """Return a mock :py:class:`requests.Response` with the JSON body *body* or the raw body
+    *raw*.
+
+    """
+    response = mock.MagicMock()
+    response.status_code = status_code
+    response.headers = headers if headers is not None else {}
+    response.json.return_value = body
+    response.content = json.dumps(body).encode('utf8')
+    response.raw = raw
+    return response
+
+
 class GatherstatsTest(TestCase):
     def test_file_load(self):
         out = io.StringIO()
@@ -55,16 +72,16 @@ class GatherstatsTest(TestCase):
 
         for key, value in STATS_ITEMS:
             self.assertTrue(Statistic.objects.filter(
-                endpoint=expected_endpoint, key=key, numeric_value=value).exists())
+                endpoint__url=expected_endpoint, key__path=key, numeric_value=value).exists())
 
     def test_url_load(self):
         out = io.StringIO()
         url = 'http://iar-backend.invalid/stats'
-        with mock.patch('requests.get') as get:
-            get.return_value.json.return_value = json.loads(STATS_FIXTURE)
+        with mock.patch('requests.Session.get') as get:
+            get.return_value = mock_response(json.loads(STATS_FIXTURE))
             call_command('gatherstats', url, stdout=out)
 
-        get.assert_called_with(url)
+        get.assert_called_with(url, headers={})
 
         # Output included the expected number of objects
         self.assertIn(' {} '.format(len(STATS_ITEMS)), out.getvalue())
@@ -73,7 +90,7 @@ class GatherstatsTest(TestCase):
 
         for key, value in STATS_ITEMS:
             self.assertTrue(Statistic.objects.filter(
-                endpoint=url, key=key, numeric_value=value).exists())
+                endpoint__url=url, key__path=key, numeric_value=value).exists())
 
     def test_file_load_with_custom_endpoint(self):
         endpoint = 'http://custom.invalid/api'
@@ -88,4 +105,231 @@ class GatherstatsTest(TestCase):
 
         for key, value in STATS_ITEMS:
             self.assertTrue(Statistic.objects.filter(
-                endpoint=endpoint, key=key, numeric_value=value).exists())
+                endpoint__url=endpoint, key__path=key, numeric_value=value).exists())
+
+    def test_streamed_file_load(self):
+        out = io.StringIO()
+        with temporary_file_with_contents(STATS_FIXTURE) as filename:
+            expected_endpoint = 'file://' + filename
+            call_command('gatherstats', filename, stdout=out, stream=True)
+
+        # Output included the expected number of objects
+        self.assertIn(' {} '.format(len(STATS_ITEMS)), out.getvalue())
+
+        self.assertEqual(Statistic.objects.all().count(), len(STATS_ITEMS))
+
+        for key, value in STATS_ITEMS:
+            self.assertTrue(Statistic.objects.filter(
+                endpoint__url=expected_endpoint, key__path=key, numeric_value=value).exists())
+
+        # The body hash is the same as if the body had not been streamed
+        self.assertEqual(Snapshot.objects.get().body_hash, _body_hash(json.loads(STATS_FIXTURE)))
+
+    def test_streamed_url_load(self):
+        out = io.StringIO()
+        url = 'http://iar-backend.invalid/stats'
+        with mock.patch('requests.Session.get') as get:
+            get.return_value = mock_response(raw=io.BytesIO(STATS_FIXTURE.encode('utf8')))
+            call_command('gatherstats', url, stdout=out, stream=True)
+
+        get.assert_called_with(url, stream=True, headers={})
+        get.return_value.close.assert_called_with()
+
+        # Output included the expected number of objects
+        self.assertIn(' {} '.format(len(STATS_ITEMS)), out.getvalue())
+
+        self.assertEqual(Statistic.objects.all().count(), len(STATS_ITEMS))
+
+        for key, value in STATS_ITEMS:
+            self.assertTrue(Statistic.objects.filter(
+                endpoint__url=url, key__path=key, numeric_value=value).exists())
+
+    def test_multiple_endpoints(self):
+        out = io.StringIO()
+        with temporary_file_with_contents(STATS_FIXTURE) as filename:
+            with mock.patch('requests.Session.get') as get:
+                get.return_value = mock_response(json.loads(STATS_FIXTURE))
+                call_command(
+                    'gatherstats', filename, 'http://a.invalid/stats', 'http://b.invalid/stats',
+                    stdout=out)
+
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(Snapshot.objects.count(), 3)
+        self.assertEqual(Statistic.objects.all().count(), 3 * len(STATS_ITEMS))
+        for endpoint in ['file://' + filename, 'http://a.invalid/stats', 'http://b.invalid/stats']:
+            self.assertIn('Created {} object(s) from {}'.format(len(STATS_ITEMS), endpoint),
+                          out.getvalue())
+            self.assertEqual(
+                Statistic.objects.filter(endpoint__url=endpoint).count(), len(STATS_ITEMS))
+
+    def test_many_endpoints(self):
+        """Many endpoints are gathered through a pipeline with small queues."""
+        out = io.StringIO()
+        urls = ['http://{}.invalid/stats'.format(idx) for idx in range(10)]
+        with mock.patch('requests.Session.get') as get, \
+                self.settings(GATHERSTATS_PIPELINE_QUEUE_SIZE=1):
+            get.return_value = mock_response(json.loads(STATS_FIXTURE))
+            call_command('gatherstats', *urls, workers=3, flatten_workers=2, stdout=out)
+
+        self.assertEqual(Snapshot.objects.count(), len(urls))
+        self.assertEqual(Statistic.objects.count(), len(urls) * len(STATS_ITEMS))
+        self.assertEqual(out.getvalue().count('Created {} object(s)'.format(len(STATS_ITEMS))),
+                         len(urls))
+
+    def test_endpoints_file(self):
+        out = io.StringIO()
+        with temporary_file_with_contents(STATS_FIXTURE) as filename:
+            listing = '# A comment\n\n{}\nhttp://a.invalid/stats\n'.format(filename)
+            with temporary_file_with_contents(listing) as endpoints_filename:
+                with mock.patch('requests.Session.get') as get:
+                    get.return_value = mock_response(json.loads(STATS_FIXTURE))
+                    call_command(
+                        'gatherstats', endpoints_file=endpoints_filename, stdout=out)
+
+        get.assert_called_once_with('http://a.invalid/stats', headers={})
+        self.assertEqual(Snapshot.objects.count(), 2)
+
+    def test_failed_endpoint(self):
+        """A failing endpoint is reported and does not prevent others being recorded."""
+        out, err = io.StringIO(), io.StringIO()
+        with temporary_file_with_contents(STATS_FIXTURE) as filename:
+            with self.assertRaises(CommandError):
+                call_command(
+                    'gatherstats', filename, filename + '-does-not-exist', stdout=out,
+                    stderr=err)
+
+        self.assertIn('file://' + filename + '-does-not-exist', err.getvalue())
+        self.assertEqual(Snapshot.objects.get().endpoint.url, 'file://' + filename)
+        self.assertEqual(Statistic.objects.all().count(), len(STATS_ITEMS))
+
+    def test_conditional_fetch(self):
+        """Validators from the previous response are sent and a 304 response is recorded as
+        unchanged.
+
+        """
+        url = 'http://iar-backend.invalid/stats'
+        validators = {'ETag': '"v1"', 'Last-Modified': 'Wed, 11 Dec 2013 10:09:08 GMT'}
+        for stream in (False, True):
+            Snapshot.objects.all().delete()
+            Statistic.objects.all().delete()
+            with mock.patch('requests.Session.get') as get:
+                get.return_value = mock_response(
+                    json.loads(STATS_FIXTURE), raw=io.BytesIO(STATS_FIXTURE.encode('utf8')),
+                    headers=validators)
+                call_command('gatherstats', url, stream=stream, stdout=io.StringIO())
+
+            with mock.patch('requests.Session.get') as get:
+                get.return_value = mock_response(status_code=304, headers={'ETag': '"v1"'})
+                out = io.StringIO()
+                call_command('gatherstats', url, stream=stream, stdout=out)
+
+            self.assertEqual(get.call_args[1]['headers'], {
+                'If-None-Match': '"v1"', 'If-Modified-Since': 'Wed, 11 Dec 2013 10:09:08 GMT',
+            })
+            self.assertIn('Created 0 object(s)', out.getvalue())
+            self.assertEqual(Statistic.objects.count(), len(STATS_ITEMS))
+            first, second = Snapshot.objects.order_by('fetched_at')
+            self.assertTrue(second.unchanged)
+            self.assertEqual(second.key_count, len(STATS_ITEMS))
+            self.assertEqual(second.body_hash, first.body_hash)
+
+    def test_skip_unchanged_setting(self):
+        """Unchanged responses are recorded in full if the setting is False."""
+        with temporary_file_with_contents(STATS_FIXTURE) as filename:
+            with self.settings(GATHERSTATS_SKIP_UNCHANGED=False):
+                for _ in range(2):
+                    call_command('gatherstats', filename, stdout=io.StringIO())
+        self.assertEqual(Statistic.objects.count(), 2 * len(STATS_ITEMS))
+
+    def test_metrics(self):
+        """Metrics of each gather are logged and written to the metrics text file."""
+        for stream in (False, True):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, 'gatherstats.prom')
+                with temporary_file_with_contents(STATS_FIXTURE) as filename, \
+                        self.settings(GATHERSTATS_METRICS_TEXTFILE=path), \
+                        self.assertLogs('gatherstats.metrics', 'INFO') as logs:
+                    call_command(
+                        'gatherstats', filename, stream=stream, endpoint='https://a.invalid/',
+                        stdout=io.StringIO())
+                with open(path) as fobj:
+                    textfile = fobj.read()
+
+            record = json.loads(logs.records[0].getMessage())
+            self.assertEqual(record['endpoint'], 'https://a.invalid/')
+            self.assertEqual(record['status'], 'ok')
+            expected_phases = {'fetch', 'flatten', 'resolve_keys', 'insert', 'derived', 'ingest'}
+            if not stream:
+                expected_phases.add('parse')
+            self.assertEqual(set(record['durations']), expected_phases)
+            self.assertEqual(record['counts']['bytes'], len(STATS_FIXTURE))
+            self.assertEqual(record['counts']['keys'], len(STATS_ITEMS))
+            self.assertGreater(record['counts']['queries'], 0)
+            self.assertIn(
+                'gatherstats_gather_success{endpoint="https://a.invalid/"} 1',
+                textfile.splitlines())
+            Statistic.objects.all().delete()
+
+    def test_bad_arguments(self):
+        with self.assertRaises(CommandError):
+            call_command('gatherstats')
+        with self.assertRaises(CommandError):
+            call_command('gatherstats', 'a', 'b', endpoint='http://custom.invalid/api')
+        with self.assertRaises(CommandError):
+            call_command('gatherstats', 'a', workers=0)
+        with self.assertRaises(CommandError):
+            call_command('gatherstats', 'a', flatten_workers=0)
+
+
+class SchedulerTest(TestCase):
+    def test_scheduled_gathers(self):
+        """The scheduler gathers repeatedly until the maximum number of runs is reached."""
+        out = io.StringIO()
+        with temporary_file_with_contents(STATS_FIXTURE) as filename:
+            call_command(
+                'gatherstats', filename, every=0.01, jitter=0.001, max_runs=3, stdout=out)
+
+        # The file is unchanged after the first gather.
+        self.assertEqual(Snapshot.objects.count(), 3)
+        self.assertEqual(Snapshot.objects.filter(unchanged=True).count(), 2)
+        self.assertEqual(Statistic.objects.all().count(), len(STATS_ITEMS))
+
+    def test_failures_do_not_stop_scheduler(self):
+        """A failed gather is reported and the scheduler carries on."""
+        err = io.StringIO()
+        call_command(
+            'gatherstats', '/does-not-exist', every=0.01, jitter=0, max_runs=2, stderr=err)
+        self.assertEqual(err.getvalue().count('Failed to gather'), 2)
+
+    def test_lock_not_held(self):
+        """Nothing is gathered if another scheduler holds the lock."""
+        out = io.StringIO()
+        with temporary_file_with_contents(STATS_FIXTURE) as filename:
+            with mock.patch('gatherstats.locks.AdvisoryLock.try_acquire') as try_acquire:
+                try_acquire.return_value = False
+                call_command(
+                    'gatherstats', filename, every=0.01, jitter=0, max_runs=2, stdout=out)
+
+        self.assertEqual(try_acquire.call_count, 2)
+        self.assertEqual(Snapshot.objects.count(), 0)
+
+    def test_stop_requested(self):
+        """The scheduler stops when a stop is requested by a signal handler."""
+        def wait(self, timeout=None):
+            self.set()
+            return True
+
+        with mock.patch('threading.Event.wait', wait):
+            call_command('gatherstats', '/does-not-exist', every=60)
+
+        self.assertEqual(Snapshot.objects.count(), 0)
+
+    def test_interval(self):
+        self.assertEqual(interval('90'), 90)
+        self.assertEqual(interval('30s'), 30)
+        self.assertEqual(interval('1.5m'), 90)
+        self.assertEqual(interval('2h'), 7200)
+        self.assertEqual(interval('7d'), 604800)
+        for value in ['', '0', '-1', '5w', 'x']:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                interval(value)
@@ -0,0 +1,82 @@
+"""
+Test the gather metrics.
+
+"""
+import os
+import tempfile
+
+from django.test import TestCase
+
+from gatherstats import metrics
+from gatherstats.models import Endpoint, Statistic
+
+
+class GatherMetricsTests(TestCase):
+    def test_recording(self):
+        """Phases, counts and queries are recorded into the metrics being recorded."""
+        gather_metrics = metrics.GatherMetrics('https://iar-backend.invalid/')
+        with gather_metrics.recording():
+            with metrics.phase('one'):
+                Endpoint.objects.count()
+            with metrics.phase('one'):
+                pass
+            metrics.increment('things', 2)
+            metrics.increment('things')
+        self.assertEqual(list(gather_metrics.durations), ['one'])
+        self.assertGreater(gather_metrics.durations['one'], 0)
+        self.assertEqual(gather_metrics.counts, {'queries': 1, 'things': 3})
+
+    def test_not_recording(self):
+        """Outside of a recording, phases and counts are ignored."""
+        gather_metrics = metrics.GatherMetrics('https://iar-backend.invalid/')
+        with metrics.phase('one'):
+            metrics.increment('things')
+        self.assertEqual(list(metrics.timed('two', [1, 2])), [1, 2])
+        self.assertEqual(gather_metrics.durations, {})
+        self.assertEqual(gather_metrics.counts, {})
+
+    def test_ingest_phases(self):
+        """Ingesting a response records its phases and counts."""
+        gather_metrics = metrics.GatherMetrics('https://iar-backend.invalid/')
+        with gather_metrics.recording():
+            Statistic.objects.create_from_stats_response(
+                endpoint=gather_metrics.endpoint, body={'a': 1, 'b': {'c': 2}},
+                return_objects=False)
+        self.assertEqual(
+            set(gather_metrics.durations), {'flatten', 'resolve_keys', 'insert', 'derived'})
+        self.assertEqual(gather_metrics.counts['keys'], 2)
+        self.assertEqual(gather_metrics.counts['statistics'], 2)
+        self.assertGreater(gather_metrics.counts['queries'], 0)
+
+    def test_prometheus_text(self):
+        """Metrics are formatted in the Prometheus text format."""
+        ok = metrics.GatherMetrics('https://a.invalid/')
+        ok.durations['fetch'] = 0.5
+        ok.counts['bytes'] = 100
+        ok.finish()
+        failed = metrics.GatherMetrics('https://b.invalid/"quoted"')
+        failed.finish(RuntimeError('oops'))
+
+        lines = metrics.prometheus_text([ok, failed]).splitlines()
+        self.assertIn('# TYPE gatherstats_gather_success gauge', lines)
+        self.assertIn('gatherstats_gather_success{endpoint="https://a.invalid/"} 1', lines)
+        self.assertIn(
+            'gatherstats_gather_success{endpoint="https://b.invalid/\\"quoted\\""} 0', lines)
+        self.assertIn(
+            'gatherstats_gather_phase_duration_seconds'
+            '{endpoint="https://a.invalid/",phase="fetch"} 0.5',
+            lines)
+        self.assertIn(
+            'gatherstats_gather_count{count="bytes",endpoint="https://a.invalid/"} 100', lines)
+
+    def test_write_textfile(self):
+        """The text file is replaced with the metrics."""
+        gather_metrics = metrics.GatherMetrics('https://a.invalid/')
+        gather_metrics.finish()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'gatherstats.prom')
+            for _ in range(2):
+                metrics.write_textfile(path, [gather_metrics])
+            with open(path) as fobj:
+                self.assertEqual(fobj.read(), metrics.prometheus_text([gather_metrics]))
+            self.assertEqual(os.listdir(tmp_dir), ['gatherstats.prom'])
@@ -1,34 +1,48 @@
 import datetime
+import unittest
 import unittest.mock as mock
 
 import django.db
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from ..models import Statistic, _flatten_dict
+from .. import metrics
+from ..models import (
+    Endpoint, LatestStatistic, Snapshot, Statistic, StatisticKey, StatisticRollup, _batched,
+    _can_return, _copy_text_value, _endpoint_ids, _flatten_dict, _key_ids, _last_values,
+    _split_path)
+
+HOUR = datetime.timedelta(hours=1)
 
 
 class StatisticUniquenessTests(TestCase):
     def setUp(self):
-        self.endpoint = 'https://iar-backend.invalid/'
-        self.key = 'some.statistics.key'
+        self.endpoint = Endpoint.objects.create(url='https://iar-backend.invalid/')
+        self.key = StatisticKey.objects.create(path='some.statistics.key')
         self.then = timezone.make_aware(datetime.datetime(
             year=2013, month=12, day=11, hour=10, minute=9, second=8
         ))
+        self.snapshot = Snapshot.objects.create(endpoint=self.endpoint, fetched_at=self.then)
 
     def test_uniqueness(self):
         """An endpoint, key, fetched_at tuple must be unique."""
         Statistic.objects.create(
-            endpoint=self.endpoint, key=self.key, fetched_at=self.then,
+            endpoint=self.endpoint, key=self.key, snapshot=self.snapshot, fetched_at=self.then,
             numeric_value=123
         )
 
         with self.assertRaises(django.db.IntegrityError):
             Statistic.objects.create(
-                endpoint=self.endpoint, key=self.key, fetched_at=self.then,
-                numeric_value=456
+                endpoint=self.endpoint, key=self.key, snapshot=self.snapshot,
+                fetched_at=self.then, numeric_value=456
             )
 
+    def test_snapshot_uniqueness(self):
+        """An endpoint can only have one snapshot for a given fetched_at time."""
+        with self.assertRaises(django.db.IntegrityError):
+            Snapshot.objects.create(endpoint=self.endpoint, fetched_at=self.then)
+
 
 class StatisticCreateTests(TestCase):
     def setUp(self):
@@ -60,10 +74,10 @@ class StatisticCreateTests(TestCase):
             self.assertIsNotNone(o.pk)
 
         # Test an object was created
-        qs = Statistic.objects.filter(key='asset_counts.by_institution.INSTA.total')
+        qs = Statistic.objects.filter(key__path='asset_counts.by_institution.INSTA.total')
         self.assertEqual(qs.count(), 1)
         o = qs.first()
-        self.assertEqual(o.endpoint, self.endpoint)
+        self.assertEqual(o.endpoint.url, self.endpoint)
         self.assertEqual(o.fetched_at, self.then)
         self.assertEqual(o.numeric_value, 7)
 
@@ -78,13 +92,98 @@ class StatisticCreateTests(TestCase):
         now.assert_called_with()
 
         # Test an object was created with the right fetched_at
-        qs = Statistic.objects.filter(key='asset_counts.by_institution.INSTB.total')
+        qs = Statistic.objects.filter(key__path='asset_counts.by_institution.INSTB.total')
         self.assertEqual(qs.count(), 1)
         o = qs.first()
-        self.assertEqual(o.endpoint, self.endpoint)
+        self.assertEqual(o.endpoint.url, self.endpoint)
         self.assertEqual(o.fetched_at, self.then)
         self.assertEqual(o.numeric_value, 103)
 
+    def test_create_from_response_count_only(self):
+        """Creating objects without returning them returns the number created."""
+        count = Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=self.response_body, fetched_at=self.then,
+            return_objects=False
+        )
+        self.assertEqual(count, 6)
+        self.assertEqual(Statistic.objects.filter(endpoint__url=self.endpoint).count(), 6)
+
+    def test_create_from_response_batches_inserts(self):
+        """Statistics are inserted in batches rather than one query per key."""
+        # COPY does not go through Django's query logging so test the INSERT path only.
+        Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=self.response_body, fetched_at=self.then - HOUR)
+
+        # One savepoint, one endpoint lookup, one lookup of a later snapshot, one snapshot
+        # INSERT, three key lookups, three INSERTs of at most two rows each, three latest value
+        # upserts, three hourly and three daily rollup upserts, one snapshot UPDATE, one endpoint
+        # UPDATE and one savepoint release. The endpoint and keys already exist.
+        with self.settings(GATHERSTATS_INGEST_USE_COPY=False), self.assertNumQueries(22):
+            count = Statistic.objects.create_from_stats_response(
+                endpoint=self.endpoint, body=self.response_body, fetched_at=self.then,
+                batch_size=2, return_objects=False
+            )
+        self.assertEqual(count, 6)
+        self.assertEqual(Statistic.objects.filter(endpoint__url=self.endpoint).count(), 12)
+
+    def test_snapshot_created(self):
+        """A snapshot is created for each response."""
+        duration = datetime.timedelta(seconds=2)
+        objects = Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=self.response_body, fetched_at=self.then,
+            fetch_duration=duration
+        )
+
+        snapshot = Snapshot.objects.get()
+        self.assertEqual(snapshot.endpoint.url, self.endpoint)
+        self.assertEqual(snapshot.fetched_at, self.then)
+        self.assertEqual(snapshot.key_count, 6)
+        self.assertEqual(snapshot.fetch_duration, duration)
+        self.assertEqual(len(snapshot.body_hash), 64)
+        for o in objects:
+            self.assertEqual(o.snapshot, snapshot)
+
+    def test_snapshot_body_hash(self):
+        """The snapshot body hash does not depend on key ordering and may be overridden."""
+        reordered_body = dict(reversed(list(self.response_body.items())))
+        reordered_body['asset_counts'] = dict(
+            reversed(list(self.response_body['asset_counts'].items())))
+        Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=self.response_body, fetched_at=self.then)
+        Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=reordered_body, fetched_at=self.then + HOUR)
+        Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=self.response_body, fetched_at=self.then + 2 * HOUR,
+            body_hash='0' * 64)
+
+        hashes = list(Snapshot.objects.order_by('fetched_at').values_list('body_hash', flat=True))
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertEqual(hashes[2], '0' * 64)
+
+    def test_latest_snapshot(self):
+        """The latest snapshot for an endpoint can be retrieved."""
+        for fetched_at in [self.then + HOUR, self.then, self.then - HOUR]:
+            Statistic.objects.create_from_stats_response(
+                endpoint=self.endpoint, body=self.response_body, fetched_at=fetched_at)
+        Statistic.objects.create_from_stats_response(
+            endpoint='https://other.invalid/', body=self.response_body,
+            fetched_at=self.then + 2 * HOUR)
+
+        self.assertEqual(
+            Snapshot.objects.latest_for_endpoint(self.endpoint).fetched_at, self.then + HOUR)
+        with self.assertRaises(Snapshot.DoesNotExist):
+            Snapshot.objects.latest_for_endpoint('https://unknown.invalid/')
+
+    def test_endpoints_and_keys_interned(self):
+        """Endpoints and keys are stored once however many times they are fetched."""
+        for fetched_at in [self.then, self.then + HOUR]:
+            Statistic.objects.create_from_stats_response(
+                endpoint=self.endpoint, body=self.response_body, fetched_at=fetched_at)
+
+        self.assertEqual(Statistic.objects.count(), 12)
+        self.assertEqual(Endpoint.objects.count(), 1)
+        self.assertEqual(StatisticKey.objects.count(), 6)
+
     def test_atomicity(self):
         """Objects are not created if there is a failure."""
         self.response_body['some'] = {
@@ -106,6 +205,633 @@ class StatisticCreateTests(TestCase):
         self.assertEqual(Statistic.objects.all().count(), 0)
 
 
+class DeltaStorageTests(TestCase):
+    def setUp(self):
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        self.bodies = [
+            {'a': 1, 'b': {'c': 2, 'd': 3}},
+            {'a': 1, 'b': {'c': 4, 'd': 3}},
+            {'a': 5, 'b': {'c': 4, 'd': 3}, 'e': 6},
+        ]
+
+    def ingest(self, body, fetched_at, delta=True):
+        return Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=body, fetched_at=fetched_at, delta=delta,
+            return_objects=False)
+
+    def test_only_changes_recorded(self):
+        """Only new or changed values are recorded."""
+        counts = [
+            self.ingest(body, self.then + idx * HOUR) for idx, body in enumerate(self.bodies)
+        ]
+        self.assertEqual(counts, [3, 1, 2])
+
+        snapshots = list(Snapshot.objects.order_by('fetched_at'))
+        self.assertEqual([s.key_count for s in snapshots], [3, 3, 4])
+        self.assertTrue(all(s.delta for s in snapshots))
+
+    def test_delta_setting(self):
+        """The delta setting is used by default."""
+        self.ingest(self.bodies[0], self.then)
+        with self.settings(GATHERSTATS_DELTA_STORAGE=True):
+            self.assertEqual(self.ingest(self.bodies[1], self.then + HOUR, delta=None), 1)
+        with self.settings(GATHERSTATS_DELTA_STORAGE=False):
+            self.assertEqual(self.ingest(self.bodies[2], self.then + 2 * HOUR, delta=None), 4)
+
+    def test_out_of_order(self):
+        """Values are all recorded if a response is recorded out of order."""
+        self.ingest(self.bodies[0], self.then)
+        self.assertEqual(self.ingest(self.bodies[0], self.then - HOUR), 3)
+        self.assertFalse(Snapshot.objects.get(fetched_at=self.then - HOUR).delta)
+
+    def test_out_of_order_carried_values(self):
+        """A response recorded out of order does not change the values reconstructed for later
+        snapshots which did not record them.
+
+        """
+        self.ingest({'a': 1, 'b': 2}, self.then)
+        self.assertEqual(self.ingest({'a': 1, 'b': 3}, self.then + 2 * HOUR), 1)
+        self.assertEqual(self.ingest({'a': 5, 'b': 3}, self.then + HOUR), 2)
+
+        def values_at(when):
+            return dict(
+                Statistic.objects.values_at(self.endpoint, when)
+                .values_list('key__path', 'numeric_value'))
+
+        self.assertEqual(values_at(self.then + HOUR), {'a': 5, 'b': 3})
+        self.assertEqual(values_at(self.then + 2 * HOUR), {'a': 1, 'b': 3})
+        self.assertEqual(
+            Statistic.objects.filter(fetched_at=self.then + 2 * HOUR).count(), 2)
+
+        # Later responses are still compared with the latest values.
+        self.assertEqual(self.ingest({'a': 1, 'b': 3}, self.then + 3 * HOUR), 0)
+        self.assertEqual(values_at(self.then + 3 * HOUR), {'a': 1, 'b': 3})
+
+    def test_out_of_order_before_unchanged(self):
+        """A response recorded out of order before an unchanged snapshot turns it into a delta
+        snapshot recording the values it carried forward.
+
+        """
+        self.ingest({'a': 1}, self.then)
+        Snapshot.objects.create_unchanged(self.endpoint, fetched_at=self.then + 2 * HOUR)
+        self.ingest({'a': 5}, self.then + HOUR)
+
+        snapshot = Snapshot.objects.get(fetched_at=self.then + 2 * HOUR)
+        self.assertFalse(snapshot.unchanged)
+        self.assertTrue(snapshot.delta)
+        self.assertEqual(
+            dict(Statistic.objects.values_at(self.endpoint, self.then + 2 * HOUR)
+                 .values_list('key__path', 'numeric_value')),
+            {'a': 1})
+
+    def test_values_at(self):
+        """Full sets of values can be reconstructed at any time."""
+        for idx, body in enumerate(self.bodies):
+            self.ingest(body, self.then + idx * HOUR)
+
+        def values_at(when):
+            return dict(
+                Statistic.objects.values_at(self.endpoint, when)
+                .values_list('key__path', 'numeric_value'))
+
+        self.assertEqual(values_at(self.then - HOUR), {})
+        for idx, body in enumerate(self.bodies):
+            expected = dict(_flatten_dict(body))
+            self.assertEqual(values_at(self.then + idx * HOUR), expected)
+            self.assertEqual(values_at(self.then + idx * HOUR + HOUR / 2), expected)
+        self.assertEqual(values_at(self.then + 10 * HOUR), dict(_flatten_dict(self.bodies[-1])))
+
+        # Other endpoints are not included
+        Statistic.objects.create_from_stats_response(
+            endpoint='https://other.invalid/', body={'z': 1}, fetched_at=self.then)
+        self.assertEqual(values_at(self.then + 10 * HOUR), dict(_flatten_dict(self.bodies[-1])))
+        self.assertEqual(
+            Statistic.objects.values_at('https://unknown.invalid/', self.then).count(), 0)
+
+
+class UnchangedResponseTests(TestCase):
+    def setUp(self):
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        self.body = {'a': 1, 'b': {'c': 2}}
+
+    def ingest(self, body, fetched_at, **kwargs):
+        return Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=body, fetched_at=fetched_at, return_objects=False,
+            skip_unchanged=True, **kwargs)
+
+    def test_unchanged_skipped(self):
+        """A response identical to the previous one only records an unchanged snapshot."""
+        self.assertEqual(self.ingest(self.body, self.then, etag='"v1"'), 2)
+        self.assertEqual(self.ingest(self.body, self.then + HOUR), 0)
+        self.assertEqual(Statistic.objects.count(), 2)
+
+        first, second = Snapshot.objects.order_by('fetched_at')
+        self.assertFalse(first.unchanged)
+        self.assertTrue(second.unchanged)
+        self.assertEqual(second.key_count, 2)
+        self.assertEqual(second.body_hash, first.body_hash)
+
+        endpoint = Endpoint.objects.get(url=self.endpoint)
+        self.assertEqual(endpoint.last_fetched_at, self.then + HOUR)
+        self.assertEqual(endpoint.body_hash, first.body_hash)
+        self.assertEqual(endpoint.etag, '"v1"')
+
+        # A changed response is recorded in full.
+        self.assertEqual(self.ingest({'a': 1, 'b': {'c': 3}}, self.then + 2 * HOUR), 2)
+
+    def test_out_of_order(self):
+        """A response fetched before the latest one is never skipped."""
+        self.ingest(self.body, self.then)
+        self.assertEqual(self.ingest(self.body, self.then - HOUR), 2)
+        self.assertEqual(Endpoint.objects.get(url=self.endpoint).last_fetched_at, self.then)
+
+    def test_delta(self):
+        """Unchanged snapshots are not used as the base of delta storage."""
+        self.ingest(self.body, self.then, delta=True)
+        self.ingest(self.body, self.then + HOUR, delta=True)
+        self.assertEqual(self.ingest({'a': 2, 'b': {'c': 2}}, self.then + 2 * HOUR, delta=True), 1)
+        self.assertEqual(
+            dict(Statistic.objects.values_at(self.endpoint, self.then + 2 * HOUR)
+                 .values_list('key__path', 'numeric_value')),
+            {'a': 2, 'b.c': 2})
+
+    def test_create_unchanged(self):
+        """Unchanged snapshots record the validators of a not modified response."""
+        self.ingest(self.body, self.then)
+        snapshot = Snapshot.objects.create_unchanged(
+            self.endpoint, fetched_at=self.then + HOUR, etag='"v2"')
+        self.assertTrue(snapshot.unchanged)
+        self.assertEqual(snapshot.key_count, 2)
+        self.assertEqual(Endpoint.objects.get(url=self.endpoint).etag, '"v2"')
+        self.assertEqual(
+            set(LatestStatistic.objects.values_list('fetched_at', flat=True)),
+            {self.then + HOUR})
+
+    def test_create_unchanged_after_delta(self):
+        """Unchanged snapshots after delta snapshots observe the values carried forward."""
+        self.ingest(self.body, self.then, delta=True)
+        self.ingest({'a': 2, 'b': {'c': 2}}, self.then + HOUR, delta=True)
+        Snapshot.objects.create_unchanged(self.endpoint, fetched_at=self.then + 2 * HOUR)
+        self.assertEqual(
+            dict(StatisticRollup.objects.filter(period=StatisticRollup.DAY)
+                 .values_list('key__path', 'total')),
+            {'a': 5, 'b.c': 6})
+
+
+class ConflictPolicyTests(TestCase):
+    def setUp(self):
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        self.body = {'a': 1, 'b': {'c': 2}}
+
+    def ingest(self, body, fetched_at=None, **kwargs):
+        return Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=body, fetched_at=fetched_at or self.then,
+            return_objects=False, **kwargs)
+
+    def values(self):
+        return dict(Statistic.objects.values_list('key__path', 'numeric_value'))
+
+    def test_error(self):
+        """By default, a re-delivered response raises an error and writes nothing."""
+        self.ingest(self.body)
+        with self.assertRaises(django.db.IntegrityError):
+            self.ingest({'a': 5, 'd': 6})
+        self.assertEqual(self.values(), {'a': 1, 'b.c': 2})
+
+    def test_skip(self):
+        """With the skip policy, existing statistics are kept and new keys are added."""
+        self.ingest(self.body)
+        with metrics.GatherMetrics(self.endpoint).recording() as gather_metrics:
+            self.assertEqual(self.ingest({'a': 5, 'b': {'c': 2}, 'd': 6}, on_conflict='skip'), 1)
+        self.assertEqual(self.values(), {'a': 1, 'b.c': 2, 'd': 6})
+        self.assertEqual(gather_metrics.counts['skipped'], 2)
+        self.assertEqual(Snapshot.objects.get().key_count, 3)
+
+        # Rollups and latest values only see the new statistic.
+        self.assertEqual(
+            StatisticRollup.objects.get(key__path='a', period=StatisticRollup.HOUR).sample_count,
+            1)
+        self.assertEqual(LatestStatistic.objects.get(key__path='a').numeric_value, 1)
+        self.assertEqual(LatestStatistic.objects.get(key__path='d').numeric_value, 6)
+
+    def test_overwrite(self):
+        """With the overwrite policy, changed values replace existing ones."""
+        self.ingest(self.body)
+        with metrics.GatherMetrics(self.endpoint).recording() as gather_metrics:
+            self.assertEqual(
+                self.ingest({'a': 5, 'b': {'c': 2}, 'd': 6}, on_conflict='overwrite'), 2)
+        self.assertEqual(self.values(), {'a': 5, 'b.c': 2, 'd': 6})
+        self.assertEqual(gather_metrics.counts['overwritten'], 1)
+        self.assertEqual(gather_metrics.counts['skipped'], 1)
+
+        rollup = StatisticRollup.objects.get(key__path='a', period=StatisticRollup.HOUR)
+        self.assertEqual((rollup.sample_count, rollup.total, rollup.last_value), (1, 5, 5))
+        self.assertEqual(LatestStatistic.objects.get(key__path='a').numeric_value, 5)
+
+    def test_setting(self):
+        """The default policy is taken from the GATHERSTATS_INGEST_ON_CONFLICT setting."""
+        self.ingest(self.body)
+        with self.settings(GATHERSTATS_INGEST_ON_CONFLICT='skip'):
+            self.assertEqual(self.ingest(self.body), 0)
+        with self.assertRaises(ValueError):
+            self.ingest(self.body, on_conflict='ignore')
+
+    @unittest.skipUnless(_can_return(django.db.connection), 'requires INSERT ... RETURNING')
+    def test_batched_queries(self):
+        """Skipped re-delivered statistics are written in one statement per batch which also
+        detects the existing ones.
+
+        """
+        body = {'k{}'.format(idx): idx for idx in range(10)}
+        self.ingest(body)
+        body['k10'] = 10
+        with CaptureQueriesContext(django.db.connection) as queries:
+            self.assertEqual(self.ingest(body, on_conflict='skip', batch_size=5), 1)
+        statistic_queries = [
+            query['sql'] for query in queries.captured_queries
+            if '"gatherstats_statistic"' in query['sql']]
+        self.assertEqual(len(statistic_queries), 3)
+        for sql in statistic_queries:
+            self.assertTrue(sql.startswith('INSERT INTO "gatherstats_statistic"'))
+            self.assertIn('ON CONFLICT', sql)
+            self.assertIn('RETURNING', sql)
+        self.assertEqual(
+            StatisticRollup.objects.get(key__path='k0', period=StatisticRollup.HOUR).sample_count,
+            1)
+
+    def test_delta_skip(self):
+        """Re-delivering a delta snapshot with the skip policy does not record values carried
+        forward from the previous snapshot again.
+
+        """
+        self.ingest({'a': 1, 'b': 2}, delta=True)
+        self.ingest({'a': 1, 'b': 3}, delta=True, fetched_at=self.then + HOUR)
+        self.assertEqual(
+            self.ingest({'a': 1, 'b': 3}, delta=True, fetched_at=self.then + HOUR,
+                        on_conflict='skip'),
+            0)
+        self.assertEqual(Statistic.objects.count(), 3)
+
+        rollup = StatisticRollup.objects.get(key__path='a', period=StatisticRollup.DAY)
+        self.assertEqual((rollup.sample_count, rollup.total), (2, 2))
+
+    def test_delta_overwrite(self):
+        """Re-delivering a delta snapshot with the overwrite policy treats values carried
+        forward from the previous snapshot as existing values.
+
+        """
+        self.ingest({'a': 1, 'b': 2}, delta=True)
+        self.ingest({'a': 1, 'b': 3}, delta=True, fetched_at=self.then + HOUR)
+        self.assertEqual(
+            self.ingest({'a': 1, 'b': 3}, delta=True, fetched_at=self.then + HOUR,
+                        on_conflict='overwrite'),
+            0)
+        self.assertEqual(Statistic.objects.count(), 3)
+        self.assertEqual(
+            self.ingest({'a': 4, 'b': 3}, delta=True, fetched_at=self.then + HOUR,
+                        on_conflict='overwrite'),
+            1)
+        self.assertEqual(
+            dict(Statistic.objects.values_at(self.endpoint, self.then + HOUR)
+                 .values_list('key__path', 'numeric_value')),
+            {'a': 4, 'b': 3})
+
+        rollup = StatisticRollup.objects.get(key__path='a', period=StatisticRollup.DAY)
+        self.assertEqual((rollup.sample_count, rollup.total), (2, 5))
+
+    def test_overwrite_before_delta(self):
+        """Overwriting values does not change the values reconstructed for later snapshots
+        which carried them forward.
+
+        """
+        self.ingest({'a': 1, 'b': 2}, delta=True)
+        self.ingest({'a': 1, 'b': 3}, delta=True, fetched_at=self.then + HOUR)
+        self.ingest({'a': 4, 'b': 2}, on_conflict='overwrite')
+        self.assertEqual(
+            dict(Statistic.objects.values_at(self.endpoint, self.then)
+                 .values_list('key__path', 'numeric_value')),
+            {'a': 4, 'b': 2})
+        self.assertEqual(
+            dict(Statistic.objects.values_at(self.endpoint, self.then + HOUR)
+                 .values_list('key__path', 'numeric_value')),
+            {'a': 1, 'b': 3})
+
+    def test_overwrite_unchanged(self):
+        """Overwriting an unchanged snapshot records only the values which differ from those it
+        carried forward.
+
+        """
+        self.ingest(self.body, fetched_at=self.then - HOUR)
+        Snapshot.objects.create_unchanged(self.endpoint, fetched_at=self.then)
+        self.assertEqual(self.ingest({'a': 5, 'b': {'c': 2}}, on_conflict='overwrite'), 1)
+
+        snapshot = Snapshot.objects.get(fetched_at=self.then)
+        self.assertFalse(snapshot.unchanged)
+        self.assertTrue(snapshot.delta)
+        rollup = StatisticRollup.objects.get(key__path='a', period=StatisticRollup.DAY)
+        self.assertEqual((rollup.sample_count, rollup.total), (2, 6))
+        rollup = StatisticRollup.objects.get(key__path='b.c', period=StatisticRollup.DAY)
+        self.assertEqual((rollup.sample_count, rollup.total), (2, 4))
+
+    def test_unchanged(self):
+        """Re-delivered not modified responses return the existing snapshot."""
+        self.ingest(self.body)
+        snapshot = Snapshot.objects.create_unchanged(
+            self.endpoint, fetched_at=self.then, on_conflict='skip')
+        self.assertFalse(snapshot.unchanged)
+
+
+class LatestStatisticTests(TestCase):
+    def setUp(self):
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+
+    def ingest(self, body, fetched_at, delta=False):
+        Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body=body, fetched_at=fetched_at, delta=delta,
+            return_objects=False)
+
+    def latest(self):
+        return {
+            path: (value, fetched_at)
+            for path, value, fetched_at in LatestStatistic.objects.for_endpoint(self.endpoint)
+            .values_list('key__path', 'numeric_value', 'fetched_at')
+        }
+
+    def test_latest_values(self):
+        """The latest value of each key is recorded."""
+        self.ingest({'a': 1, 'b': 2}, self.then)
+        self.ingest({'a': 3, 'c': 4}, self.then + HOUR)
+        self.assertEqual(self.latest(), {
+            'a': (3, self.then + HOUR), 'b': (2, self.then), 'c': (4, self.then + HOUR),
+        })
+
+        # Other endpoints are not included
+        Statistic.objects.create_from_stats_response(
+            endpoint='https://other.invalid/', body={'a': 5}, fetched_at=self.then + 2 * HOUR)
+        self.assertEqual(self.latest()['a'], (3, self.then + HOUR))
+
+    def test_out_of_order(self):
+        """Values fetched before the latest value do not replace it."""
+        self.ingest({'a': 1}, self.then)
+        self.ingest({'a': 2}, self.then - HOUR)
+        self.assertEqual(self.latest(), {'a': (1, self.then)})
+
+    def test_delta(self):
+        """Unchanged values are recorded as observed in delta mode."""
+        self.ingest({'a': 1}, self.then, delta=True)
+        self.ingest({'a': 1}, self.then + HOUR, delta=True)
+        self.assertEqual(self.latest(), {'a': (1, self.then + HOUR)})
+
+    def test_constant_cost(self):
+        """Reading the latest values is one query however much history there is."""
+        for idx in range(5):
+            self.ingest({'a': idx, 'b': idx}, self.then + idx * HOUR)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.latest()), 2)
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        self.values = [4, 2, 6, 6]
+
+    def ingest(self, value, fetched_at, delta=False, skip_unchanged=False):
+        Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body={'a': value}, fetched_at=fetched_at, delta=delta,
+            return_objects=False, skip_unchanged=skip_unchanged)
+
+    def assertRollup(self, rollup, sample_count, total, minimum, maximum, last_value):
+        self.assertEqual(
+            (rollup.sample_count, rollup.total, rollup.minimum, rollup.maximum,
+             rollup.last_value),
+            (sample_count, total, minimum, maximum, last_value))
+
+    def test_incremental(self):
+        """Rollups are updated as statistics are created."""
+        # The third value falls in the next hour and is recorded out of order.
+        for value, minutes in zip(self.values, [0, 20, 60, 40]):
+            self.ingest(value, self.then + datetime.timedelta(minutes=minutes))
+
+        hours = list(StatisticRollup.objects.series(self.endpoint, 'a', StatisticRollup.HOUR))
+        self.assertEqual(len(hours), 2)
+        self.assertEqual(hours[0].period_start, self.then.replace(minute=0, second=0))
+        self.assertRollup(hours[0], 3, 12, 2, 6, 6)
+        self.assertEqual(hours[0].mean, 4)
+        self.assertRollup(hours[1], 1, 6, 6, 6, 6)
+
+        day, = StatisticRollup.objects.series(self.endpoint, 'a', StatisticRollup.DAY)
+        self.assertEqual(day.period_start, self.then.replace(hour=0, minute=0, second=0))
+        self.assertRollup(day, 4, 18, 2, 6, 6)
+
+    def test_delta(self):
+        """Rollups include unchanged values which were not recorded as statistics."""
+        for idx, value in enumerate(self.values):
+            self.ingest(value, self.then + idx * datetime.timedelta(minutes=10), delta=True)
+        self.assertEqual(Statistic.objects.count(), 3)
+        day, = StatisticRollup.objects.series(self.endpoint, 'a', StatisticRollup.DAY)
+        self.assertRollup(day, 4, 18, 2, 6, 6)
+
+    def test_unchanged(self):
+        """Rollups include the values of unchanged responses."""
+        for idx, value in enumerate([10, 10, 10, 10, 10, 20]):
+            self.ingest(
+                value, self.then + idx * datetime.timedelta(minutes=10), skip_unchanged=True)
+        self.assertEqual(Snapshot.objects.filter(unchanged=True).count(), 4)
+        day, = StatisticRollup.objects.series(self.endpoint, 'a', StatisticRollup.DAY)
+        self.assertRollup(day, 6, 70, 10, 20, 20)
+
+    def test_disabled(self):
+        """Rollups are not maintained if no periods are configured."""
+        with self.settings(GATHERSTATS_ROLLUP_PERIODS=()):
+            self.ingest(1, self.then)
+        self.assertEqual(StatisticRollup.objects.count(), 0)
+
+    def test_rebuild(self):
+        """Rollups can be computed from existing statistics."""
+        with self.settings(GATHERSTATS_ROLLUP_PERIODS=()):
+            for idx, value in enumerate(self.values):
+                self.ingest(value, self.then + idx * HOUR)
+
+        day_start = self.then.replace(hour=0, minute=0, second=0)
+        day_end = day_start + datetime.timedelta(days=1)
+        self.assertEqual(StatisticRollup.objects.rebuild(day_start, day_end), 5)
+
+        hours = list(StatisticRollup.objects.series(self.endpoint, 'a', StatisticRollup.HOUR))
+        self.assertEqual([hour.last_value for hour in hours], self.values)
+        day, = StatisticRollup.objects.series(self.endpoint, 'a', StatisticRollup.DAY)
+        self.assertRollup(day, 4, 18, 2, 6, 6)
+
+        # Existing rollups are only replaced if requested.
+        StatisticRollup.objects.update(sample_count=100)
+        StatisticRollup.objects.rebuild(day_start, day_end)
+        self.assertEqual(StatisticRollup.objects.filter(sample_count=100).count(), 5)
+        StatisticRollup.objects.rebuild(day_start, day_end, replace=True)
+        self.assertEqual(StatisticRollup.objects.filter(sample_count=100).count(), 0)
+
+    def test_prune(self):
+        """Old statistics are deleted apart from the latest value of each key."""
+        for idx, value in enumerate(self.values):
+            Statistic.objects.create_from_stats_response(
+                endpoint=self.endpoint, body={'a': value, 'b': idx},
+                fetched_at=self.then + idx * datetime.timedelta(days=1), delta=True)
+        self.assertEqual(Statistic.objects.count(), 7)
+
+        cutoff = self.then + datetime.timedelta(days=3)
+        expected = dict(
+            Statistic.objects.values_at(self.endpoint, cutoff).values_list('key__path', 'pk'))
+        self.assertEqual(Statistic.objects.prune(cutoff), 4)
+        self.assertEqual(
+            dict(Statistic.objects.values_at(self.endpoint, cutoff)
+                 .values_list('key__path', 'pk')),
+            expected)
+        self.assertEqual(Statistic.objects.filter(fetched_at__lt=cutoff).count(), 2)
+
+
+class InternCacheTests(TransactionTestCase):
+    def setUp(self):
+        for cache in [_endpoint_ids, _key_ids, _last_values]:
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    def test_lookups_cached_after_commit(self):
+        """Once an ingest commits, endpoint and key lookups are served from memory."""
+        body = {'foo': {'bar': 1, 'baz': 2}}
+        then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        Statistic.objects.create_from_stats_response(
+            endpoint='https://iar-backend.invalid/', body=body, fetched_at=then,
+            return_objects=False)
+
+        with CaptureQueriesContext(django.db.connection) as queries:
+            Statistic.objects.create_from_stats_response(
+                endpoint='https://iar-backend.invalid/', body=body, fetched_at=then + HOUR,
+                return_objects=False)
+
+        # The endpoint's latest response is still recorded.
+        for query in queries:
+            if query['sql'].startswith('SELECT'):
+                self.assertNotIn(Endpoint._meta.db_table, query['sql'])
+            self.assertNotIn(StatisticKey._meta.db_table, query['sql'])
+
+    def test_last_values_cached_after_commit(self):
+        """Once a delta ingest commits, the last values are not re-read from the database."""
+        then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        for idx in range(2):
+            Statistic.objects.create_from_stats_response(
+                endpoint='https://iar-backend.invalid/', body={'foo': {'bar': idx, 'baz': 2}},
+                fetched_at=then + idx * HOUR, delta=True)
+
+        with CaptureQueriesContext(django.db.connection) as queries:
+            count = Statistic.objects.create_from_stats_response(
+                endpoint='https://iar-backend.invalid/', body={'foo': {'bar': 3, 'baz': 2}},
+                fetched_at=then + 2 * HOUR, delta=True, return_objects=False)
+
+        self.assertEqual(count, 1)
+        for query in queries:
+            self.assertNotIn(StatisticKey._meta.db_table, query['sql'])
+
+        # A snapshot recorded elsewhere is noticed.
+        Snapshot.objects.create(
+            endpoint=Endpoint.objects.get(), fetched_at=then + 3 * HOUR)
+        count = Statistic.objects.create_from_stats_response(
+            endpoint='https://iar-backend.invalid/', body={'foo': {'bar': 3, 'baz': 2}},
+            fetched_at=then + 4 * HOUR, delta=True, return_objects=False)
+        self.assertEqual(count, 0)
+
+    def test_rolled_back_lookups_not_cached(self):
+        """Rows created by a rolled back transaction are not cached."""
+        with self.assertRaises(django.db.IntegrityError):
+            Statistic.objects.create_from_stats_response(
+                endpoint='https://iar-backend.invalid/', body={'foo': None})
+        self.assertEqual(Endpoint.objects.count(), 0)
+
+        Statistic.objects.create_from_stats_response(
+            endpoint='https://iar-backend.invalid/', body={'foo': 1})
+        self.assertEqual(Statistic.objects.get().key.path, 'foo')
+
+
+class StatisticKeyTests(TestCase):
+    def setUp(self):
+        Statistic.objects.create_from_stats_response(
+            endpoint='https://iar-backend.invalid/', body={
+                'asset_counts': {
+                    'all': {'total': 3},
+                    'by_institution': {
+                        'INSTB': {'total': 1, 'completed': 1},
+                        'INSTA': {'total': 2, 'completed': 0},
+                    },
+                },
+            })
+
+    def test_split_path(self):
+        self.assertEqual(_split_path('asset_counts.by_institution.UIS.total'), {
+            'depth': 4, 'parent': 'asset_counts.by_institution.UIS', 'leaf': 'total',
+            'dimension': 'institution', 'dimension_value': 'UIS',
+        })
+        self.assertEqual(_split_path('total'), {
+            'depth': 1, 'parent': '', 'leaf': 'total', 'dimension': '', 'dimension_value': '',
+        })
+        # A "by_" component needs a value and a leaf to follow it.
+        self.assertEqual(_split_path('counts.by_institution')['dimension'], '')
+        self.assertEqual(_split_path('counts.by_institution.UIS')['dimension'], '')
+        self.assertEqual(_split_path('counts.by_.UIS.total')['dimension'], '')
+
+    def test_ingest_sets_parts(self):
+        """Keys created when ingesting have their structured parts set."""
+        key = StatisticKey.objects.get(path='asset_counts.by_institution.INSTA.completed')
+        self.assertEqual(
+            (key.depth, key.parent, key.leaf, key.dimension, key.dimension_value),
+            (4, 'asset_counts.by_institution.INSTA', 'completed', 'institution', 'INSTA'))
+
+    def test_save_sets_parts(self):
+        key = StatisticKey.objects.create(path='a.b')
+        self.assertEqual((key.depth, key.parent, key.leaf), (2, 'a', 'b'))
+
+    def test_dimension_values(self):
+        self.assertEqual(
+            StatisticKey.objects.dimension_values('institution'), ['INSTA', 'INSTB'])
+        self.assertEqual(StatisticKey.objects.dimension_values('type'), [])
+
+    def test_in_dimension(self):
+        def paths(qs):
+            return set(qs.values_list('path', flat=True))
+
+        self.assertEqual(
+            paths(StatisticKey.objects.in_dimension('institution', leaf='total')),
+            {'asset_counts.by_institution.INSTA.total', 'asset_counts.by_institution.INSTB.total'})
+        self.assertEqual(
+            paths(StatisticKey.objects.in_dimension('institution', value='INSTB')),
+            {'asset_counts.by_institution.INSTB.total',
+             'asset_counts.by_institution.INSTB.completed'})
+
+
+class BatchedTests(TestCase):
+    def test_batched(self):
+        self.assertEqual(list(_batched(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(_batched([], 2)), [])
+
+    def test_bad_batch_size(self):
+        with self.assertRaises(ValueError):
+            list(_batched(range(5), 0))
+
+
+class CopyTextValueTests(TestCase):
+    def test_values(self):
+        """Values are formatted for PostgreSQL's COPY text format."""
+        self.assertEqual(_copy_text_value(None), '\\N')
+        self.assertEqual(_copy_text_value(1.5), '1.5')
+        self.assertEqual(_copy_text_value(float('nan')), 'NaN')
+        self.assertEqual(_copy_text_value(float('-inf')), '-Infinity')
+        self.assertEqual(
+            _copy_text_value(timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))),
+            '2013-12-11T10:09:08+00:00')
+        self.assertEqual(_copy_text_value('a\tb\\c\nd'), 'a\\tb\\\\c\\nd')
+
+
 class FlattenDictTests(TestCase):
     def test_flatten_dict(self):
         items = set(_flatten_dict({
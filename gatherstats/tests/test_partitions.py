@@ -0,0 +1,100 @@
+"""
+Test partitioning of the statistic table.
+
+"""
+import datetime
+import io
+import unittest
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from gatherstats import partitions
+from gatherstats.models import Statistic
+
+
+class PartitionBoundsTest(TestCase):
+    def test_partition_start(self):
+        when = timezone.make_aware(datetime.datetime(2018, 1, 31, 23, 30))
+        self.assertEqual(
+            partitions.partition_start(when, 'month'),
+            datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual(
+            partitions.partition_start(when, 'day'),
+            datetime.datetime(2018, 1, 31, tzinfo=datetime.timezone.utc))
+        with self.assertRaises(ValueError):
+            partitions.partition_start(when, 'week')
+
+    def test_next_partition_start(self):
+        start = datetime.datetime(2018, 1, 31, tzinfo=datetime.timezone.utc)
+        self.assertEqual(
+            partitions.next_partition_start(start.replace(day=1), 'month'),
+            start.replace(month=2, day=1))
+        self.assertEqual(
+            partitions.next_partition_start(start.replace(month=12, day=1), 'month'),
+            start.replace(year=2019, month=1, day=1))
+        self.assertEqual(
+            partitions.next_partition_start(start, 'day'), start.replace(month=2, day=1))
+
+    def test_partition_name(self):
+        start = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(
+            partitions.partition_name(start, 'month'), 'gatherstats_statistic_p2018_01')
+        self.assertEqual(
+            partitions.partition_name(start, 'day'), 'gatherstats_statistic_p2018_01_01')
+
+
+class PartitionstatsUnsupportedTest(TestCase):
+    @unittest.skipIf(connection.vendor == 'postgresql', 'partitioning is supported')
+    def test_unsupported(self):
+        """The command fails on databases which do not support partitioning."""
+        self.assertFalse(partitions.is_partitioned())
+        with self.assertRaises(CommandError):
+            call_command('partitionstats', stdout=io.StringIO())
+
+
+class PartitionstatsTest(TestCase):
+    def setUp(self):
+        if not partitions.is_supported():
+            self.skipTest('partitioning requires PostgreSQL 11 or later')
+
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.now = timezone.now()
+        self.old = self.now - datetime.timedelta(days=400)
+        for fetched_at in (self.old, self.now):
+            Statistic.objects.create_from_stats_response(
+                endpoint=self.endpoint, body={'a': 1, 'b': 2}, fetched_at=fetched_at,
+                return_objects=False)
+
+    def test_convert(self):
+        """Converting keeps all statistics and creates partitions covering them."""
+        with self.assertRaises(CommandError):
+            call_command('partitionstats', stdout=io.StringIO())
+
+        with self.settings(GATHERSTATS_PARTITION_INTERVAL='month'):
+            call_command('partitionstats', '--convert', '--ahead', '2', stdout=io.StringIO())
+        self.assertTrue(partitions.is_partitioned())
+        self.assertEqual(Statistic.objects.count(), 4)
+
+        names = [name for name, _, _ in partitions.list_partitions()]
+        self.assertEqual(names[0], partitions.partition_name(
+            partitions.partition_start(self.old, 'month'), 'month'))
+        self.assertEqual(names[-1], partitions.partition_name(
+            partitions.partition_start(self.now + datetime.timedelta(days=62), 'month'), 'month'))
+
+        # Ingest continues to work and the unique constraint is retained.
+        Statistic.objects.create_from_stats_response(
+            endpoint=self.endpoint, body={'a': 2}, return_objects=False)
+        self.assertEqual(Statistic.objects.count(), 5)
+
+    def test_retention(self):
+        """Expired partitions are detached."""
+        call_command('partitionstats', '--convert', stdout=io.StringIO())
+        out = io.StringIO()
+        call_command('partitionstats', '--retention', '365d', '--drop', stdout=out)
+        self.assertIn('Dropped partition', out.getvalue())
+        self.assertEqual(Statistic.objects.filter(fetched_at=self.old).count(), 0)
+        self.assertEqual(Statistic.objects.filter(fetched_at=self.now).count(), 2)
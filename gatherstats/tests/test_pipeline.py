@@ -0,0 +1,122 @@
+"""
+Test the fetch, flatten and write pipeline.
+
+"""
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from gatherstats.pipeline import Pipeline
+
+
+class PipelineTests(SimpleTestCase):
+    def test_results(self):
+        """Every task passes through each stage and is written from the calling thread."""
+        writer_threads = set()
+
+        def write(task, value):
+            writer_threads.add(threading.current_thread())
+            return value + 1
+
+        pipeline = Pipeline(
+            lambda task: task * 10, lambda task, value: value * 2, write, fetcher_count=3,
+            flatten_count=2)
+        results = list(pipeline.run(range(20)))
+
+        self.assertEqual(
+            sorted((task, value, error) for task, value, error in results),
+            [(task, task * 20 + 1, None) for task in range(20)])
+        self.assertEqual(writer_threads, {threading.current_thread()})
+
+    def test_task_errors(self):
+        """A task failing in any stage is reported and does not stop the others."""
+        def fail_on(bad):
+            def stage(task, *args):
+                if task == bad:
+                    raise ValueError(task)
+                return task
+            return stage
+
+        pipeline = Pipeline(fail_on(1), fail_on(2), fail_on(3), fetcher_count=2)
+        results = {task: (value, error) for task, value, error in pipeline.run(range(5))}
+
+        self.assertEqual(set(results), set(range(5)))
+        for task in (1, 2, 3):
+            self.assertIsNone(results[task][0])
+            self.assertEqual(results[task][1].args, (task,))
+        for task in (0, 4):
+            self.assertEqual(results[task], (task, None))
+
+    def test_backpressure(self):
+        """Fetching waits for a slow writer once the queues are full."""
+        lock = threading.Lock()
+        counts = {'fetched': 0, 'written': 0, 'waiting': []}
+
+        def fetch(task):
+            with lock:
+                counts['fetched'] += 1
+            return task
+
+        def write(task, value):
+            time.sleep(0.01)
+            with lock:
+                counts['waiting'].append(counts['fetched'] - counts['written'])
+                counts['written'] += 1
+
+        pipeline = Pipeline(
+            fetch, lambda task, value: value, write, fetcher_count=2, flatten_count=1,
+            queue_size=1)
+        list(pipeline.run(range(30)))
+
+        # Each queue and each thread of the fetch and flatten stages hold at most one response.
+        self.assertLessEqual(max(counts['waiting']), 1 + 1 + 1 + 2 + 1)
+        self.assertEqual(counts['written'], 30)
+
+    def test_lazy_tasks(self):
+        """Tasks are taken from the iterable as they are needed."""
+        taken = []
+
+        def tasks():
+            for task in range(100):
+                taken.append(task)
+                yield task
+
+        results = Pipeline(
+            lambda task: task, lambda task, value: value, lambda task, value: value,
+            queue_size=1).run(tasks())
+        next(results)
+        time.sleep(0.1)
+        self.assertLess(len(taken), 10)
+        results.close()
+
+    def test_close_stops_threads(self):
+        """Closing the results stops every thread of the pipeline."""
+        results = Pipeline(
+            lambda task: task, lambda task, value: value, lambda task, value: value,
+            fetcher_count=4, flatten_count=2, queue_size=1).run(range(1000))
+        next(results)
+        results.close()
+        self.assertEqual(
+            [thread for thread in threading.enumerate()
+             if thread.name.startswith('gatherstats-')], [])
+
+    def test_task_iteration_error(self):
+        """An error raised while iterating over the tasks is re-raised by the writer."""
+        def tasks():
+            yield 1
+            raise RuntimeError('no more tasks')
+
+        pipeline = Pipeline(
+            lambda task: task, lambda task, value: value, lambda task, value: value)
+        with self.assertRaisesRegex(RuntimeError, 'no more tasks'):
+            list(pipeline.run(tasks()))
+        self.assertEqual(
+            [thread for thread in threading.enumerate()
+             if thread.name.startswith('gatherstats-')], [])
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            Pipeline(None, None, None, fetcher_count=0)
+        with self.assertRaises(ValueError):
+            Pipeline(None, None, None, queue_size=0)
@@ -0,0 +1,184 @@
+"""
+Test the spool of fetched responses and the flushstats management command.
+
+"""
+import datetime
+import io
+import json
+import os
+import tempfile
+import unittest.mock as mock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError
+from django.test import TestCase
+from django.utils import timezone
+
+from gatherstats.models import Snapshot, Statistic, StatisticRollup
+from gatherstats.spool import Spool
+
+from .test_gatherstats import STATS_FIXTURE, STATS_ITEMS, temporary_file_with_contents
+
+HOUR = datetime.timedelta(hours=1)
+
+
+class SpoolTests(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.spool = Spool(os.path.join(tmp_dir.name, 'spool'))
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8, 7))
+
+    def test_flush(self):
+        """Entries are written with their fetch times in order of fetch time."""
+        self.spool.append(self.endpoint, {'a': 2}, self.then + HOUR, etag='"v2"')
+        self.spool.append(
+            self.endpoint, {'a': 1}, self.then, fetch_duration=datetime.timedelta(seconds=2))
+        self.assertEqual(len(self.spool), 2)
+
+        result = self.spool.flush()
+
+        self.assertEqual(result, (2, 0, 0, None))
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(
+            list(Statistic.objects.order_by('fetched_at').values_list(
+                'fetched_at', 'numeric_value')),
+            [(self.then, 1), (self.then + HOUR, 2)])
+        self.assertEqual(
+            Snapshot.objects.get(fetched_at=self.then).fetch_duration,
+            datetime.timedelta(seconds=2))
+
+    def test_not_modified(self):
+        """Not modified responses are written as unchanged snapshots."""
+        self.spool.append(self.endpoint, {'a': 1}, self.then)
+        self.spool.append(self.endpoint, None, self.then + HOUR, etag='"v1"')
+        self.spool.flush()
+        self.assertTrue(Snapshot.objects.get(fetched_at=self.then + HOUR).unchanged)
+
+    def test_idempotent(self):
+        """Entries which have already been written are deleted without writing them again."""
+        path = self.spool.append(self.endpoint, {'a': 1}, self.then)
+        with open(path) as fobj:
+            contents = fobj.read()
+        self.spool.flush()
+
+        # As if the previous flush were interrupted before deleting the entry.
+        with open(path, 'w') as fobj:
+            fobj.write(contents)
+        self.assertEqual(self.spool.flush(), (1, 0, 0, None))
+        self.assertEqual(Statistic.objects.count(), 1)
+
+    def test_idempotent_delta(self):
+        """Flushing an entry twice with delta storage writes neither statistics nor rollups
+        again.
+
+        """
+        with self.settings(GATHERSTATS_DELTA_STORAGE=True):
+            self.spool.append(self.endpoint, {'a': 1, 'b': 2}, self.then)
+            self.spool.flush()
+            path = self.spool.append(self.endpoint, {'a': 1, 'b': 3}, self.then + HOUR)
+            with open(path) as fobj:
+                contents = fobj.read()
+            self.spool.flush()
+
+            with open(path, 'w') as fobj:
+                fobj.write(contents)
+            self.assertEqual(self.spool.flush(), (1, 0, 0, None))
+
+        self.assertEqual(Statistic.objects.count(), 3)
+        self.assertTrue(Snapshot.objects.get(fetched_at=self.then + HOUR).delta)
+        self.assertEqual(
+            dict(StatisticRollup.objects.filter(period=StatisticRollup.DAY)
+                 .values_list('key__path', 'sample_count')),
+            {'a': 2, 'b': 2})
+
+    def test_database_unavailable(self):
+        """Entries remain in the spool if the database is unavailable."""
+        for idx in range(3):
+            self.spool.append(self.endpoint, {'a': idx}, self.then + idx * HOUR)
+
+        create = Statistic.objects.create_from_stats_response
+        calls = []
+
+        def flaky_create(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise OperationalError('server closed the connection unexpectedly')
+            return create(*args, **kwargs)
+
+        with mock.patch.object(
+                Statistic.objects, 'create_from_stats_response', side_effect=flaky_create):
+            result = self.spool.flush()
+
+        self.assertEqual(result.flushed, 1)
+        self.assertEqual(result.remaining, 2)
+        self.assertIsInstance(result.error, OperationalError)
+        self.assertEqual(len(self.spool), 2)
+
+        self.assertEqual(self.spool.flush(), (2, 0, 0, None))
+        self.assertEqual(Statistic.objects.count(), 3)
+
+    def test_bad_entries(self):
+        """Entries which cannot be written are moved aside."""
+        with open(os.path.join(self.spool.directory, '00000000000000000000-x.json'), 'w') as fobj:
+            fobj.write('{')
+        self.spool.append(self.endpoint, {'a': 1}, self.then)
+
+        self.assertEqual(self.spool.flush(), (1, 1, 0, None))
+        self.assertEqual(os.listdir(self.spool.failed_directory), ['00000000000000000000-x.json'])
+
+
+class SpooledGatherTests(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.spool_dir = os.path.join(tmp_dir.name, 'spool')
+
+    def test_spooled_gather(self):
+        """Responses are spooled and then flushed."""
+        out = io.StringIO()
+        with temporary_file_with_contents(STATS_FIXTURE) as filename:
+            call_command('gatherstats', filename, spool=self.spool_dir, stdout=out)
+        self.assertIn('Spooled response from', out.getvalue())
+        self.assertIn('Flushed 1 spooled response(s); 0 remain', out.getvalue())
+        self.assertEqual(Statistic.objects.count(), len(STATS_ITEMS))
+        self.assertEqual(len(Spool(self.spool_dir)), 0)
+
+    def test_database_unavailable(self):
+        """Fetched responses are kept if the database is unavailable and flushed later."""
+        error = OperationalError('could not connect to server')
+        with temporary_file_with_contents(STATS_FIXTURE) as filename, \
+                mock.patch('gatherstats.spool._write_entry', side_effect=error), \
+                mock.patch(
+                    'gatherstats.management.commands.gatherstats._validators',
+                    side_effect=error):
+            call_command(
+                'gatherstats', filename, spool=self.spool_dir, stdout=io.StringIO(),
+                stderr=io.StringIO())
+        self.assertEqual(len(Spool(self.spool_dir)), 1)
+        self.assertEqual(Statistic.objects.count(), 0)
+
+        out = io.StringIO()
+        call_command('flushstats', spool=self.spool_dir, stdout=out)
+        self.assertIn('Flushed 1 spooled response(s); 0 remain', out.getvalue())
+        self.assertEqual(Statistic.objects.count(), len(STATS_ITEMS))
+
+    def test_flushstats_retries(self):
+        """flushstats retries and fails if responses remain."""
+        Spool(self.spool_dir).append(
+            'https://a.invalid/', json.loads(STATS_FIXTURE), timezone.now())
+        error = OperationalError('could not connect to server')
+        with mock.patch('gatherstats.spool._write_entry', side_effect=error) as write_entry, \
+                mock.patch('time.sleep'), self.assertRaises(CommandError):
+            call_command(
+                'flushstats', spool=self.spool_dir, retries=2, stdout=io.StringIO(),
+                stderr=io.StringIO())
+        self.assertEqual(write_entry.call_count, 3)
+
+    def test_bad_arguments(self):
+        with self.assertRaises(CommandError):
+            call_command('flushstats')
+        with self.assertRaises(CommandError):
+            call_command('gatherstats', 'x', spool=self.spool_dir, stream=True)
@@ -0,0 +1,69 @@
+"""
+Test incremental parsing of stats response bodies.
+
+"""
+import io
+import json
+
+from django.test import TestCase
+
+from gatherstats.models import _BodyHasher, _body_hash, _flatten_dict
+from gatherstats.streaming import CountingReader, iter_items
+
+
+BODY = {
+    'foo': 45,
+    'bar': {
+        'buzz': 70.5,
+        'bang': 'hello',
+        'deeper': {'a': None, 'b': True, 'c': {'d': -3}},
+        'empty': {},
+    },
+    'quux': {},
+    'list': [1, {'x': [2, 3]}, []],
+    'after': 7,
+}
+
+
+class IterItemsTests(TestCase):
+    def test_matches_flatten_dict(self):
+        """The same key path, value pairs are generated as by _flatten_dict()."""
+        items = list(iter_items(io.BytesIO(json.dumps(BODY).encode('utf8'))))
+        expected = list(_flatten_dict(BODY))
+
+        self.assertEqual(len(items), len(expected))
+        self.assertEqual(
+            sorted(items, key=lambda item: item[0]), sorted(expected, key=lambda item: item[0]))
+
+    def test_type_error(self):
+        """A body which is not an object raises a type error on first iteration."""
+        for body in [b'[]', b'1', b'"foo"']:
+            with self.assertRaises(TypeError):
+                list(iter_items(io.BytesIO(body)))
+
+
+class CountingReaderTests(TestCase):
+    def test_count(self):
+        """The number of bytes read is recorded."""
+        data = json.dumps(BODY).encode('utf8')
+        reader = CountingReader(io.BytesIO(data))
+        list(iter_items(reader))
+        self.assertEqual(reader.bytes_read, len(data))
+
+
+class BodyHashTests(TestCase):
+    def test_streamed_hash_matches(self):
+        """A body parsed incrementally has the same hash as the parsed body."""
+        hasher = _BodyHasher()
+        items = list(hasher.hash_items(iter_items(io.BytesIO(json.dumps(BODY).encode('utf8')))))
+        self.assertEqual(len(items), len(list(_flatten_dict(BODY))))
+        self.assertEqual(hasher.hexdigest(), _body_hash(BODY))
+        self.assertEqual(len(hasher.hexdigest()), 64)
+
+    def test_values_hashed(self):
+        """Changing a key or a value changes the hash."""
+        hashes = {
+            _body_hash(body)
+            for body in [BODY, dict(BODY, foo=46), dict(BODY, foo2=45), {}]
+        }
+        self.assertEqual(len(hashes), 4)
@@ -0,0 +1,273 @@
+"""
+Test the read API.
+
+"""
+import datetime
+import json
+import os
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from gatherstats.models import Statistic, StatisticKey, _glob_regex
+
+HOUR = datetime.timedelta(hours=1)
+
+
+class SeriesTest(TestCase):
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create_user('viewer'))
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        for idx in range(3):
+            Statistic.objects.create_from_stats_response(
+                endpoint=self.endpoint, fetched_at=self.then + idx * HOUR, body={
+                    'all': {'total': 10 + idx, 'completed': idx},
+                    'by_institution': {
+                        'INSTA': {'total': 5, 'completed': idx},
+                        'INSTB': {'total': 5 + idx, 'completed': 0},
+                    },
+                })
+        Statistic.objects.create_from_stats_response(
+            endpoint='https://other.invalid/', fetched_at=self.then, body={'all': {'total': 1}})
+
+    def get(self, **params):
+        return self.client.get(
+            reverse('gatherstats:series'), dict(endpoint=self.endpoint, **params))
+
+    def get_json(self, **params):
+        response = self.get(**params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(b''.join(response.streaming_content).decode('utf8'))
+
+    def test_single_key(self):
+        body = self.get_json(key='all.total')
+        self.assertEqual(body['endpoint'], self.endpoint)
+        self.assertEqual(body['columns'], ['fetched_at', 'value'])
+        self.assertEqual(body['series'], {
+            'all.total': [
+                [(self.then + idx * HOUR).isoformat(), 10.0 + idx] for idx in range(3)
+            ],
+        })
+
+    def test_glob_and_prefix(self):
+        body = self.get_json(key=['by_institution.*.total', 'all.total'], prefix='all.comp')
+        self.assertEqual(set(body['series']), {
+            'all.total', 'all.completed', 'by_institution.INSTA.total',
+            'by_institution.INSTB.total',
+        })
+        self.assertEqual(set(self.get_json(key='**.completed')['series']), {
+            'all.completed', 'by_institution.INSTA.completed', 'by_institution.INSTB.completed',
+        })
+
+    def test_time_range(self):
+        body = self.get_json(
+            key='all.total', start=(self.then + HOUR).isoformat(),
+            end=(self.then + 2 * HOUR).isoformat())
+        self.assertEqual(body['series'], {'all.total': [[(self.then + HOUR).isoformat(), 11.0]]})
+
+    def test_no_matches(self):
+        self.assertEqual(self.get_json(key='nonexistent')['series'], {})
+
+    def test_rollups(self):
+        body = self.get_json(key='all.*', period='day')
+        self.assertEqual(body['columns'], ['period_start', 'count', 'mean', 'min', 'max', 'last'])
+        day_start = self.then.replace(hour=0, minute=0, second=0).isoformat()
+        self.assertEqual(body['series'], {
+            'all.total': [[day_start, 3, 11.0, 10.0, 12.0, 12.0]],
+            'all.completed': [[day_start, 3, 1.0, 0.0, 2.0, 2.0]],
+        })
+
+    def test_single_query(self):
+        """All series are read with one query."""
+        response = self.get(key=['all.*', 'by_institution.**'])
+        with self.assertNumQueries(1):
+            body = json.loads(b''.join(response.streaming_content).decode('utf8'))
+        self.assertEqual(len(body['series']), 6)
+
+    def test_bad_requests(self):
+        self.assertEqual(
+            self.client.get(reverse('gatherstats:series'), {'key': 'all.total'}).status_code, 400)
+        self.assertEqual(self.get().status_code, 400)
+        self.assertEqual(self.get(key='all.total', start='yesterday').status_code, 400)
+        self.assertEqual(self.get(key='all.total', period='week').status_code, 400)
+
+
+class LatestTest(TestCase):
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create_user('viewer'))
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        for idx in range(3):
+            Statistic.objects.create_from_stats_response(
+                endpoint=self.endpoint, fetched_at=self.then + idx * HOUR,
+                body={'all': {'total': 10 + idx, 'completed': idx}})
+
+    def get(self, **params):
+        return self.client.get(
+            reverse('gatherstats:latest'), dict(endpoint=self.endpoint, **params))
+
+    def test_all_keys(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        last = (self.then + 2 * HOUR).isoformat()
+        self.assertEqual(response.json(), {
+            'endpoint': self.endpoint,
+            'columns': ['fetched_at', 'value'],
+            'values': {'all.total': [last, 12.0], 'all.completed': [last, 2.0]},
+        })
+
+    def test_selected_keys(self):
+        self.assertEqual(list(self.get(key='*.total').json()['values']), ['all.total'])
+        self.assertEqual(self.get(prefix='none.').json()['values'], {})
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(reverse('gatherstats:latest')).status_code, 400)
+
+
+class CompareTest(TestCase):
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create_user('viewer'))
+        self.endpoint = 'https://iar-backend.invalid/'
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        for idx in range(2):
+            Statistic.objects.create_from_stats_response(
+                endpoint=self.endpoint, fetched_at=self.then + idx * HOUR,
+                body={'all': {'total': 10 + 10 * idx, 'completed': 0}})
+
+    def get(self, **params):
+        return self.client.get(
+            reverse('gatherstats:compare'), dict(endpoint=self.endpoint, **params))
+
+    def test_compare(self):
+        response = self.get(
+            before=self.then.isoformat(), after=(self.then + HOUR).isoformat(), key='all.*')
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content.decode('utf8'))
+        self.assertEqual(body['columns'], ['before', 'after', 'change', 'relative_change'])
+        self.assertEqual(body['changes'], {
+            'all.total': [10.0, 20.0, 10.0, 1.0],
+            'all.completed': [0.0, 0.0, 0.0, None],
+        })
+
+    def test_bad_request(self):
+        self.assertEqual(self.get(before=self.then.isoformat()).status_code, 400)
+        self.assertEqual(self.get(before='yesterday', after='today').status_code, 400)
+        self.assertEqual(
+            self.get(before=(self.then + HOUR).isoformat(), after=self.then.isoformat())
+            .status_code, 400)
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create_user('viewer'))
+        self.then = timezone.make_aware(datetime.datetime(2013, 12, 11, 10, 9, 8))
+        for idx in range(2):
+            Statistic.objects.create_from_stats_response(
+                endpoint='https://iar-backend.invalid/', fetched_at=self.then + idx * HOUR,
+                body={'all': {'total': 10 + idx}}, fetch_duration=datetime.timedelta(seconds=2))
+
+    def test_disabled(self):
+        """The view is disabled by default."""
+        self.assertEqual(self.client.get(reverse('gatherstats:metrics')).status_code, 404)
+
+    def test_access(self):
+        """Anonymous users are refused unless the metrics view is public."""
+        self.client.logout()
+        with self.settings(GATHERSTATS_METRICS_VIEW=True):
+            self.assertEqual(self.client.get(reverse('gatherstats:metrics')).status_code, 403)
+            with self.settings(GATHERSTATS_METRICS_PUBLIC=True):
+                self.assertEqual(
+                    self.client.get(reverse('gatherstats:metrics')).status_code, 200)
+            # Making the rest of the API public does not make the metrics view public.
+            with self.settings(GATHERSTATS_API_PUBLIC=True):
+                self.assertEqual(
+                    self.client.get(reverse('gatherstats:metrics')).status_code, 403)
+
+    def test_snapshot_metrics(self):
+        """Metrics of the latest snapshot of each endpoint are returned."""
+        with self.settings(GATHERSTATS_METRICS_VIEW=True):
+            response = self.client.get(reverse('gatherstats:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        lines = response.content.decode('utf8').splitlines()
+        labels = '{endpoint="https://iar-backend.invalid/"}'
+        self.assertIn(
+            'gatherstats_snapshot_fetched_timestamp_seconds{} {!r}'.format(
+                labels, (self.then + HOUR).timestamp()),
+            lines)
+        self.assertIn('gatherstats_snapshot_fetch_duration_seconds{} 2.0'.format(labels), lines)
+        self.assertIn('gatherstats_snapshot_keys{} 1'.format(labels), lines)
+        self.assertIn('# TYPE gatherstats_snapshot_unchanged gauge', lines)
+
+    def test_textfile(self):
+        """The metrics written by the last gather are included."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'gatherstats.prom')
+            with self.settings(GATHERSTATS_METRICS_VIEW=True, GATHERSTATS_METRICS_TEXTFILE=path):
+                # A missing file is ignored.
+                self.assertEqual(self.client.get(reverse('gatherstats:metrics')).status_code, 200)
+
+                with open(path, 'w') as fobj:
+                    fobj.write('gatherstats_gather_success{endpoint="x"} 1\n')
+                response = self.client.get(reverse('gatherstats:metrics'))
+        self.assertIn(
+            'gatherstats_gather_success{endpoint="x"} 1',
+            response.content.decode('utf8').splitlines())
+
+
+class AccessTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('viewer')
+        self.urls = [
+            reverse('gatherstats:series') + '?endpoint=https://a.invalid/&key=all.total',
+            reverse('gatherstats:latest') + '?endpoint=https://a.invalid/',
+            reverse('gatherstats:compare') + (
+                '?endpoint=https://a.invalid/&before=2018-01-01T00:00:00Z'
+                '&after=2018-01-02T00:00:00Z'),
+        ]
+
+    def assertStatus(self, status_code):
+        for url in self.urls:
+            self.assertEqual(self.client.get(url).status_code, status_code, url)
+
+    def test_anonymous(self):
+        """Anonymous users are refused unless the API is public."""
+        self.assertStatus(403)
+        with self.settings(GATHERSTATS_API_PUBLIC=True):
+            self.assertStatus(200)
+
+    def test_logged_in(self):
+        self.client.force_login(self.user)
+        self.assertStatus(200)
+
+    def test_permission(self):
+        """Logged in users must have the configured permission."""
+        self.client.force_login(self.user)
+        with self.settings(GATHERSTATS_API_PERMISSION='gatherstats.view_statistic'):
+            self.assertStatus(403)
+            self.user.user_permissions.add(Permission.objects.get(codename='view_statistic'))
+            self.client.force_login(get_user_model().objects.get(pk=self.user.pk))
+            self.assertStatus(200)
+
+
+class GlobTest(TestCase):
+    def test_glob_regex(self):
+        paths = ['a.b.c', 'a.bb.c', 'a.b.c.d', 'a_b', 'axb']
+        StatisticKey.objects.bulk_create([StatisticKey.for_path(path) for path in paths])
+
+        def matching(pattern):
+            return set(
+                StatisticKey.objects.filter(path__regex=_glob_regex(pattern))
+                .values_list('path', flat=True))
+
+        self.assertEqual(matching('a.*.c'), {'a.b.c', 'a.bb.c'})
+        self.assertEqual(matching('a.?.c'), {'a.b.c'})
+        self.assertEqual(matching('a.**'), {'a.b.c', 'a.bb.c', 'a.b.c.d'})
+        self.assertEqual(matching('a_b'), {'a_b'})
+        self.assertEqual(matching('a?b'), {'a_b', 'axb'})
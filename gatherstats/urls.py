@@ -0,0 +1,16 @@
+"""
+URL patterns for the read API provided by :py:mod:`gatherstats.views`.
+
+"""
+from django.urls import path
+
+from . import views
+
+app_name = 'gatherstats'
+
+urlpatterns = [
+    path('compare', views.compare, name='compare'),
+    path('latest', views.latest, name='latest'),
+    path('metrics', views.metrics, name='metrics'),
+    path('series', views.series, name='series'),
+]
@@ -0,0 +1,413 @@
+"""
+A read-only JSON API returning the latest values and time series of gathered statistics.
+
+The API is only available to logged in users unless the ``GATHERSTATS_API_PUBLIC`` setting is
+True. If the ``GATHERSTATS_API_PERMISSION`` setting names a permission, such as
+``"gatherstats.view_statistic"``, users must also have that permission. Other requests get a
+403 Forbidden response.
+
+The ``series`` view returns the values of one or more keys from one endpoint over a range of
+time. It accepts the following query parameters:
+
+``endpoint``
+    URL of the endpoint. Required.
+
+``key``
+    Key path or glob pattern selecting keys. In a pattern, ``*`` matches within one component
+    of the key path, ``**`` matches across components and ``?`` matches a single character.
+    May be repeated.
+
+``prefix``
+    Select keys whose path starts with this prefix. May be repeated. At least one ``key`` or
+    ``prefix`` must be given.
+
+``start``, ``end``
+    ISO 8601 date and time. Only values fetched at or after *start* and before *end* are
+    returned. Times without a time zone are in the server's time zone. Optional.
+
+``period``
+    One of ``raw`` (the default), ``hour`` or ``day``. For ``hour`` and ``day``, the
+    :py:class:`~gatherstats.models.StatisticRollup` rows for each period are returned in place of
+    individual statistics.
+
+The response is a JSON object of the following form:
+
+.. code:: js
+
+    {
+        "endpoint": "https://iar-backend.invalid/stats",
+        "period": "raw",
+        "columns": ["fetched_at", "value"],
+        "series": {
+            "asset_counts.all.total": [["2018-01-01T00:00:00+00:00", 1234.0], ...],
+            // ... etc
+        }
+    }
+
+For rollups, the columns are "period_start", "count", "mean", "min", "max" and "last". For
+endpoints gathered with change-only storage, raw series only contain the changed values.
+
+All series are read by a single database query which is iterated over with a server-side cursor
+where supported and the response is streamed as rows arrive.
+
+The ``latest`` view returns the latest value of each key from one endpoint. It accepts the
+``endpoint``, ``key`` and ``prefix`` parameters as above. If no ``key`` or ``prefix`` is given,
+all keys are returned. The response is a JSON object of the following form:
+
+.. code:: js
+
+    {
+        "endpoint": "https://iar-backend.invalid/stats",
+        "columns": ["fetched_at", "value"],
+        "values": {
+            "asset_counts.all.total": ["2018-01-01T00:00:00+00:00", 1234.0],
+            // ... etc
+        }
+    }
+
+The latest values are read from :py:class:`~gatherstats.models.LatestStatistic` and so the cost
+of the query does not grow with the amount of history gathered.
+
+The ``compare`` view returns the change in the value of each key from one endpoint between two
+instants. It accepts the ``endpoint``, ``key`` and ``prefix`` parameters as above, all keys being
+compared if no ``key`` or ``prefix`` is given, and the required ``before`` and ``after``
+parameters, which are ISO 8601 dates and times. The response is a JSON object of the following
+form:
+
+.. code:: js
+
+    {
+        "endpoint": "https://iar-backend.invalid/stats",
+        "before": "2018-01-01T00:00:00+00:00",
+        "after": "2018-01-08T00:00:00+00:00",
+        "columns": ["before", "after", "change", "relative_change"],
+        "changes": {
+            "asset_counts.all.total": [1234.0, 1300.0, 66.0, 0.0535],
+            // ... etc
+        }
+    }
+
+Values are null if the key had no value at an instant or the change cannot be computed. All the
+values are read by a single query. See :py:mod:`gatherstats.comparison`.
+
+The ``metrics`` view returns metrics in the Prometheus text format. It is only enabled if the
+``GATHERSTATS_METRICS_VIEW`` setting is True. Gauges of the fetch time, fetch duration, key
+count and whether the response was unchanged are given for the latest snapshot of each endpoint.
+Access is controlled as for the other views except that the ``GATHERSTATS_METRICS_PUBLIC``
+setting, rather than ``GATHERSTATS_API_PUBLIC``, makes the view available to anyone, such as a
+Prometheus server which cannot log in.
+If the ``GATHERSTATS_METRICS_TEXTFILE`` setting is set and the file can be read, the metrics
+written to it by the last gather are appended. See :py:mod:`gatherstats.metrics`. If caching is
+enabled, the numbers of cache hits and misses in the serving process are also given.
+
+If the ``GATHERSTATS_CACHE`` setting names a cache, the results of the ``series``, ``latest``
+and ``compare`` views are cached until statistics of the endpoint are next ingested. See
+:py:mod:`gatherstats.caching`.
+
+"""
+import collections
+import functools
+import json
+
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import dateparse, timezone
+from django.views.decorators.http import require_GET
+
+from . import caching
+from . import metrics as gather_metrics
+from .models import (
+    Endpoint, LatestStatistic, Snapshot, Statistic, StatisticKey, StatisticRollup)
+
+#: Columns of each point in a series of raw statistics and of each latest value.
+RAW_COLUMNS = ['fetched_at', 'value']
+
+#: Columns of each point in a series of rollups.
+ROLLUP_COLUMNS = ['period_start', 'count', 'mean', 'min', 'max', 'last']
+
+#: Columns of each key's change.
+COMPARE_COLUMNS = ['before', 'after', 'change', 'relative_change']
+
+#: Number of rows read from the database at a time.
+CHUNK_SIZE = 2000
+
+
+def _access_required(public_setting):
+    """Decorator for views which may only be used by logged in users having the permission
+    named by the ``GATHERSTATS_API_PERMISSION`` setting, if it is not None, unless the setting
+    named *public_setting* is True. Other requests get a 403 Forbidden response.
+
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(request, *args, **kwargs):
+            denied = _access_denied(request, public_setting)
+            if denied is not None:
+                return denied
+            return view(request, *args, **kwargs)
+        return wrapped_view
+    return decorator
+
+
+def _access_denied(request, public_setting):
+    """Return a 403 Forbidden response if *request* may not use a view as described for
+    :py:func:`_access_required`, otherwise None.
+
+    """
+    if getattr(settings, public_setting):
+        return None
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return _forbidden('Authentication is required')
+    permission = settings.GATHERSTATS_API_PERMISSION
+    if permission is not None and not user.has_perm(permission):
+        return _forbidden('Permission {} is required'.format(permission))
+    return None
+
+
+@require_GET
+@_access_required('GATHERSTATS_API_PUBLIC')
+def series(request):
+    """Return time series of the statistics selected by the query parameters."""
+    endpoint = request.GET.get('endpoint')
+    if not endpoint:
+        return _bad_request('The endpoint parameter is required')
+
+    keys = _selected_keys(request)
+    if keys is None:
+        return _bad_request('At least one key or prefix parameter is required')
+
+    try:
+        start, end = _parse_datetime_param(request, 'start'), _parse_datetime_param(request, 'end')
+    except ValueError as e:
+        return _bad_request(str(e))
+
+    period = request.GET.get('period', 'raw')
+
+    # The rows of each series are consecutive since they are ordered by key. Ordering by key
+    # primary key rather than path matches the endpoint/key/time indexes.
+    if period == 'raw':
+        def read_rows():
+            qs = Statistic.objects.filter(endpoint__url=endpoint, key__in=keys)
+            if start is not None:
+                qs = qs.filter(fetched_at__gte=start)
+            if end is not None:
+                qs = qs.filter(fetched_at__lt=end)
+            return (
+                qs.order_by('key_id', 'fetched_at')
+                .values_list('key__path', 'fetched_at', 'numeric_value')
+                .iterator(chunk_size=CHUNK_SIZE)
+            )
+        columns = RAW_COLUMNS
+    elif period in dict(StatisticRollup.PERIOD_CHOICES):
+        def read_rows():
+            qs = StatisticRollup.objects.filter(
+                endpoint__url=endpoint, key__in=keys, period=period)
+            if start is not None:
+                qs = qs.filter(period_start__gte=start)
+            if end is not None:
+                qs = qs.filter(period_start__lt=end)
+            return (
+                (path, period_start, count, total / count, minimum, maximum, last_value)
+                for path, period_start, count, total, minimum, maximum, last_value in (
+                    qs.order_by('key_id', 'period_start')
+                    .values_list(
+                        'key__path', 'period_start', 'sample_count', 'total', 'minimum',
+                        'maximum', 'last_value')
+                    .iterator(chunk_size=CHUNK_SIZE)
+                )
+            )
+        columns = ROLLUP_COLUMNS
+    else:
+        return _bad_request('Unknown period: {}'.format(period))
+
+    rows = caching.iterate_or_compute(
+        endpoint, 'series', [request.GET.getlist('key'), request.GET.getlist('prefix'), start,
+                             end, period], read_rows)
+    header = {'endpoint': endpoint, 'period': period, 'columns': columns}
+    return StreamingHttpResponse(
+        _stream_series(header, rows), content_type='application/json')
+
+
+@require_GET
+@_access_required('GATHERSTATS_API_PUBLIC')
+def latest(request):
+    """Return the latest value of each of the keys selected by the query parameters."""
+    endpoint = request.GET.get('endpoint')
+    if not endpoint:
+        return _bad_request('The endpoint parameter is required')
+
+    def read_values():
+        qs = LatestStatistic.objects.for_endpoint(endpoint)
+        keys = _selected_keys(request)
+        if keys is not None:
+            qs = qs.filter(key__in=keys)
+        return {
+            path: [fetched_at.isoformat(), value]
+            for path, fetched_at, value in qs.values_list(
+                'key__path', 'fetched_at', 'numeric_value')
+        }
+
+    values = caching.get_or_compute(
+        endpoint, 'latest', [request.GET.getlist('key'), request.GET.getlist('prefix')],
+        read_values)
+    return JsonResponse({'endpoint': endpoint, 'columns': RAW_COLUMNS, 'values': values})
+
+
+@require_GET
+@_access_required('GATHERSTATS_API_PUBLIC')
+def compare(request):
+    """Return the change in the value of each of the keys selected by the query parameters
+    between two instants.
+
+    """
+    endpoint = request.GET.get('endpoint')
+    if not endpoint:
+        return _bad_request('The endpoint parameter is required')
+
+    try:
+        before = _parse_datetime_param(request, 'before')
+        after = _parse_datetime_param(request, 'after')
+    except ValueError as e:
+        return _bad_request(str(e))
+    if before is None or after is None:
+        return _bad_request('The before and after parameters are required')
+    if before > after:
+        return _bad_request('The before parameter must not be later than after')
+
+    changes = Statistic.objects.compare(
+        endpoint, before, after, patterns=request.GET.getlist('key'),
+        prefixes=request.GET.getlist('prefix'))
+    return JsonResponse({
+        'endpoint': endpoint,
+        'before': before.isoformat(),
+        'after': after.isoformat(),
+        'columns': COMPARE_COLUMNS,
+        'changes': {change.key: list(change[1:]) for change in changes},
+    })
+
+
+@require_GET
+def metrics(request):
+    """Return metrics of the latest snapshot of each endpoint and of the last gather."""
+    if not settings.GATHERSTATS_METRICS_VIEW:
+        raise Http404('The metrics view is not enabled')
+    denied = _access_denied(request, 'GATHERSTATS_METRICS_PUBLIC')
+    if denied is not None:
+        return denied
+
+    latest_snapshots = Endpoint.objects.annotate(latest_snapshot=Subquery(
+        Snapshot.objects.filter(endpoint=OuterRef('pk')).order_by('-fetched_at').values('pk')[:1]
+    )).values('latest_snapshot')
+
+    families = collections.OrderedDict([
+        ('gatherstats_snapshot_fetched_timestamp_seconds', (
+            'Time at which the latest snapshot of the endpoint was fetched.', [])),
+        ('gatherstats_snapshot_fetch_duration_seconds', (
+            'Time taken to fetch the latest snapshot of the endpoint.', [])),
+        ('gatherstats_snapshot_keys', (
+            'Number of keys in the latest snapshot of the endpoint.', [])),
+        ('gatherstats_snapshot_unchanged', (
+            'Whether the latest snapshot of the endpoint was unchanged.', [])),
+    ])
+    snapshots = (
+        Snapshot.objects.filter(pk__in=latest_snapshots)
+        .values_list('endpoint__url', 'fetched_at', 'fetch_duration', 'key_count', 'unchanged')
+        .order_by('endpoint__url')
+    )
+    for url, fetched_at, fetch_duration, key_count, unchanged in snapshots:
+        labels = {'endpoint': url}
+        families['gatherstats_snapshot_fetched_timestamp_seconds'][1].append(
+            (labels, fetched_at.timestamp()))
+        if fetch_duration is not None:
+            families['gatherstats_snapshot_fetch_duration_seconds'][1].append(
+                (labels, fetch_duration.total_seconds()))
+        families['gatherstats_snapshot_keys'][1].append((labels, key_count))
+        families['gatherstats_snapshot_unchanged'][1].append((labels, int(unchanged)))
+
+    if settings.GATHERSTATS_CACHE is not None:
+        cache_counts = caching.counts()
+        families['gatherstats_cache_hits'] = (
+            'Number of query results read from the cache by this process.',
+            [({}, cache_counts['hits'])])
+        families['gatherstats_cache_misses'] = (
+            'Number of query results computed and cached by this process.',
+            [({}, cache_counts['misses'])])
+
+    content = gather_metrics.format_gauges(families)
+    if settings.GATHERSTATS_METRICS_TEXTFILE is not None:
+        try:
+            with open(settings.GATHERSTATS_METRICS_TEXTFILE) as fobj:
+                content += fobj.read()
+        except OSError:
+            pass
+
+    return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _bad_request(message):
+    return JsonResponse({'error': message}, status=400)
+
+
+def _forbidden(message):
+    return JsonResponse({'error': message}, status=403)
+
+
+def _selected_keys(request):
+    """Return a queryset of the keys selected by the key and prefix query parameters or None if
+    neither parameter was given.
+
+    """
+    patterns, prefixes = request.GET.getlist('key'), request.GET.getlist('prefix')
+    if len(patterns) + len(prefixes) == 0:
+        return None
+    return StatisticKey.objects.matching(patterns, prefixes)
+
+
+def _parse_datetime_param(request, name):
+    """Parse the ISO 8601 date and time query parameter *name* as an aware datetime. Return None
+    if the parameter is absent. Raises :py:exc:`ValueError` if the parameter is invalid.
+
+    """
+    value = request.GET.get(name)
+    if value is None:
+        return None
+    parsed = dateparse.parse_datetime(value)
+    if parsed is None:
+        raise ValueError('Invalid {} parameter: {}'.format(name, value))
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _stream_series(header, rows):
+    """A generator which yields the JSON serialisation of the object *header* with a "series"
+    member added mapping key path to list of points. The iterable *rows* yields tuples of key
+    path followed by the point's values and the rows for each key must be consecutive. Output is
+    generated in chunks of about :py:data:`CHUNK_SIZE` points.
+
+    """
+    encoder = json.JSONEncoder()
+    chunk = [encoder.encode(header)[:-1], ', "series": {']
+    current_path = None
+    for path, *point in rows:
+        if path != current_path:
+            if current_path is not None:
+                chunk.append('], ')
+            chunk.extend([encoder.encode(path), ': ['])
+            current_path = path
+        else:
+            chunk.append(', ')
+        chunk.append(encoder.encode([
+            value.isoformat() if hasattr(value, 'isoformat') else value for value in point
+        ]))
+
+        if len(chunk) >= 3 * CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+
+    if current_path is not None:
+        chunk.append(']')
+    chunk.append('}}')
+    yield ''.join(chunk)
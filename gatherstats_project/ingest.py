@@ -0,0 +1,29 @@
+"""
+The :py:mod:`gatherstats_project.ingest` module is the entry point of the ``ingest.py`` script.
+It runs the gatherstats management command with a minimal Django start up: the settings module
+is given by the ``DJANGO_INGEST_SETTINGS_MODULE`` environment variable, defaulting to
+:py:mod:`gatherstats_project.settings.ingest`, and the command is run directly rather than via
+``manage.py``'s discovery of every installed application's commands.
+
+"""
+import os
+import sys
+
+#: Settings module used if ``DJANGO_INGEST_SETTINGS_MODULE`` is not set.
+DEFAULT_SETTINGS_MODULE = 'gatherstats_project.settings.ingest'
+
+
+def main(argv=None):
+    """Run the gatherstats management command with the command line arguments *argv*, which
+    default to :py:data:`sys.argv` and start with the program name.
+
+    """
+    argv = argv if argv is not None else sys.argv
+    os.environ['DJANGO_SETTINGS_MODULE'] = os.environ.get(
+        'DJANGO_INGEST_SETTINGS_MODULE', DEFAULT_SETTINGS_MODULE)
+
+    import django
+    django.setup()
+
+    from gatherstats.management.commands.gatherstats import Command
+    Command().run_from_argv([argv[0], 'gatherstats'] + argv[1:])
@@ -0,0 +1,34 @@
+"""
+The :py:mod:`gatherstats_project.settings.ingest` module contains settings for processes which
+only gather statistics, such as those started by the ``ingest.py`` script. Only the
+:py:mod:`gatherstats` application is installed and so Django starts up with just the ORM and the
+gatherstats models. The admin, authentication, sessions and web interface are not available.
+
+Run migrations and other management commands with the regular settings.
+
+"""
+# Import settings from the base settings file
+from .base import *  # noqa: F401, F403
+
+#: Ingest processes are never served and debug mode would keep every query in memory.
+DEBUG = False
+
+#: Only the gatherstats application is installed.
+INSTALLED_APPS = [
+    'gatherstats',
+]
+
+#: No requests are served.
+MIDDLEWARE = []
+
+#: No templates are rendered.
+TEMPLATES = []
+
+#: No users log in.
+AUTHENTICATION_BACKENDS = []
+
+#: No users log in.
+AUTH_PASSWORD_VALIDATORS = []
+
+#: Nothing is translated.
+USE_I18N = False
@@ -1,5 +1,9 @@
 """
-The IAR stats gatherer application has no URLs since it has no views.
+The IAR stats gatherer exposes a read-only JSON API for the gathered statistics.
 
 """
-urlpatterns = []
+from django.urls import include, path
+
+urlpatterns = [
+    path('api/', include('gatherstats.urls')),
+]
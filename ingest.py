@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+"""
+Gather statistics with a minimal Django start up. Takes the same arguments as
+"./manage.py gatherstats". See gatherstats_project/ingest.py.
+
+"""
+from gatherstats_project.ingest import main
+
+if __name__ == "__main__":
+    main()